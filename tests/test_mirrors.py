@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import os
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import tg_bot_minecraft_server as bot
+
+JAR = os.urandom(256 * 1024)
+BAD_JAR = JAR[:-1] + b"\0"
+
+
+class Host:
+    def __init__(self, body=JAR, status=200, checksum=True):
+        self.body = body
+        self.status = status
+        self.checksum = checksum
+        self.paths = []
+
+    async def handle(self, request):
+        self.paths.append(request.path)
+        if self.status != 200:
+            return web.Response(status=self.status)
+        if request.path.endswith(".sha1"):
+            if not self.checksum:
+                return web.Response(status=404)
+            return web.Response(text=hashlib.sha1(self.body).hexdigest() + "  server.jar\n")
+        return web.Response(body=self.body, headers={"ETag": '"jar"'})
+
+
+@pytest.fixture(autouse=True)
+def clean_stats(monkeypatch):
+    monkeypatch.setattr(bot, "SEGMENTED_DOWNLOADS", False)
+    monkeypatch.setattr(bot, "RETRY_BASE_DELAY", 0.01)
+    monkeypatch.setattr(bot, "MIRROR_HEDGE_DELAY", 0.2)
+    monkeypatch.setattr(bot, "host_breakers", {})
+    monkeypatch.setattr(bot, "mirror_stats", {})
+    monkeypatch.setattr(bot, "download_stats", dict.fromkeys(bot.download_stats, 0))
+
+
+def run(monkeypatch, origin, mirror, scenario, checksummed=True):
+    async def main():
+        runners = []
+        bases = []
+        for host in (origin, mirror):
+            app = web.Application()
+            app.router.add_get("/{path:.*}", host.handle)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", 0).start()
+            runners.append(runner)
+            address = runner.addresses[0]
+            bases.append(f"http://{address[0]}:{address[1]}")
+        monkeypatch.setattr(bot, "MIRRORS", {bases[0]: tuple(bases)})
+        monkeypatch.setattr(bot, "CHECKSUM_ORIGINS", {bases[0]: "sha1"} if checksummed else {})
+        bot.mirror_stats[bases[0]] = {"ewma": 1.0, "wins": 0, "lost": 0, "errors": 0}
+        bot.mirror_stats[bases[1]] = {"ewma": 0.0, "wins": 0, "lost": 0, "errors": 0}
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await scenario(session, bases[0] + "/maven/server.jar", bases)
+        finally:
+            for runner in runners:
+                await runner.cleanup()
+
+    return asyncio.run(main())
+
+
+def test_bad_mirror_fails_origin_checksum(monkeypatch, tmp_path):
+    origin, mirror = Host(), Host(body=BAD_JAR)
+    dest = str(tmp_path / "jar.part")
+
+    async def scenario(session, url, bases):
+        return await bot.download_with_retry(session, url, dest_path=dest)
+
+    run(monkeypatch, origin, mirror, scenario)
+    with open(dest, 'rb') as f:
+        assert f.read() == JAR
+    assert "/maven/server.jar.sha1" not in mirror.paths
+    assert bot.download_stats["checksum_failures"] == 1
+    assert bot.download_stats["verified"] == 1
+
+
+def test_mirror_jar_refused_without_origin_checksum(monkeypatch, tmp_path):
+    origin, mirror = Host(checksum=False), Host()
+    dest = str(tmp_path / "jar.part")
+
+    async def scenario(session, url, bases):
+        return await bot.download_with_retry(session, url, dest_path=dest)
+
+    run(monkeypatch, origin, mirror, scenario)
+    with open(dest, 'rb') as f:
+        assert f.read() == JAR
+    assert "/maven/server.jar" in origin.paths
+    assert bot.download_stats["verified"] == 0
+
+
+def test_mirror_jar_refused_when_origin_is_down(monkeypatch, tmp_path):
+    origin, mirror = Host(status=503), Host()
+    dest = str(tmp_path / "jar.part")
+
+    async def scenario(session, url, bases):
+        with pytest.raises(bot.UpstreamUnavailable):
+            await bot.download_with_retry(session, url, dest_path=dest)
+
+    run(monkeypatch, origin, mirror, scenario)
+    assert not os.path.exists(dest)
+
+
+def test_artifacts_without_checksum_are_not_mirrored(monkeypatch, tmp_path):
+    origin, mirror = Host(), Host()
+    dest = str(tmp_path / "jar.part")
+
+    async def scenario(session, url, bases):
+        return await bot.download_with_retry(session, url, dest_path=dest)
+
+    run(monkeypatch, origin, mirror, scenario, checksummed=False)
+    with open(dest, 'rb') as f:
+        assert f.read() == JAR
+    assert mirror.paths == []
+
+
+def test_origin_404_is_not_counted_as_mirror_error(monkeypatch):
+    origin, mirror = Host(status=404), Host(status=404)
+
+    async def scenario(session, url, bases):
+        bot.mirror_stats[bases[0]]["ewma"] = 0.0
+        bot.mirror_stats[bases[1]]["ewma"] = 0.1
+        response, _ = await bot.hedged_get(session, bot.mirror_urls(url))
+        response.release()
+        assert response.status == 404
+        return bases
+
+    bases = run(monkeypatch, origin, mirror, scenario)
+    assert bot.mirror_stats[bases[0]]["errors"] == 0
+    assert bot.mirror_stats[bases[0]]["lost"] == 1
+    assert bot.mirror_urls(bases[0] + "/maven/x.jar")[0].startswith(bases[0])
@@ -0,0 +1,201 @@
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+import tg_bot_minecraft_server as bot
+
+
+class FakeRedis:
+    def __init__(self, password=None):
+        self.password = password
+        self.strings = {}
+        self.hashes = {}
+        self.expires = {}
+        self.commands = []
+        self.lock = threading.Lock()
+
+    def _alive(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.strings.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.strings
+
+    def handle(self, args, session):
+        name = args[0].upper()
+        self.commands.append(name)
+        if name == "AUTH":
+            if args[1] != self.password:
+                return Exception("WRONGPASS invalid password")
+            session["auth"] = True
+            return "OK"
+        if self.password and not session.get("auth"):
+            return Exception("NOAUTH Authentication required")
+        with self.lock:
+            if name == "SELECT":
+                session["db"] = int(args[1])
+                return "OK"
+            if name == "HGET":
+                return self.hashes.get(args[1], {}).get(args[2])
+            if name == "HSET":
+                self.hashes.setdefault(args[1], {})[args[2]] = args[3]
+                return 1
+            if name == "HDEL":
+                return 1 if self.hashes.get(args[1], {}).pop(args[2], None) is not None else 0
+            if name == "SET":
+                key, value, options = args[1], args[2], [a.upper() for a in args[3:]]
+                if "NX" in options and self._alive(key):
+                    return None
+                self.strings[key] = value
+                self.expires.pop(key, None)
+                if "PX" in options:
+                    self.expires[key] = time.time() + int(args[3 + options.index("PX") + 1]) / 1000
+                return "OK"
+            if name == "EVAL":
+                script, key, owner = args[1], args[3], args[4]
+                if not self._alive(key) or self.strings[key] != owner:
+                    return 0
+                if "pexpire" in script:
+                    self.expires[key] = time.time() + int(args[5]) / 1000
+                else:
+                    del self.strings[key]
+                    self.expires.pop(key, None)
+                return 1
+        return Exception(f"ERR unknown command '{name}'")
+
+
+def _encode(reply):
+    if isinstance(reply, Exception):
+        return b"-%s\r\n" % str(reply).encode()
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if reply == "OK":
+        return b"+OK\r\n"
+    data = reply.encode()
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        session = {}
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            assert line[:1] == b"*"
+            args = []
+            for _ in range(int(line[1:-2])):
+                size = int(self.rfile.readline()[1:-2])
+                args.append(self.rfile.read(size + 2)[:-2].decode())
+            self.wfile.write(_encode(self.server.redis.handle(args, session)))
+
+
+@pytest.fixture
+def redis_server():
+    def start(password=None):
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), RespHandler)
+        server.daemon_threads = True
+        server.redis = FakeRedis(password)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    servers = []
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _backend(server, auth=""):
+    host, port = server.server_address
+    return bot.RedisBackend(f"redis://{auth}{host}:{port}/2", "test:")
+
+
+def test_lock_acquire_refresh_release(redis_server):
+    backend = _backend(redis_server())
+    try:
+        assert backend.acquire_lock("build:1", "a", 5)
+        assert not backend.acquire_lock("build:1", "b", 5)
+        assert backend.refresh_lock("build:1", "a", 5)
+        assert not backend.refresh_lock("build:1", "b", 5)
+        backend.release_lock("build:1", "b")
+        assert not backend.acquire_lock("build:1", "b", 5)
+        backend.release_lock("build:1", "a")
+        assert backend.acquire_lock("build:1", "b", 5)
+    finally:
+        backend.close()
+
+
+def test_lock_expires_after_ttl(redis_server):
+    backend = _backend(redis_server())
+    try:
+        assert backend.acquire_lock("build:1", "a", 0.2)
+        assert not backend.acquire_lock("build:1", "b", 0.2)
+        time.sleep(0.3)
+        assert not backend.refresh_lock("build:1", "a", 0.2)
+        assert backend.acquire_lock("build:1", "b", 0.2)
+    finally:
+        backend.close()
+
+
+def test_write_batch_and_load(redis_server):
+    server = redis_server()
+    backend = _backend(server)
+    try:
+        assert backend.load("settings", 1) is None
+        backend.write_batch(
+            [("settings", 1, '{"base": "default", "set": {"ram": "4096"}}'), ("states", 1, '["input_port", "cfg"]')],
+            []
+        )
+        assert backend.load("settings", 1) == {"base": "default", "set": {"ram": "4096"}}
+        assert backend.load_all(["settings", "states", "menu"], 1) == [
+            {"base": "default", "set": {"ram": "4096"}}, ["input_port", "cfg"], None
+        ]
+        backend.write_batch([], [("states", 1)])
+        assert backend.load("states", 1) is None
+        assert "test:state:settings" in server.redis.hashes
+    finally:
+        backend.close()
+
+
+def test_shared_values_round_trip(redis_server):
+    backend = _backend(redis_server())
+    try:
+        backend.set_shared("jars", "fabric|1.20.1|x|y", {"digest": "abc", "size": 3})
+        assert backend.get_shared("jars", "fabric|1.20.1|x|y") == {"digest": "abc", "size": 3}
+        assert backend.get_shared("jars", "missing") is None
+    finally:
+        backend.close()
+
+
+def test_handshake_auth_and_errors(redis_server):
+    server = redis_server(password="secret")
+    backend = _backend(server, ":secret@")
+    try:
+        assert backend.acquire_lock("build:1", "a", 5)
+        assert server.redis.commands[:2] == ["AUTH", "SELECT"]
+    finally:
+        backend.close()
+    wrong = _backend(server, ":nope@")
+    with pytest.raises(Exception, match="WRONGPASS"):
+        wrong.load("settings", 1)
+    wrong.close()
+
+
+def test_reconnects_after_connection_loss(redis_server):
+    server = redis_server()
+    backend = _backend(server)
+    try:
+        backend.set_shared("meta", "k", [1])
+        backend.client._sock.shutdown(socket.SHUT_RDWR)
+        with pytest.raises(OSError):
+            backend.get_shared("meta", "k")
+        assert backend.get_shared("meta", "k") == [1]
+    finally:
+        backend.close()
@@ -0,0 +1,171 @@
+import asyncio
+import os
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import tg_bot_minecraft_server as bot
+
+JAR = os.urandom(2 * 1024 * 1024)
+RATE = 4 * 1024 * 1024
+CHUNK = 32 * 1024
+
+
+class JarServer:
+    def __init__(self):
+        self.requests = []
+        self.cuts = {}
+        self.active = 0
+        self.max_active = 0
+
+    async def handle(self, request):
+        header = request.headers.get("Range")
+        start, end, status = 0, len(JAR) - 1, 200
+        if header:
+            first, last = header.split("=", 1)[1].split("-")
+            start, end, status = int(first), int(last) if last else len(JAR) - 1, 206
+        self.requests.append(start if header else None)
+        headers = {"ETag": '"jar"', "Accept-Ranges": "bytes", "Content-Length": str(end - start + 1)}
+        if header:
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(JAR)}"
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        cut = self.cuts[start].pop(0) if header and self.cuts.get(start) else None
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            pos = start
+            while pos <= end:
+                if cut is not None and pos - start >= cut:
+                    request.transport.close()
+                    return response
+                size = min(CHUNK, end + 1 - pos)
+                await response.write(JAR[pos:pos + size])
+                pos += size
+                await asyncio.sleep(size / RATE)
+            await response.write_eof()
+            return response
+        finally:
+            self.active -= 1
+
+
+@pytest.fixture(autouse=True)
+def segmented(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "SEGMENTED_DOWNLOADS", True)
+    monkeypatch.setattr(bot, "SEGMENT_MIN_SIZE", 256 * 1024)
+    monkeypatch.setattr(bot, "SEGMENT_START_COUNT", 4)
+    monkeypatch.setattr(bot, "RETRY_BASE_DELAY", 0.01)
+    monkeypatch.setattr(bot, "segment_tuning", {})
+    monkeypatch.setattr(bot, "host_breakers", {})
+    monkeypatch.setattr(bot, "mirror_stats", {})
+    monkeypatch.setattr(bot, "download_stats", dict.fromkeys(bot.download_stats, 0))
+    return str(tmp_path / "jar.part")
+
+
+def run(server, scenario):
+    async def main():
+        app = web.Application()
+        app.router.add_get("/jar", server.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await scenario(session, f"http://{host}:{port}/jar")
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(main())
+
+
+def test_segments_download_concurrently(segmented):
+    server = JarServer()
+    delivered = []
+    paced = []
+
+    async def on_chunk(chunk, total_size):
+        delivered.append(chunk)
+
+    async def throttle(nbytes):
+        paced.append(nbytes)
+
+    async def scenario(session, url):
+        return await bot.download_with_retry(session, url, dest_path=segmented, on_chunk=on_chunk, throttle=throttle)
+
+    assert run(server, scenario) == segmented
+    with open(segmented, 'rb') as f:
+        assert f.read() == JAR
+    assert b"".join(delivered) == JAR
+    assert sum(paced) == len(JAR)
+    assert server.max_active >= 2
+    assert len(server.requests) == 4
+    assert bot.download_stats["segmented"] == 1
+    assert bot.segment_tuning["127.0.0.1"]["segments"] == 5
+    assert sum(entry["wins"] for entry in bot.mirror_stats.values()) == 4
+    assert not os.path.exists(segmented + ".json")
+
+
+def test_tune_segments_adapts_to_rate_and_errors(monkeypatch):
+    monkeypatch.setattr(bot, "segment_tuning", {})
+    bot._tune_segments("h", 4, 1000.0, 0)
+    assert bot.segment_tuning["h"]["segments"] == 5
+    bot._tune_segments("h", 5, 1500.0, 0)
+    assert bot.segment_tuning["h"]["segments"] == 6
+    bot._tune_segments("h", 6, 1000.0, 0)
+    assert bot.segment_tuning["h"]["segments"] == 5
+    bot._tune_segments("h", 5, 1050.0, 0)
+    assert bot.segment_tuning["h"]["segments"] == 5
+    bot._tune_segments("h", 5, 5000.0, 2)
+    assert bot.segment_tuning["h"]["segments"] == 4
+    bot._tune_segments("h", bot.SEGMENT_MAX_COUNT, 50000.0, 0)
+    assert bot.segment_tuning["h"]["segments"] == bot.SEGMENT_MAX_COUNT
+    bot._tune_segments("h", 2, 1.0, 1)
+    assert bot.segment_tuning["h"]["segments"] == 2
+    assert bot._segment_count("h", 64 * 1024 * 1024) == 2
+    assert bot._segment_count("other", 3 * bot.SEGMENT_MIN_SIZE) == 3
+
+
+def test_failed_segment_retries_from_its_own_offset(segmented):
+    server = JarServer()
+    third = len(JAR) // 2
+    server.cuts[third] = [128 * 1024]
+
+    async def scenario(session, url):
+        return await bot.download_with_retry(session, url, dest_path=segmented)
+
+    run(server, scenario)
+    with open(segmented, 'rb') as f:
+        assert f.read() == JAR
+    assert bot.download_stats["segment_errors"] == 1
+    assert bot.download_stats["restarts"] == 0
+    assert server.requests.count(third) == 1
+    assert third + 128 * 1024 in server.requests
+    assert bot.segment_tuning["127.0.0.1"]["segments"] == 3
+
+
+def test_exhausted_segment_keeps_contiguous_prefix(segmented):
+    server = JarServer()
+    third = len(JAR) // 2
+    server.cuts[third] = [64 * 1024]
+
+    async def scenario(session, url):
+        with pytest.raises(bot.UpstreamUnavailable):
+            await bot.download_with_retry(session, url, max_retries=1, dest_path=segmented)
+        size = os.path.getsize(segmented)
+        assert 0 < size < len(JAR)
+        assert size <= third + 64 * 1024
+        with open(segmented, 'rb') as f:
+            assert f.read() == JAR[:size]
+        assert os.path.exists(segmented + ".json")
+        server.requests.clear()
+        await bot.download_with_retry(session, url, dest_path=segmented)
+        return size
+
+    size = run(server, scenario)
+    with open(segmented, 'rb') as f:
+        assert f.read() == JAR
+    assert server.requests == [size]
+    assert bot.download_stats["resumed"] == 1
@@ -0,0 +1,84 @@
+import asyncio
+
+import tg_bot_minecraft_server as bot
+
+
+class FlakyBackend(bot.MemoryBackend):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.batches = []
+
+    def write_batch(self, upserts, deletes):
+        self.batches.append((list(upserts), list(deletes)))
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk I/O error")
+        super().write_batch(upserts, deletes)
+
+
+def _store(backend):
+    store = bot.StateStore(backend)
+    return store, bot.StoredDict(store, "menu")
+
+
+def test_failed_flush_is_retried():
+    backend = FlakyBackend(1)
+    store, menu = _store(backend)
+    menu[1] = 100
+
+    async def scenario():
+        try:
+            await store.flush()
+        except OSError:
+            pass
+        else:
+            raise AssertionError("flush should fail")
+        await store.flush()
+
+    asyncio.run(scenario())
+    assert backend.load("menu", 1) == 100
+    assert len(backend.batches) == 2
+    asyncio.run(store.flush())
+    assert len(backend.batches) == 2
+
+
+def test_failed_delete_is_retried():
+    backend = FlakyBackend(0)
+    store, menu = _store(backend)
+    menu[1] = 100
+    asyncio.run(store.flush())
+    backend.failures = 1
+    del menu[1]
+
+    async def scenario():
+        try:
+            await store.flush()
+        except OSError:
+            pass
+        await store.flush()
+
+    asyncio.run(scenario())
+    assert backend.load("menu", 1) is None
+    assert backend.batches[-1] == ([], [("menu", 1)])
+
+
+def test_failed_user_flush_is_retried(monkeypatch):
+    monkeypatch.setattr(bot, "STATE_MULTI_REPLICA", True)
+    monkeypatch.setattr(bot.MemoryBackend, "shared", True)
+    backend = FlakyBackend(1)
+    store, menu = _store(backend)
+    menu[1] = 100
+
+    async def scenario():
+        await store.flush_user(1)
+        assert backend.load("menu", 1) is None
+        await store.flush_user(1)
+        menu[1] = 200
+        await store.flush()
+
+    asyncio.run(scenario())
+    assert backend.load("menu", 1) == 200
+    assert [batch[0] for batch in backend.batches] == [
+        [("menu", 1, "100")], [("menu", 1, "100")], [("menu", 1, "200")]
+    ]
@@ -0,0 +1,48 @@
+import asyncio
+
+import tg_bot_minecraft_server as bot
+
+
+class FakeUpdate:
+    def __init__(self, user_id):
+        self.effective_user = type("User", (), {"id": user_id})()
+
+
+def test_updates_of_one_user_run_in_order_without_blocking_others():
+    processor = bot.PerUserUpdateProcessor(4, 64)
+    finished = []
+
+    async def work(tag, delay):
+        await asyncio.sleep(delay)
+        finished.append(tag)
+
+    async def scenario():
+        flood = [asyncio.create_task(processor.process_update(FakeUpdate(1), work(f"a{i}", 0.05))) for i in range(10)]
+        await asyncio.sleep(0.01)
+        await processor.process_update(FakeUpdate(2), work("b", 0))
+        assert finished == ["b"]
+        await asyncio.gather(*flood)
+
+    asyncio.run(scenario())
+    assert finished == ["b"] + [f"a{i}" for i in range(10)]
+    assert processor._user_locks == {}
+
+
+def test_concurrency_is_capped_across_users():
+    processor = bot.PerUserUpdateProcessor(3, 64)
+    running = []
+    peak = []
+
+    async def work():
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+
+    async def scenario():
+        await asyncio.gather(*(processor.process_update(FakeUpdate(i), work()) for i in range(10)))
+        await processor.process_update(object(), work())
+
+    asyncio.run(scenario())
+    assert max(peak) == 3
+    assert len(peak) == 11
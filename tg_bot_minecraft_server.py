@@ -1,22 +1,681 @@
 import os
+import json
+import time
+import hmac
+import math
+import random
+import heapq
+import zlib
 import zipfile
+import hashlib
 import logging
 import aiohttp
+import shutil
+import socket
+import signal
+import secrets
+import sqlite3
 import asyncio
 import tempfile
+import threading
 import traceback
+import email.utils
+from datetime import datetime, timezone
+from types import MappingProxyType
+from itertools import chain
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+from aiohttp import web
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.error import BadRequest, RetryAfter
 from telegram.request import HTTPXRequest
 
 logging.disable(logging.CRITICAL)
 
-TOKEN = "BOT_TOKEN
+TOKEN = os.environ.get("BOT_TOKEN", "")
+ADMIN_IDS = set()
+
+JAR_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "jar_cache")
+JAR_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+JAR_CACHE_MIN_AGE = 15 * 60
+META_CACHE_TTL = 600
+ARCHIVE_LIMIT_BYTES = int(49.5 * 1024 * 1024)
+COMPRESSION_SAMPLE_SIZE = 256 * 1024
+COMPRESSION_MIN_GAIN = 0.05
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+FILE_ID_CACHE_MAX = 10000
+PROGRESS_MIN_INTERVAL = 2.0
+TG_GLOBAL_RATE = 30
+TG_PRIVATE_CHAT_RATE = 1.0
+TG_GROUP_CHAT_RATE = 20 / 60
+TG_MAX_RETRIES = 3
+PRIORITY_MENU = 0
+PRIORITY_PROGRESS = 1
+PRIORITY_CLEANUP = 2
+BUILD_WORKERS = 2
+BUILD_QUEUE_LIMIT = 20
+MAX_CONCURRENT_UPDATES = 64
+MAX_PENDING_UPDATES = 4096
+HTTP_POOL_LIMIT = 32
+HTTP_POOL_PER_HOST = 8
+STATE_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot_state.sqlite3")
+STATE_FLUSH_INTERVAL = 2.0
+STATE_HOT_LIMIT = 50000
+STATE_BACKEND = "sqlite"
+STATE_MULTI_REPLICA = False
+REDIS_URL = "redis://127.0.0.1:6379/0"
+REDIS_PREFIX = "mcbot:"
+REDIS_TIMEOUT = 5
+BUILD_LOCK_TTL = 60
+JAR_PARTIAL_MAX_AGE = 24 * 60 * 60
+JAR_LOCK_TTL = 60
+JAR_LOCK_POLL = 2
+SEGMENTED_DOWNLOADS = True
+SEGMENT_MIN_SIZE = 4 * 1024 * 1024
+SEGMENT_START_COUNT = 4
+SEGMENT_MAX_COUNT = 8
+MIRRORS = {
+    "https://meta.fabricmc.net": ("https://meta.fabricmc.net", "https://bmclapi2.bangbang93.com/fabric-meta"),
+    "https://files.minecraftforge.net": ("https://files.minecraftforge.net",),
+    "https://maven.minecraftforge.net": ("https://maven.minecraftforge.net", "https://bmclapi2.bangbang93.com/maven"),
+}
+CHECKSUM_ORIGINS = {"https://maven.minecraftforge.net": "sha1"}
+MIRROR_HEDGE_DELAY = 1.5
+MIRROR_EWMA_ALPHA = 0.3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+META_MAX_RETRIES = 3
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 60
+SIZE_PROBE_TIMEOUT = 10
+SIZE_MIN_RATIO = 0.6
+SIZE_RATIO_ALPHA = 0.5
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+CALLBACK_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+MENU_CACHE_MAX = 4096
+WARM_TOP_N = 8
+WARM_INTERVAL = 15 * 60
+WARM_STARTUP_DELAY = 10
+WARM_IDLE_POLL = 5
+WARM_CONCURRENCY = 1
+WARM_BANDWIDTH = 4 * 1024 * 1024
+WARM_BUSY_BANDWIDTH = 512 * 1024
+WARM_DECAY = 0.9
+WEBHOOK_URL = ""
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = ""
+WEBHOOK_MAX_CONNECTIONS = 40
+
+class MemoryBackend:
+    shared = False
+
+    def __init__(self):
+        self.values = {}
+        self.shared_values = {}
+        self.locks = {}
+        self._lock = threading.Lock()
+
+    def load(self, namespace, user_id):
+        value = self.values.get((namespace, user_id))
+        return json.loads(value) if value is not None else None
+
+    def load_all(self, namespaces, user_id):
+        return [self.load(namespace, user_id) for namespace in namespaces]
+
+    def write_batch(self, upserts, deletes):
+        with self._lock:
+            for namespace, user_id, value in upserts:
+                self.values[(namespace, user_id)] = value
+            for namespace, user_id in deletes:
+                self.values.pop((namespace, user_id), None)
+
+    def acquire_lock(self, name, owner, ttl):
+        with self._lock:
+            held = self.locks.get(name)
+            if held and held[1] > time.time():
+                return False
+            self.locks[name] = (owner, time.time() + ttl)
+            return True
+
+    def refresh_lock(self, name, owner, ttl):
+        with self._lock:
+            held = self.locks.get(name)
+            if not held or held[0] != owner:
+                return False
+            self.locks[name] = (owner, time.time() + ttl)
+            return True
+
+    def release_lock(self, name, owner):
+        with self._lock:
+            held = self.locks.get(name)
+            if held and held[0] == owner:
+                del self.locks[name]
+
+    def get_shared(self, namespace, key):
+        value = self.shared_values.get((namespace, key))
+        return json.loads(value) if value is not None else None
+
+    def set_shared(self, namespace, key, value):
+        self.shared_values[(namespace, key)] = json.dumps(value)
+
+    def close(self):
+        pass
 
-user_settings = {}
-user_states = {}
-user_creating_server = {}
-user_menu_message = {}
+class SQLiteBackend:
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self._reader = None
+        self._writer = None
+        self._read_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "namespace TEXT NOT NULL, user_id INTEGER NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, user_id)) WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS shared ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+        )
+        return conn
+
+    def _read(self, sql, params):
+        with self._read_lock:
+            if self._reader is None:
+                self._reader = self._connect()
+            return self._reader.execute(sql, params).fetchone()
+
+    def _write(self, fn):
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._writer)
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+            return result
+
+    def load(self, namespace, user_id):
+        row = self._read("SELECT value FROM state WHERE namespace = ? AND user_id = ?", (namespace, user_id))
+        return json.loads(row[0]) if row else None
+
+    def load_all(self, namespaces, user_id):
+        return [self.load(namespace, user_id) for namespace in namespaces]
+
+    def write_batch(self, upserts, deletes):
+        def apply(conn):
+            conn.executemany(
+                "INSERT INTO state (namespace, user_id, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (namespace, user_id) DO UPDATE SET value = excluded.value",
+                upserts
+            )
+            conn.executemany("DELETE FROM state WHERE namespace = ? AND user_id = ?", deletes)
+        self._write(apply)
+
+    def acquire_lock(self, name, owner, ttl):
+        def apply(conn):
+            now = time.time()
+            cur = conn.execute(
+                "INSERT INTO locks (name, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE locks.expires <= ?",
+                (name, owner, now + ttl, now)
+            )
+            return cur.rowcount == 1
+        return self._write(apply)
+
+    def refresh_lock(self, name, owner, ttl):
+        return self._write(lambda conn: conn.execute(
+            "UPDATE locks SET expires = ? WHERE name = ? AND owner = ?", (time.time() + ttl, name, owner)
+        ).rowcount == 1)
+
+    def release_lock(self, name, owner):
+        self._write(lambda conn: conn.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner)))
+
+    def get_shared(self, namespace, key):
+        row = self._read("SELECT value FROM shared WHERE namespace = ? AND key = ?", (namespace, key))
+        return json.loads(row[0]) if row else None
+
+    def set_shared(self, namespace, key, value):
+        self._write(lambda conn: conn.execute(
+            "INSERT INTO shared (namespace, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value",
+            (namespace, key, json.dumps(value))
+        ))
+
+    def close(self):
+        for conn in (self._reader, self._writer):
+            if conn is not None:
+                conn.close()
+        self._reader = self._writer = None
+
+class RedisClient:
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.strip("/") or 0)
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=REDIS_TIMEOUT)
+        self._file = self._sock.makefile("rb")
+        handshake = []
+        if self.password:
+            handshake.append(("AUTH", self.password))
+        if self.db:
+            handshake.append(("SELECT", self.db))
+        for reply in self._call(handshake) if handshake else []:
+            if isinstance(reply, Exception):
+                self._close()
+                raise reply
+
+    def _close(self):
+        for closable in (self._file, self._sock):
+            if closable is not None:
+                try:
+                    closable.close()
+                except OSError:
+                    pass
+        self._sock = self._file = None
+
+    def _encode(self, args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    def _reply(self):
+        line = self._file.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Redis: соединение закрыто")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode("utf-8")
+        if kind == b"-":
+            return Exception(f"Redis: {body.decode('utf-8', 'replace')}")
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            size = int(body)
+            if size < 0:
+                return None
+            data = self._file.read(size + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            count = int(body)
+            return None if count < 0 else [self._reply() for _ in range(count)]
+        raise ConnectionError(f"Redis: неожиданный ответ {line!r}")
+
+    def _call(self, commands):
+        self._sock.sendall(b"".join(self._encode(args) for args in commands))
+        return [self._reply() for _ in commands]
+
+    def pipeline(self, commands):
+        with self._lock:
+            if self._sock is None:
+                self._connect()
+            try:
+                replies = self._call(commands)
+            except (OSError, ConnectionError):
+                self._close()
+                raise
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+    def execute(self, *args):
+        return self.pipeline([args])[0]
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+REDIS_REFRESH_SCRIPT = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+)
+REDIS_RELEASE_SCRIPT = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('del', KEYS[1]) else return 0 end"
+)
+
+class RedisBackend:
+    shared = True
+
+    def __init__(self, url, prefix):
+        self.client = RedisClient(url)
+        self.prefix = prefix
+
+    def load(self, namespace, user_id):
+        value = self.client.execute("HGET", f"{self.prefix}state:{namespace}", user_id)
+        return json.loads(value) if value is not None else None
+
+    def load_all(self, namespaces, user_id):
+        values = self.client.pipeline([("HGET", f"{self.prefix}state:{namespace}", user_id) for namespace in namespaces])
+        return [json.loads(value) if value is not None else None for value in values]
+
+    def write_batch(self, upserts, deletes):
+        commands = [("HSET", f"{self.prefix}state:{namespace}", user_id, value) for namespace, user_id, value in upserts]
+        commands += [("HDEL", f"{self.prefix}state:{namespace}", user_id) for namespace, user_id in deletes]
+        if commands:
+            self.client.pipeline(commands)
+
+    def acquire_lock(self, name, owner, ttl):
+        return self.client.execute("SET", f"{self.prefix}lock:{name}", owner, "NX", "PX", int(ttl * 1000)) == "OK"
+
+    def refresh_lock(self, name, owner, ttl):
+        return self.client.execute("EVAL", REDIS_REFRESH_SCRIPT, 1, f"{self.prefix}lock:{name}", owner, int(ttl * 1000)) == 1
+
+    def release_lock(self, name, owner):
+        self.client.execute("EVAL", REDIS_RELEASE_SCRIPT, 1, f"{self.prefix}lock:{name}", owner)
+
+    def get_shared(self, namespace, key):
+        value = self.client.execute("HGET", f"{self.prefix}shared:{namespace}", key)
+        return json.loads(value) if value is not None else None
+
+    def set_shared(self, namespace, key, value):
+        self.client.execute("HSET", f"{self.prefix}shared:{namespace}", key, json.dumps(value))
+
+    def close(self):
+        self.client.close()
+
+def make_state_backend():
+    if STATE_BACKEND == "redis":
+        return RedisBackend(REDIS_URL, REDIS_PREFIX)
+    if STATE_BACKEND == "memory":
+        return MemoryBackend()
+    return SQLiteBackend(STATE_DB_PATH)
+
+async def backend_call(fn, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, fn, *args)
+
+class StateStore:
+    def __init__(self, backend):
+        self.backend = backend
+        self.maps = []
+        self._flush_task = None
+
+    def load(self, namespace, user_id):
+        return self.backend.load(namespace, user_id)
+
+    def _collect(self, only=None):
+        upserts, deletes = [], []
+        for stored in self.maps:
+            stored.collect(upserts, deletes, only)
+        return upserts, deletes
+
+    async def _write(self, upserts, deletes):
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self.backend.write_batch, upserts, deletes)
+        except BaseException:
+            for stored in self.maps:
+                stored.settle(upserts, deletes, False)
+            raise
+        for stored in self.maps:
+            stored.settle(upserts, deletes, True)
+
+    def replicated(self):
+        return STATE_MULTI_REPLICA and self.backend.shared
+
+    async def sync_user(self, user_id):
+        if not self.replicated():
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            raws = await loop.run_in_executor(None, self.backend.load_all, [stored.namespace for stored in self.maps], user_id)
+        except Exception as e:
+            print(f"[ERROR] Загрузка состояния {user_id}: {e}")
+            return
+        for stored, raw in zip(self.maps, raws):
+            stored.refresh(user_id, raw)
+
+    async def flush_user(self, user_id):
+        if not self.replicated():
+            return
+        upserts, deletes = self._collect(user_id)
+        if upserts or deletes:
+            try:
+                await self._write(upserts, deletes)
+            except Exception as e:
+                print(f"[ERROR] Сохранение состояния {user_id}: {e}")
+
+    async def flush(self):
+        upserts, deletes = self._collect()
+        if upserts or deletes:
+            await self._write(upserts, deletes)
+        for stored in self.maps:
+            stored.trim()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[ERROR] Сохранение состояния: {e}")
+
+    def start(self):
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        self.backend.close()
+
+class StoredDict:
+    _ABSENT = object()
+
+    def __init__(self, store, namespace, encode=None, decode=None):
+        self.store = store
+        self.namespace = namespace
+        self.encode = encode or (lambda v: v)
+        self.decode = decode or (lambda v: v)
+        self._hot = OrderedDict()
+        self._touched = set()
+        self._writing = set()
+        self._saved = {}
+        store.maps.append(self)
+
+    def _get(self, user_id):
+        value = self._hot.get(user_id, self._ABSENT)
+        if value is self._ABSENT and user_id not in self._hot:
+            raw = self.store.load(self.namespace, user_id)
+            value = self._ABSENT if raw is None else self.decode(raw)
+            self._hot[user_id] = value
+            if value is not self._ABSENT:
+                self._saved[user_id] = hash(json.dumps(raw, sort_keys=True, ensure_ascii=False))
+        self._hot.move_to_end(user_id)
+        return value
+
+    def __contains__(self, user_id):
+        return self._get(user_id) is not self._ABSENT
+
+    def __getitem__(self, user_id):
+        value = self._get(user_id)
+        if value is self._ABSENT:
+            raise KeyError(user_id)
+        self._touched.add(user_id)
+        return value
+
+    def get(self, user_id, default=None):
+        value = self._get(user_id)
+        if value is self._ABSENT:
+            return default
+        self._touched.add(user_id)
+        return value
+
+    def __setitem__(self, user_id, value):
+        self._hot[user_id] = value
+        self._hot.move_to_end(user_id)
+        self._touched.add(user_id)
+
+    def __delitem__(self, user_id):
+        if self._get(user_id) is self._ABSENT:
+            raise KeyError(user_id)
+        self._hot[user_id] = self._ABSENT
+        self._touched.add(user_id)
+
+    def pop(self, user_id, default=None):
+        value = self._get(user_id)
+        if value is self._ABSENT:
+            return default
+        self._hot[user_id] = self._ABSENT
+        self._touched.add(user_id)
+        return value
+
+    def _dirty(self, user_id):
+        if user_id not in self._touched:
+            return False
+        value = self._hot.get(user_id, self._ABSENT)
+        if value is self._ABSENT:
+            return user_id in self._saved
+        return hash(json.dumps(self.encode(value), sort_keys=True, ensure_ascii=False)) != self._saved.get(user_id)
+
+    def refresh(self, user_id, raw):
+        if self._dirty(user_id):
+            return
+        self._touched.discard(user_id)
+        if raw is None:
+            self._hot[user_id] = self._ABSENT
+            self._saved.pop(user_id, None)
+        else:
+            self._hot[user_id] = self.decode(raw)
+            self._saved[user_id] = hash(json.dumps(raw, sort_keys=True, ensure_ascii=False))
+        self._hot.move_to_end(user_id)
+
+    def collect(self, upserts, deletes, only=None):
+        if only is None:
+            touched = self._touched - self._writing
+        elif only in self._touched and only not in self._writing:
+            touched = (only,)
+        else:
+            return
+        for user_id in touched:
+            value = self._hot.get(user_id, self._ABSENT)
+            if value is self._ABSENT:
+                if user_id in self._saved:
+                    deletes.append((self.namespace, user_id))
+                    self._writing.add(user_id)
+                else:
+                    self._touched.discard(user_id)
+                continue
+            encoded = json.dumps(self.encode(value), sort_keys=True, ensure_ascii=False)
+            if self._saved.get(user_id) != hash(encoded):
+                upserts.append((self.namespace, user_id, encoded))
+                self._writing.add(user_id)
+            else:
+                self._touched.discard(user_id)
+
+    def settle(self, upserts, deletes, ok):
+        for namespace, user_id, encoded in upserts:
+            if namespace != self.namespace:
+                continue
+            self._writing.discard(user_id)
+            if not ok:
+                continue
+            fingerprint = hash(encoded)
+            self._saved[user_id] = fingerprint
+            value = self._hot.get(user_id, self._ABSENT)
+            if value is not self._ABSENT and hash(json.dumps(self.encode(value), sort_keys=True, ensure_ascii=False)) == fingerprint:
+                self._touched.discard(user_id)
+        for namespace, user_id in deletes:
+            if namespace != self.namespace:
+                continue
+            self._writing.discard(user_id)
+            if not ok:
+                continue
+            self._saved.pop(user_id, None)
+            if self._hot.get(user_id, self._ABSENT) is self._ABSENT:
+                self._touched.discard(user_id)
+
+    def trim(self):
+        while len(self._hot) > STATE_HOT_LIMIT:
+            user_id = next(iter(self._hot))
+            if user_id in self._touched:
+                break
+            del self._hot[user_id]
+            self._saved.pop(user_id, None)
+
+state_backend = make_state_backend()
+state_store = StateStore(state_backend)
+user_settings = StoredDict(
+    state_store, "settings", encode=lambda settings: settings.to_state(), decode=lambda state: settings_from_state(state)
+)
+user_states = StoredDict(state_store, "states", decode=lambda v: tuple(v) if isinstance(v, list) else v)
+build_locks = {}
+user_menu_message = StoredDict(state_store, "menu")
+
+http_session = None
+
+build_queue = OrderedDict()
+build_workers = []
+build_wakeup = None
+build_stats = {"active": 0, "completed": 0, "rejected": 0, "avg_seconds": 60.0}
+BUILD_DROPPED_TEXT = "⚠️ Бот перезапускается, сборка отменена.\n\nЗапустите её заново через /start."
+
+outbound_stats = {"sent": 0, "retry_after": 0, "queue_depth": 0, "max_queue_depth": 0, "total_wait": 0.0, "max_wait": 0.0}
+progress_stats = {"requested": 0, "sent": 0, "skipped": 0, "retry_after": 0}
+file_id_cache = OrderedDict()
+file_id_stats = {"hits": 0, "uploads": 0, "bytes_saved": 0}
+base_archive_stats = {"hits": 0, "built": 0, "assemble_seconds": 0.0}
+compression_stats = {"stored": 0, "fast": 0, "full": 0, "cpu_spent": 0.0, "cpu_saved": 0.0}
+jar_flights = {}
+jar_flight_stats = {"started": 0, "coalesced": 0}
+download_stats = {"bytes_transferred": 0, "resumed": 0, "bytes_reused": 0, "restarts": 0, "segmented": 0, "segment_errors": 0,
+                  "hedged": 0, "verified": 0, "checksum_failures": 0, "unverified": 0}
+segment_tuning = {}
+mirror_stats = {}
+host_breakers = {}
+resilience_stats = {"retries": 0, "retry_after": 0, "fail_fast": 0, "served_from_cache": 0}
+jar_popularity = {}
+size_predictions = {}
+prediction_stats = {"rejected": 0, "probed": 0, "missed": 0}
+warm_task = None
+warm_pacer = {"next": 0.0}
+webhook_stats = {"received": 0, "rejected": 0, "malformed": 0}
+warm_stats = {"cycles": 0, "prefetched": 0, "already_warm": 0, "failed": 0, "bytes": 0, "throttled_seconds": 0.0}
+jar_cache_index = OrderedDict()
+jar_cache_lock = threading.Lock()
+meta_cache = {}
+meta_cache_stats = {"fresh": 0, "stale": 0, "revalidated": 0, "fetched": 0, "shared": 0}
+jar_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes_saved": 0, "bytes_downloaded": 0, "seconds_saved": 0.0, "shared": 0}
+callback_routes = {}
+callback_prefix_trie = {}
+callback_latency = {}
+callback_stats = {"unrouted": 0}
+menu_cache = OrderedDict()
+menu_cache_stats = {"hits": 0, "misses": 0}
 
 PRESETS = {
     "preset_vanilla_survival": {
@@ -159,103 +818,1202 @@ def get_java_for_version(mc_version):
     else:
         return 8, "Java 8"
 
-async def download_with_retry(session, url, progress_callback=None, max_retries=3):
-    for attempt in range(max_retries):
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        timeout = aiohttp.ClientTimeout(total=None, connect=60, sock_read=900)
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_POOL_PER_HOST,
+            ttl_dns_cache=300, keepalive_timeout=60
+        )
+        http_session = aiohttp.ClientSession(timeout=timeout, connector=connector)
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+class UpstreamError(aiohttp.ClientError):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class UpstreamUnavailable(Exception):
+    pass
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        resilience_stats["retry_after"] += 1
+        return retry_after if retry_after <= RETRY_MAX_DELAY else None
+    cap = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return cap / 2 + random.uniform(0, cap / 2)
+
+def upstream_error(response):
+    if response.status >= 500 or response.status == 429:
+        return UpstreamError(f"HTTP {response.status}", parse_retry_after(response.headers.get("Retry-After")))
+    return Exception(f"HTTP {response.status}")
+
+def breaker_allows(host):
+    breaker = host_breakers.get(host)
+    if breaker is None or breaker["state"] == "closed":
+        return True
+    if breaker["state"] == "open" and time.monotonic() >= breaker["until"]:
+        breaker["state"] = "half_open"
+        breaker["probing"] = False
+    if breaker["state"] == "half_open" and not breaker["probing"]:
+        breaker["probing"] = True
+        return True
+    breaker["rejected"] += 1
+    return False
+
+def breaker_record(host, ok, retry_after=None):
+    breaker = host_breakers.setdefault(
+        host, {"state": "closed", "failures": 0, "until": 0.0, "probing": False, "opened": 0, "rejected": 0}
+    )
+    breaker["probing"] = False
+    if ok is None:
+        return
+    if ok:
+        breaker["state"] = "closed"
+        breaker["failures"] = 0
+        return
+    breaker["failures"] += 1
+    if breaker["state"] == "half_open" or breaker["failures"] >= BREAKER_FAILURES:
+        if breaker["state"] != "open":
+            breaker["opened"] += 1
+            print(f"[WARN] {host} недоступен, запросы приостановлены на {BREAKER_COOLDOWN} с")
+        breaker["state"] = "open"
+        breaker["until"] = time.monotonic() + max(BREAKER_COOLDOWN, retry_after or 0)
+
+def _mirror_base(url):
+    for bases in MIRRORS.values():
+        for base in bases:
+            if url.startswith(base + "/"):
+                return base
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+def mirror_urls(url):
+    for origin, bases in MIRRORS.items():
+        if url.startswith(origin + "/"):
+            ranked = sorted(
+                enumerate(bases),
+                key=lambda item: mirror_stats[item[1]]["ewma"] if item[1] in mirror_stats else MIRROR_HEDGE_DELAY * item[0]
+            )
+            return [base + url[len(origin):] for _, base in ranked]
+    return [url]
+
+def record_mirror(url, seconds, outcome):
+    base = _mirror_base(url)
+    entry = mirror_stats.get(base)
+    if outcome == "error":
+        seconds = max(seconds, MIRROR_HEDGE_DELAY * 4)
+    if entry is None:
+        entry = mirror_stats[base] = {"ewma": seconds, "wins": 0, "lost": 0, "errors": 0}
+    elif outcome != "lost" or seconds > entry["ewma"]:
+        entry["ewma"] += MIRROR_EWMA_ALPHA * (seconds - entry["ewma"])
+    entry[{"win": "wins", "lost": "lost", "error": "errors"}[outcome]] += 1
+
+async def hedged_get(session, urls, method="GET", **kwargs):
+    async def request(url):
+        return await session.request(method, url, **kwargs)
+
+    waiting = list(urls)
+    pending = {}
+    blocked = []
+    winner = None
+    failure = None
+    try:
+        while winner is None and (waiting or pending):
+            while waiting:
+                url = waiting.pop(0)
+                host = urlparse(url).netloc
+                if not breaker_allows(host):
+                    blocked.append(host)
+                    continue
+                if pending:
+                    download_stats["hedged"] += 1
+                pending[asyncio.create_task(request(url))] = (url, time.monotonic())
+                break
+            if not pending:
+                break
+            done, _ = await asyncio.wait(
+                pending, timeout=MIRROR_HEDGE_DELAY if waiting else None, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                url, started = pending.pop(task)
+                host = urlparse(url).netloc
+                try:
+                    response = task.result()
+                except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                    record_mirror(url, time.monotonic() - started, "error")
+                    breaker_record(host, False)
+                    failure = e
+                    continue
+                unhealthy = response.status >= 500 or response.status == 429
+                breaker_record(host, not unhealthy, parse_retry_after(response.headers.get("Retry-After")) if unhealthy else None)
+                if winner is None and (response.status < 500 and response.status not in (404, 429) or not (waiting or pending)):
+                    record_mirror(url, time.monotonic() - started, "win")
+                    winner = (response, url)
+                else:
+                    record_mirror(url, time.monotonic() - started, "lost" if winner or response.status == 404 else "error")
+                    response.release()
+    finally:
+        for task, (url, started) in pending.items():
+            task.cancel()
+            record_mirror(url, time.monotonic() - started, "lost")
+            breaker_record(urlparse(url).netloc, None)
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, aiohttp.ClientResponse):
+                result.release()
+    if winner is None and failure is None and blocked:
+        resilience_stats["fail_fast"] += 1
+        wait = min(host_breakers[host]["until"] for host in blocked) - time.monotonic()
+        raise UpstreamUnavailable(
+            f"⛔ {', '.join(dict.fromkeys(blocked))} временно недоступен\n\n"
+            f"🔁 Повторите через {max(1, math.ceil(wait))} с"
+        )
+    if winner is None:
+        raise failure or aiohttp.ClientError("Нет доступных зеркал")
+    return winner
+
+def checksum_algorithm(url):
+    return next((alg for origin, alg in CHECKSUM_ORIGINS.items() if url.startswith(origin + "/")), None)
+
+async def fetch_checksum(session, url):
+    algorithm = checksum_algorithm(url)
+    if algorithm is None:
+        return None
+    try:
+        response, _ = await hedged_get(session, [f"{url}.{algorithm}"], timeout=aiohttp.ClientTimeout(total=30))
+        async with response:
+            if response.status != 200:
+                return None
+            digest = ((await response.text()).split() or [""])[0].lower()
+    except (asyncio.TimeoutError, aiohttp.ClientError, UnicodeDecodeError, UpstreamUnavailable):
+        return None
+    if len(digest) != hashlib.new(algorithm).digest_size * 2 or any(c not in "0123456789abcdef" for c in digest):
+        return None
+    return algorithm, digest
+
+def _load_partial_state(dest_path, url):
+    try:
+        with open(dest_path + ".json", 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("url") != url or not (state.get("etag") or state.get("last_modified") or state.get("total")):
+        return None
+    if not os.path.exists(dest_path):
+        return None
+    return state
+
+def _save_partial_state(dest_path, state):
+    with open(dest_path + ".json", 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+
+def _drop_partial(dest_path):
+    for path in (dest_path, dest_path + ".json"):
         try:
-            async with session.get(url, allow_redirects=True) as response:
-                if response.status != 200:
-                    raise Exception(f"HTTP {response.status}")
-                total_size = int(response.headers.get('Content-Length', 0))
-                if total_size > 0 and progress_callback:
-                    await progress_callback(f"⏳ Загрузка {total_size // (1024*1024)}MB...")
-                downloaded = 0
-                chunks = []
-                chunk_size = 1024 * 1024
-                last_progress = 0
-                async for chunk in response.content.iter_chunked(chunk_size):
-                    chunks.append(chunk)
-                    downloaded += len(chunk)
-                    if total_size > 0 and progress_callback:
-                        progress = int((downloaded / total_size) * 100)
-                        if progress >= last_progress + 10:
-                            await progress_callback(f"⏳ {progress}% ({downloaded // (1024*1024)}/{total_size // (1024*1024)}MB)")
-                            last_progress = progress
-                return b''.join(chunks)
-        except (asyncio.TimeoutError, aiohttp.ClientError):
-            if attempt < max_retries - 1:
-                if progress_callback:
-                    await progress_callback(f"⚠️ Повтор {attempt+2}/{max_retries}...")
-                await asyncio.sleep(3)
-                continue
-            else:
-                raise Exception(f"Не удалось загрузить после {max_retries} попыток")
-    raise Exception("Не удалось загрузить файл")
+            os.unlink(path)
+        except OSError:
+            pass
 
-async def get_server_jar(loader, version, progress_callback=None):
+def _content_range_total(header):
     try:
-        if not loader:
-            loader = "fabric"
-        if not version:
-            version = "1.20.1"
-        loader = loader.lower()
-        timeout = aiohttp.ClientTimeout(total=None, connect=60, sock_read=900)
-        connector = aiohttp.TCPConnector(limit=1, limit_per_host=1, ttl_dns_cache=300, force_close=False)
-        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
-            if loader == "fabric":
-                if not is_fabric_supported(version):
-                    raise Exception(
-                        f"❌ Fabric не поддерживает версию {version}\n\n"
-                        f"💡 Fabric работает только начиная с версии 1.14\n\n"
-                        f"Используйте Forge для версий ниже 1.14"
-                    )
-                if progress_callback:
-                    await progress_callback("⏳ Поиск Fabric...")
-                async with session.get("https://meta.fabricmc.net/v2/versions/loader") as lr:
-                    if lr.status == 200:
-                        loaders = await lr.json()
-                        if loaders:
-                            loader_version = loaders[0]['version']
-                            async with session.get("https://meta.fabricmc.net/v2/versions/installer") as ir:
-                                if ir.status == 200:
-                                    installers = await ir.json()
-                                    if installers:
-                                        installer_version = installers[0]['version']
-                                        url = f"https://meta.fabricmc.net/v2/versions/loader/{version}/{loader_version}/{installer_version}/server/jar"
-                                        jar_data = await download_with_retry(session, url, progress_callback)
-                                        return jar_data, f"fabric-server-{version}.jar"
-                raise Exception(f"Fabric не поддерживает {version}")
-            elif loader == "forge":
-                if progress_callback:
-                    await progress_callback("⏳ Поиск Forge...")
-                async with session.get("https://files.minecraftforge.net/net/minecraftforge/forge/promotions_slim.json") as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        promos = data.get('promos', {})
-                        forge_version = promos.get(f"{version}-latest") or promos.get(f"{version}-recommended")
-                        if forge_version:
-                            major = int(version.split('.')[1]) if len(version.split('.')) > 1 else 0
-                            full_version = f"{version}-{forge_version}"
-                            if 7 <= major <= 12:
-                                url = f"https://maven.minecraftforge.net/net/minecraftforge/forge/{full_version}/forge-{full_version}-universal.jar"
-                                try:
-                                    jar_data = await download_with_retry(session, url, progress_callback)
-                                    return jar_data, f"forge-{version}-universal.jar"
-                                except:
-                                    if version == "1.7.10":
-                                        fvd = f"{version}-{forge_version}-{version}"
-                                        url = f"https://maven.minecraftforge.net/net/minecraftforge/forge/{fvd}/forge-{fvd}-universal.jar"
-                                        jar_data = await download_with_retry(session, url, progress_callback)
-                                        return jar_data, f"forge-{version}-universal.jar"
-                            else:
-                                url = f"https://maven.minecraftforge.net/net/minecraftforge/forge/{full_version}/forge-{full_version}-installer.jar"
-                                if progress_callback:
-                                    await progress_callback("⚠️ Forge 1.13+ требует запуска installer")
-                                jar_data = await download_with_retry(session, url, progress_callback)
-                                return jar_data, f"forge-{version}-installer.jar"
-                        raise Exception(f"Forge не поддерживает {version}")
+        span, total = header.split(" ", 1)[1].split("/", 1)
+        return int(span.split("-", 1)[0]), int(total)
+    except (IndexError, ValueError):
+        return None, None
+
+def _read_range_sync(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+async def _replay_partial(dest_path, start, end, on_chunk, total_size):
+    loop = asyncio.get_event_loop()
+    while start < end:
+        stop = min(end, start + 1024 * 1024)
+        await on_chunk(await loop.run_in_executor(None, _read_range_sync, dest_path, start, stop), total_size)
+        start = stop
+
+def _segment_count(host, total_size):
+    tuned = segment_tuning.get(host)
+    count = tuned["segments"] if tuned else SEGMENT_START_COUNT
+    return max(1, min(count, total_size // SEGMENT_MIN_SIZE))
+
+def _tune_segments(host, count, rate, errors):
+    tuned = segment_tuning.setdefault(host, {"segments": count, "rate": 0.0})
+    if errors:
+        tuned["segments"] = max(2, count - 1)
+    elif rate > tuned["rate"] * 1.1:
+        tuned["segments"] = min(SEGMENT_MAX_COUNT, count + 1)
+    elif rate < tuned["rate"] * 0.9:
+        tuned["segments"] = max(2, count - 1)
+    tuned["rate"] = rate
+
+class SegmentedDownload:
+    def __init__(self, session, url, dest_path, total_size, validator, on_chunk, delivered, progress_callback, max_retries,
+                 throttle=None):
+        self.session = session
+        self.url = url
+        self.dest_path = dest_path
+        self.total_size = total_size
+        self.validator = validator
+        self.on_chunk = on_chunk
+        self.delivered = delivered
+        self.progress_callback = progress_callback
+        self.max_retries = max_retries
+        self.throttle = throttle
+        self.segments = []
+        self.errors = 0
+        self.last_progress = 0
+
+    def _plan(self, count):
+        size = -(-self.total_size // count)
+        for start in range(0, self.total_size, size):
+            self.segments.append({"start": start, "end": min(self.total_size, start + size), "written": 0, "event": asyncio.Event()})
+
+    def contiguous(self):
+        done = 0
+        for seg in self.segments:
+            done = seg["start"] + seg["written"]
+            if done < seg["end"]:
+                break
+        return done
+
+    async def _report(self):
+        if not self.progress_callback:
+            return
+        downloaded = sum(seg["written"] for seg in self.segments)
+        progress = int(downloaded / self.total_size * 100)
+        if progress >= self.last_progress + 10:
+            self.last_progress = progress
+            await self.progress_callback(
+                f"⏳ {progress}% ({downloaded // (1024*1024)}/{self.total_size // (1024*1024)}MB, потоков: {len(self.segments)})"
+            )
+
+    async def _pump(self, fd, seg, response):
+        loop = asyncio.get_event_loop()
+        async for chunk in response.content.iter_chunked(256 * 1024):
+            chunk = chunk[:seg["end"] - seg["start"] - seg["written"]]
+            await loop.run_in_executor(None, os.pwrite, fd, chunk, seg["start"] + seg["written"])
+            seg["written"] += len(chunk)
+            download_stats["bytes_transferred"] += len(chunk)
+            seg["event"].set()
+            await self._report()
+            if self.throttle:
+                await self.throttle(len(chunk))
+            if seg["start"] + seg["written"] >= seg["end"]:
+                return
+        raise aiohttp.ClientPayloadError(f"Сегмент {seg['start']}-{seg['end']} оборван")
+
+    async def _segment(self, fd, seg, first_response):
+        for attempt in range(self.max_retries):
+            try:
+                if first_response is not None and attempt == 0:
+                    await self._pump(fd, seg, first_response)
+                    return
+                headers = {"Range": f"bytes={seg['start'] + seg['written']}-{seg['end'] - 1}"}
+                if self.validator:
+                    headers["If-Range"] = self.validator
+                response, _ = await hedged_get(self.session, [self.url], allow_redirects=True, headers=headers)
+                async with response:
+                    if response.status >= 500 or response.status == 429:
+                        raise upstream_error(response)
+                    if response.status != 206:
+                        raise aiohttp.ClientPayloadError(f"HTTP {response.status} на сегменте")
+                    await self._pump(fd, seg, response)
+                    return
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                self.errors += 1
+                download_stats["segment_errors"] += 1
+                delay = backoff_delay(attempt, getattr(e, "retry_after", None))
+                if attempt == self.max_retries - 1 or delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    async def _deliver(self):
+        for seg in self.segments:
+            while self.delivered < seg["end"]:
+                available = seg["start"] + seg["written"]
+                if available > self.delivered:
+                    await _replay_partial(self.dest_path, self.delivered, available, self.on_chunk, self.total_size)
+                    self.delivered = available
+                else:
+                    seg["event"].clear()
+                    await seg["event"].wait()
+
+    async def run(self, first_response, count):
+        self._plan(count)
+        started = time.monotonic()
+        fd = os.open(self.dest_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.total_size)
+            tasks = [
+                asyncio.create_task(self._segment(fd, seg, first_response if i == 0 else None))
+                for i, seg in enumerate(self.segments)
+            ]
+            if self.on_chunk:
+                tasks.append(asyncio.create_task(self._deliver()))
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                os.ftruncate(fd, self.contiguous())
+                raise
+        finally:
+            os.close(fd)
+            host = first_response.url.host
+            _tune_segments(host, len(self.segments), self.total_size / max(0.001, time.monotonic() - started), self.errors)
+        download_stats["segmented"] += 1
+
+async def download_with_retry(session, url, dest_path, progress_callback=None, max_retries=3, on_chunk=None, throttle=None):
+    loop = asyncio.get_event_loop()
+    delivered = 0
+    state = _load_partial_state(dest_path, url)
+    checksum = asyncio.create_task(fetch_checksum(session, url))
+    rejected = set()
+    committed = False
+
+    async def sink(chunk, total_size):
+        nonlocal committed
+        if await on_chunk(chunk, total_size):
+            committed = True
+
+    async def verify(source):
+        nonlocal state, delivered
+        expected = await checksum
+        if expected is None:
+            if source == url:
+                return
+            download_stats["unverified"] += 1
+            reason = "Нет контрольной суммы для ядра с зеркала"
+        else:
+            algorithm, digest = expected
+            if await loop.run_in_executor(None, hash_file_sync, dest_path, algorithm) == digest:
+                download_stats["verified"] += 1
+                return
+            download_stats["checksum_failures"] += 1
+            record_mirror(source, 0, "error")
+            reason = "Контрольная сумма ядра не совпала"
+        rejected.add(source)
+        state = None
+        _drop_partial(dest_path)
+        if committed:
+            raise Exception(reason)
+        delivered = 0
+        raise aiohttp.ClientPayloadError(f"{reason}: {source}")
+
+    try:
+        for attempt in range(max_retries):
+            out = None
+            try:
+                offset = os.path.getsize(dest_path) if state else 0
+                headers = {}
+                mirrored = checksum_algorithm(url) and not (checksum.done() and checksum.result() is None)
+                urls = [u for u in (mirror_urls(url) if mirrored else [url]) if u not in rejected]
+                if offset and state.get("source"):
+                    urls = [state["source"]]
+                if not urls:
+                    raise Exception("Контрольная сумма ядра не совпала ни на одном зеркале")
+                if offset:
+                    headers["Range"] = f"bytes={offset}-"
+                    if state["etag"] or state["last_modified"]:
+                        headers["If-Range"] = state["etag"] or state["last_modified"]
+                response, source = await hedged_get(session, urls, allow_redirects=True, headers=headers)
+                async with response:
+                    if response.status == 416 and offset and offset == state.get("total"):
+                        if on_chunk and delivered < offset:
+                            await _replay_partial(dest_path, delivered, offset, sink, offset)
+                            delivered = offset
+                        await verify(source)
+                        os.unlink(dest_path + ".json")
+                        return dest_path
+                    if response.status in (206, 416) and offset:
+                        start, total_size = _content_range_total(response.headers.get('Content-Range', ''))
+                        if response.status == 416 or start != offset or total_size != state["total"]:
+                            download_stats["restarts"] += 1
+                            state = None
+                            _drop_partial(dest_path)
+                            if committed:
+                                raise Exception("Файл на сервере изменился во время загрузки")
+                            delivered = 0
+                            raise aiohttp.ClientPayloadError("Частичный файл не совпадает с сервером")
+                        download_stats["resumed"] += 1
+                        download_stats["bytes_reused"] += offset
+                        if progress_callback:
+                            await progress_callback(f"⏩ Докачка с {offset // (1024*1024)}MB...")
+                    elif response.status == 200:
+                        total_size = int(response.headers.get('Content-Length', 0))
+                        etag = response.headers.get('ETag')
+                        if offset:
+                            download_stats["restarts"] += 1
+                            if etag != state["etag"] or total_size != state["total"]:
+                                if committed:
+                                    state = None
+                                    _drop_partial(dest_path)
+                                    raise Exception("Файл на сервере изменился во время загрузки")
+                                delivered = 0
+                        offset = 0
+                        state = None
+                        if etag or response.headers.get('Last-Modified') or total_size:
+                            state = {
+                                "url": url, "etag": etag, "last_modified": response.headers.get('Last-Modified'),
+                                "total": total_size, "source": source
+                            }
+                            await loop.run_in_executor(None, _save_partial_state, dest_path, state)
+                    else:
+                        raise upstream_error(response)
+                    if (not offset and SEGMENTED_DOWNLOADS and hasattr(os, "pwrite")
+                            and response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+                            and total_size >= 2 * SEGMENT_MIN_SIZE):
+                        count = _segment_count(response.url.host, total_size)
+                        if count > 1:
+                            if progress_callback:
+                                await progress_callback(f"⏳ Загрузка {total_size // (1024*1024)}MB, потоков: {count}...")
+                            job = SegmentedDownload(
+                                session, source, dest_path, total_size, state and (state["etag"] or state["last_modified"]),
+                                sink if on_chunk else None, delivered, progress_callback, max_retries, throttle
+                            )
+                            try:
+                                await job.run(response, count)
+                            finally:
+                                delivered = job.delivered
+                            await verify(source)
+                            if state:
+                                os.unlink(dest_path + ".json")
+                            return dest_path
+                    if total_size > 0 and progress_callback and not offset:
+                        await progress_callback(f"⏳ Загрузка {total_size // (1024*1024)}MB...")
+                    if on_chunk and delivered < offset:
+                        await _replay_partial(dest_path, delivered, offset, sink, total_size)
+                        delivered = offset
+                    downloaded = offset
+                    chunk_size = 1024 * 1024
+                    last_progress = int((downloaded / total_size) * 100) // 10 * 10 if total_size > 0 else 0
+                    out = open(dest_path, 'ab' if offset else 'wb')
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        await loop.run_in_executor(None, out.write, chunk)
+                        download_stats["bytes_transferred"] += len(chunk)
+                        if throttle:
+                            await throttle(len(chunk))
+                        if on_chunk and downloaded + len(chunk) > delivered:
+                            await sink(chunk[max(0, delivered - downloaded):], total_size)
+                            delivered = downloaded + len(chunk)
+                        downloaded += len(chunk)
+                        if total_size > 0 and progress_callback:
+                            progress = int((downloaded / total_size) * 100)
+                            if progress >= last_progress + 10:
+                                await progress_callback(f"⏳ {progress}% ({downloaded // (1024*1024)}/{total_size // (1024*1024)}MB)")
+                                last_progress = progress
+                    if total_size > 0 and downloaded != total_size:
+                        raise aiohttp.ClientPayloadError(f"Получено {downloaded} из {total_size} байт")
+                    out.close()
+                    await verify(source)
+                    if state:
+                        os.unlink(dest_path + ".json")
+                    return dest_path
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                delay = backoff_delay(attempt, getattr(e, "retry_after", None))
+                if attempt < max_retries - 1 and delay is not None:
+                    resilience_stats["retries"] += 1
+                    if progress_callback:
+                        await progress_callback(f"⚠️ Повтор {attempt+2}/{max_retries} через {delay:.0f} с...")
+                    await asyncio.sleep(delay)
+                    continue
+                else:
+                    raise UpstreamUnavailable(f"Не удалось загрузить после {attempt+1} попыток")
+            finally:
+                if out and not out.closed:
+                    out.close()
+        raise Exception("Не удалось загрузить файл")
+    finally:
+        checksum.cancel()
+
+def _jar_cache_path(digest):
+    return os.path.join(JAR_CACHE_DIR, f"{digest}.jar")
+
+def _jar_cache_index_path():
+    return os.path.join(JAR_CACHE_DIR, "index.json")
+
+def load_jar_cache_index():
+    os.makedirs(JAR_CACHE_DIR, exist_ok=True)
+    jar_cache_index.clear()
+    try:
+        with open(_jar_cache_index_path(), 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        entries = []
+    for key, entry in entries:
+        if os.path.exists(_jar_cache_path(entry["digest"])):
+            jar_cache_index[key] = entry
+    _jar_partial_cleanup()
+
+def save_jar_cache_index():
+    tmp_path = _jar_cache_index_path() + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(list(jar_cache_index.items()), f)
+    os.replace(tmp_path, _jar_cache_index_path())
+
+def _base_archive_dir():
+    return os.path.join(JAR_CACHE_DIR, "bases")
+
+def base_archive_path(jar_path, jar_name):
+    digest = os.path.splitext(os.path.basename(jar_path))[0]
+    return os.path.join(_base_archive_dir(), f"{digest}_{jar_name}.zip")
+
+def _base_archive_files():
+    try:
+        return [e for e in os.scandir(_base_archive_dir()) if e.name.endswith(".zip")]
+    except OSError:
+        return []
+
+def _jar_cache_evict():
+    sizes = {}
+    for entry in jar_cache_index.values():
+        sizes[entry["digest"]] = entry["size"]
+    bases = {}
+    for base in _base_archive_files():
+        digest = base.name.split("_", 1)[0]
+        bases.setdefault(digest, []).append(base.path)
+        if digest in sizes:
+            sizes[digest] += base.stat().st_size
+    total = sum(sizes.values())
+    while total > JAR_CACHE_MAX_BYTES and len(jar_cache_index) > 1:
+        key, entry = next(iter(jar_cache_index.items()))
+        if time.time() - entry["last_used"] < JAR_CACHE_MIN_AGE:
+            break
+        del jar_cache_index[key]
+        jar_cache_stats["evictions"] += 1
+        if any(e["digest"] == entry["digest"] for e in jar_cache_index.values()):
+            continue
+        for path in [_jar_cache_path(entry["digest"])] + bases.get(entry["digest"], []):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        total -= sizes[entry["digest"]]
+
+def _adopt_shared_jar(key):
+    try:
+        entry = state_backend.get_shared("jars", key)
+    except Exception as e:
+        print(f"[ERROR] Общий индекс ядер: {e}")
+        return
+    if not entry or not os.path.exists(_jar_cache_path(entry["digest"])):
+        return
+    with jar_cache_lock:
+        if key not in jar_cache_index:
+            jar_cache_index[key] = entry
+            jar_cache_stats["shared"] += 1
+
+def jar_cache_get(key):
+    if key not in jar_cache_index:
+        _adopt_shared_jar(key)
+    with jar_cache_lock:
+        entry = jar_cache_index.get(key)
+        if not entry:
+            return None
+        path = _jar_cache_path(entry["digest"])
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = -1
+        if size != entry["size"]:
+            jar_cache_index.pop(key, None)
+            return None
+        jar_cache_index.move_to_end(key)
+        entry["last_used"] = time.time()
+        return path, entry
+
+def jar_cache_fallback(loader, version):
+    prefix = f"{loader}|{version}|"
+    with jar_cache_lock:
+        keys = [key for key in reversed(jar_cache_index) if key.startswith(prefix)]
+    for key in keys:
+        cached = jar_cache_get(key)
+        if cached is not None:
+            return cached
+    return None
+
+def _jar_partial_dir():
+    return os.path.join(JAR_CACHE_DIR, "partial")
+
+def jar_cache_partial_path(key):
+    os.makedirs(_jar_partial_dir(), exist_ok=True)
+    return os.path.join(_jar_partial_dir(), hashlib.sha1(key.encode("utf-8")).hexdigest() + ".part")
+
+def _jar_partial_cleanup():
+    try:
+        entries = list(os.scandir(_jar_partial_dir()))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if time.time() - entry.stat().st_mtime > JAR_PARTIAL_MAX_AGE:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+def jar_cache_put(key, src_path, jar_name, download_seconds):
+    sha256 = hashlib.sha256()
+    sha1 = hashlib.sha1()
+    size = 0
+    try:
+        with open(src_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+                sha1.update(block)
+                size += len(block)
+    except FileNotFoundError:
+        cached = jar_cache_get(key)
+        if cached is None:
+            raise
+        return cached[0]
+    digest = sha256.hexdigest()
+    path = _jar_cache_path(digest)
+    try:
+        if os.path.exists(path):
+            os.unlink(src_path)
+        else:
+            os.replace(src_path, path)
+    except FileNotFoundError:
+        if not os.path.exists(path):
+            raise
+    entry = {
+        "digest": digest, "sha1": sha1.hexdigest(), "size": size,
+        "jar_name": jar_name, "download_seconds": download_seconds, "last_used": time.time()
+    }
+    with jar_cache_lock:
+        jar_cache_index[key] = entry
+        jar_cache_index.move_to_end(key)
+        _jar_cache_evict()
+        save_jar_cache_index()
+    try:
+        state_backend.set_shared("jars", key, entry)
+    except Exception as e:
+        print(f"[ERROR] Общий индекс ядер: {e}")
+    return path
+
+async def _fetch_meta(session, url):
+    for attempt in range(META_MAX_RETRIES):
+        try:
+            return await _fetch_meta_once(session, url)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            delay = backoff_delay(attempt, getattr(e, "retry_after", None))
+            if attempt == META_MAX_RETRIES - 1 or delay is None:
+                raise UpstreamUnavailable(f"⛔ {urlparse(url).netloc} не отвечает: {e or type(e).__name__}")
+            resilience_stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+async def _fetch_meta_once(session, url):
+    entry = meta_cache.get(url)
+    headers = {}
+    if entry:
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    resp, _ = await hedged_get(session, mirror_urls(url), headers=headers, timeout=aiohttp.ClientTimeout(total=60))
+    async with resp:
+        if resp.status == 304 and entry:
+            entry["fetched_at"] = time.monotonic()
+            meta_cache_stats["revalidated"] += 1
+            await _store_shared_meta(url)
+            return entry["data"]
+        if resp.status != 200:
+            raise upstream_error(resp)
+        data = await resp.json(content_type=None)
+        meta_cache[url] = {
+            "data": data,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "fetched_at": time.monotonic(),
+            "refresh": None
+        }
+    meta_cache_stats["fetched"] += 1
+    await _store_shared_meta(url)
+    return data
+
+async def _store_shared_meta(url):
+    entry = meta_cache[url]
+    shared = {
+        "data": entry["data"], "etag": entry["etag"], "last_modified": entry["last_modified"],
+        "fetched_at": time.time() - (time.monotonic() - entry["fetched_at"])
+    }
+    try:
+        await backend_call(state_backend.set_shared, "meta", url, shared)
+    except Exception as e:
+        print(f"[ERROR] Общие метаданные {url}: {e}")
+
+async def _load_shared_meta(url, stale_ok=False):
+    try:
+        shared = await backend_call(state_backend.get_shared, "meta", url)
+    except Exception as e:
+        print(f"[ERROR] Общие метаданные {url}: {e}")
+        return None
+    if not shared or (not stale_ok and time.time() - shared["fetched_at"] >= META_CACHE_TTL):
+        return None
+    previous = meta_cache.get(url)
+    meta_cache[url] = {
+        "data": shared["data"], "etag": shared["etag"], "last_modified": shared["last_modified"],
+        "fetched_at": time.monotonic() - (time.time() - shared["fetched_at"]),
+        "refresh": previous["refresh"] if previous else None
+    }
+    meta_cache_stats["shared"] += 1
+    return shared["data"]
+
+async def _refresh_meta(url):
+    try:
+        if await _load_shared_meta(url) is None:
+            await _fetch_meta(get_http_session(), url)
+    except Exception as e:
+        print(f"[ERROR] Обновление {url}: {e}")
+    finally:
+        entry = meta_cache.get(url)
+        if entry:
+            entry["refresh"] = None
+
+async def get_meta_json(session, url):
+    entry = meta_cache.get(url)
+    if entry:
+        if time.monotonic() - entry["fetched_at"] < META_CACHE_TTL:
+            meta_cache_stats["fresh"] += 1
+        else:
+            meta_cache_stats["stale"] += 1
+            if entry["refresh"] is None:
+                entry["refresh"] = asyncio.create_task(_refresh_meta(url))
+        return entry["data"]
+    data = await _load_shared_meta(url)
+    if data is not None:
+        return data
+    try:
+        return await _fetch_meta(session, url)
+    except UpstreamUnavailable:
+        data = await _load_shared_meta(url, stale_ok=True)
+        if data is None:
+            raise
+        resilience_stats["served_from_cache"] += 1
+        return data
+
+async def resolve_server_jar(session, loader, version, progress_callback=None):
+    if loader == "fabric":
+        if not is_fabric_supported(version):
+            raise Exception(
+                f"❌ Fabric не поддерживает версию {version}\n\n"
+                f"💡 Fabric работает только начиная с версии 1.14\n\n"
+                f"Используйте Forge для версий ниже 1.14"
+            )
+        if progress_callback:
+            await progress_callback("⏳ Поиск Fabric...")
+        loaders = await get_meta_json(session, "https://meta.fabricmc.net/v2/versions/loader")
+        installers = await get_meta_json(session, "https://meta.fabricmc.net/v2/versions/installer")
+        if loaders and installers:
+            loader_version = loaders[0]['version']
+            installer_version = installers[0]['version']
+            return {
+                "key": f"fabric|{version}|{loader_version}|{installer_version}",
+                "urls": [f"https://meta.fabricmc.net/v2/versions/loader/{version}/{loader_version}/{installer_version}/server/jar"],
+                "jar_name": f"fabric-server-{version}.jar",
+                "error": None
+            }
+        raise Exception(f"Fabric не поддерживает {version}")
+    elif loader == "forge":
+        if progress_callback:
+            await progress_callback("⏳ Поиск Forge...")
+        data = await get_meta_json(session, "https://files.minecraftforge.net/net/minecraftforge/forge/promotions_slim.json")
+        promos = data.get('promos', {})
+        forge_version = promos.get(f"{version}-latest") or promos.get(f"{version}-recommended")
+        if forge_version:
+            major = int(version.split('.')[1]) if len(version.split('.')) > 1 else 0
+            full_version = f"{version}-{forge_version}"
+            if 7 <= major <= 12:
+                urls = [f"https://maven.minecraftforge.net/net/minecraftforge/forge/{full_version}/forge-{full_version}-universal.jar"]
+                if version == "1.7.10":
+                    fvd = f"{version}-{forge_version}-{version}"
+                    urls.append(f"https://maven.minecraftforge.net/net/minecraftforge/forge/{fvd}/forge-{fvd}-universal.jar")
+                return {
+                    "key": f"forge|{version}|{forge_version}|universal",
+                    "urls": urls,
+                    "jar_name": f"forge-{version}-universal.jar",
+                    "error": f"Forge не поддерживает {version}"
+                }
+            if progress_callback:
+                await progress_callback("⚠️ Forge 1.13+ требует запуска installer")
+            return {
+                "key": f"forge|{version}|{forge_version}|installer",
+                "urls": [f"https://maven.minecraftforge.net/net/minecraftforge/forge/{full_version}/forge-{full_version}-installer.jar"],
+                "jar_name": f"forge-{version}-installer.jar",
+                "error": None
+            }
+        raise Exception(f"Forge не поддерживает {version}")
+    raise Exception(f"Неизвестный загрузчик: {loader}")
+
+async def _fetch_server_jar(loader, version, progress_callback=None, on_chunk=None, throttle=None):
+    streamed = 0
+    try:
+        session = get_http_session()
+        target = await resolve_server_jar(session, loader, version, progress_callback)
+        loop = asyncio.get_event_loop()
+
+        async def from_cache(cached):
+            jar_path, entry = cached
+            jar_cache_stats["hits"] += 1
+            jar_cache_stats["bytes_saved"] += entry["size"]
+            jar_cache_stats["seconds_saved"] += entry.get("download_seconds", 0)
+            if progress_callback:
+                await progress_callback(f"⚡ Ядро из кэша: {entry['size'] // (1024*1024)}MB")
+            return jar_path, target["jar_name"]
+
+        async def forward_chunk(chunk, total_size):
+            nonlocal streamed
+            consumed = await on_chunk(target["jar_name"], chunk, total_size)
+            if consumed:
+                streamed += len(chunk)
+            return consumed
+
+        lock_name = f"jar:{target['key']}"
+        token = f"{INSTANCE_ID}:{os.urandom(8).hex()}"
+        waiting = False
+        while True:
+            cached = await loop.run_in_executor(None, jar_cache_get, target["key"])
+            if cached is not None:
+                return await from_cache(cached)
+            if await backend_call(state_backend.acquire_lock, lock_name, token, JAR_LOCK_TTL):
+                break
+            if progress_callback and not waiting:
+                await progress_callback("⏳ Ядро уже скачивает другой процесс, ожидаем...")
+            waiting = True
+            await asyncio.sleep(JAR_LOCK_POLL)
+        keeper = asyncio.create_task(_keep_lock(lock_name, token, JAR_LOCK_TTL))
+        try:
+            cached = await loop.run_in_executor(None, jar_cache_get, target["key"])
+            if cached is not None:
+                return await from_cache(cached)
+            jar_cache_stats["misses"] += 1
+            started = time.monotonic()
+            part_path = jar_cache_partial_path(target["key"])
+            try:
+                for i, url in enumerate(target["urls"]):
+                    try:
+                        await download_with_retry(
+                            session, url, part_path, progress_callback,
+                            on_chunk=forward_chunk if on_chunk else None, throttle=throttle
+                        )
+                        break
+                    except UpstreamUnavailable:
+                        raise
+                    except Exception:
+                        if i < len(target["urls"]) - 1 and not streamed:
+                            continue
+                        if target["error"]:
+                            raise Exception(target["error"])
+                        raise
+                jar_cache_stats["bytes_downloaded"] += os.path.getsize(part_path)
+                jar_path = await loop.run_in_executor(
+                    None, jar_cache_put, target["key"], part_path, target["jar_name"], time.monotonic() - started
+                )
+            except BaseException:
+                if not os.path.exists(part_path + ".json"):
+                    _drop_partial(part_path)
+                raise
+        finally:
+            keeper.cancel()
+            try:
+                await backend_call(state_backend.release_lock, lock_name, token)
+            except Exception as e:
+                print(f"[ERROR] Снятие блокировки {lock_name}: {e}")
+        return jar_path, target["jar_name"]
+    except UpstreamUnavailable as e:
+        cached = None if streamed else await asyncio.get_event_loop().run_in_executor(None, jar_cache_fallback, loader, version)
+        if cached is None:
+            raise Exception(str(e))
+        jar_path, entry = cached
+        resilience_stats["served_from_cache"] += 1
+        if progress_callback:
+            await progress_callback(f"⚠️ Источник недоступен, ядро из кэша: {entry['size'] // (1024*1024)}MB")
+        return jar_path, entry["jar_name"]
     except Exception as e:
         raise Exception(str(e))
-    return None, None
+
+async def get_server_jar(loader, version, progress_callback=None, on_chunk=None, background=False):
+    if not loader:
+        loader = "fabric"
+    if not version:
+        version = "1.20.1"
+    loader = loader.lower()
+    key = (loader, version)
+    flight = jar_flights.get(key)
+    if flight is None:
+        flight = {
+            "listeners": [], "sinks": [], "streamed": False, "last_text": None, "task": None,
+            "throttle": _warm_pace if background else None
+        }
+
+        async def broadcast(text):
+            flight["last_text"] = text
+            await asyncio.gather(*(cb(text) for cb in list(flight["listeners"])), return_exceptions=True)
+
+        async def pace(nbytes):
+            if flight["throttle"]:
+                await flight["throttle"](nbytes)
+
+        async def broadcast_chunk(jar_name, chunk, total_size):
+            flight["streamed"] = True
+            consumed = False
+            for sink in list(flight["sinks"]):
+                try:
+                    await sink(jar_name, chunk, total_size)
+                    consumed = True
+                except Exception:
+                    flight["sinks"].remove(sink)
+            return consumed
+
+        def finish(_):
+            if jar_flights.get(key) is flight:
+                del jar_flights[key]
+
+        jar_flights[key] = flight
+        flight["task"] = asyncio.create_task(_fetch_server_jar(loader, version, broadcast, broadcast_chunk, pace))
+        flight["task"].add_done_callback(finish)
+        jar_flight_stats["started"] += 1
+    else:
+        jar_flight_stats["coalesced"] += 1
+        if not background:
+            flight["throttle"] = None
+        if progress_callback and flight["last_text"]:
+            await progress_callback(flight["last_text"])
+    if progress_callback:
+        flight["listeners"].append(progress_callback)
+    if on_chunk and not flight["streamed"]:
+        flight["sinks"].append(on_chunk)
+    try:
+        return await asyncio.shield(flight["task"])
+    finally:
+        if progress_callback in flight["listeners"]:
+            flight["listeners"].remove(progress_callback)
+        if on_chunk in flight["sinks"]:
+            flight["sinks"].remove(on_chunk)
+
+def record_jar_popularity(loader, version):
+    key = f"{loader.lower()}|{version}"
+    jar_popularity[key] = jar_popularity.get(key, 0) + 1
+
+def _jar_popularity_path():
+    return os.path.join(JAR_CACHE_DIR, "popularity.json")
+
+def load_jar_popularity():
+    jar_popularity.clear()
+    try:
+        with open(_jar_popularity_path(), 'r', encoding='utf-8') as f:
+            jar_popularity.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+def save_jar_popularity(entries):
+    os.makedirs(JAR_CACHE_DIR, exist_ok=True)
+    tmp_path = _jar_popularity_path() + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, _jar_popularity_path())
+
+def warm_targets(include_presets):
+    targets = []
+    if include_presets:
+        for preset in PRESETS.values():
+            target = (preset["settings"]["loader"].lower(), preset["settings"]["version"])
+            if target not in targets:
+                targets.append(target)
+    ranked = sorted(jar_popularity.items(), key=lambda item: item[1], reverse=True)
+    for key, _ in ranked[:WARM_TOP_N]:
+        target = tuple(key.split("|", 1))
+        if target not in targets:
+            targets.append(target)
+    return targets
+
+async def _warm_pace(nbytes):
+    rate = WARM_BUSY_BANDWIDTH if build_stats["active"] else WARM_BANDWIDTH
+    now = time.monotonic()
+    warm_pacer["next"] = max(warm_pacer["next"], now) + nbytes / rate
+    warm_stats["bytes"] += nbytes
+    delay = warm_pacer["next"] - now
+    if delay > 0:
+        warm_stats["throttled_seconds"] += delay
+        await asyncio.sleep(delay)
+
+async def warm_jar(loader, version, slots):
+    async with slots:
+        while build_stats["active"] or build_queue_size():
+            await asyncio.sleep(WARM_IDLE_POLL)
+        try:
+            target = await resolve_server_jar(get_http_session(), loader, version)
+            loop = asyncio.get_event_loop()
+            if await loop.run_in_executor(None, jar_cache_get, target["key"]) is not None:
+                warm_stats["already_warm"] += 1
+                return
+            await get_server_jar(loader, version, background=True)
+            warm_stats["prefetched"] += 1
+        except Exception as e:
+            warm_stats["failed"] += 1
+            print(f"[WARN] Прогрев {loader} {version}: {e}")
+
+async def jar_warmer():
+    await asyncio.sleep(WARM_STARTUP_DELAY)
+    slots = asyncio.Semaphore(WARM_CONCURRENCY)
+    include_presets = True
+    while True:
+        targets = warm_targets(include_presets)
+        await asyncio.gather(*(warm_jar(loader, version, slots) for loader, version in targets))
+        include_presets = False
+        warm_stats["cycles"] += 1
+        for key in list(jar_popularity):
+            jar_popularity[key] *= WARM_DECAY
+            if jar_popularity[key] < 0.05:
+                del jar_popularity[key]
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, save_jar_popularity, dict(jar_popularity))
+        await asyncio.sleep(WARM_INTERVAL)
+
+def start_jar_warmer():
+    global warm_task
+    warm_task = asyncio.create_task(jar_warmer())
+
+async def stop_jar_warmer():
+    if warm_task is None:
+        return
+    warm_task.cancel()
+    await asyncio.gather(warm_task, return_exceptions=True)
+    save_jar_popularity(dict(jar_popularity))
+
+def _size_predictions_path():
+    return os.path.join(JAR_CACHE_DIR, "sizes.json")
+
+def load_size_predictions():
+    size_predictions.clear()
+    try:
+        with open(_size_predictions_path(), 'r', encoding='utf-8') as f:
+            size_predictions.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+def save_size_predictions(entries):
+    os.makedirs(JAR_CACHE_DIR, exist_ok=True)
+    tmp_path = _size_predictions_path() + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, _size_predictions_path())
+
+async def _persist_size_predictions():
+    entries = {key: dict(entry) for key, entry in size_predictions.items()}
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, save_size_predictions, entries)
+    except OSError as e:
+        print(f"[ERROR] Сохранение прогнозов размера: {e}")
+
+async def probe_jar_size(session, urls):
+    for url in urls:
+        try:
+            response, _ = await hedged_get(
+                session, mirror_urls(url), method="HEAD", allow_redirects=True,
+                timeout=aiohttp.ClientTimeout(total=SIZE_PROBE_TIMEOUT)
+            )
+            async with response:
+                if response.status == 200 and response.content_length:
+                    return response.content_length
+        except (asyncio.TimeoutError, aiohttp.ClientError, UpstreamUnavailable):
+            continue
+    return None
+
+async def predict_archive_size(loader, version):
+    loader = loader.lower()
+    key = f"{loader}|{version}"
+    learned = size_predictions.get(key, {})
+    session = get_http_session()
+    try:
+        target = await resolve_server_jar(session, loader, version)
+    except Exception:
+        return None
+    prediction = {"target": target["key"], "ratio": learned.get("ratio")}
+    cached = await asyncio.get_event_loop().run_in_executor(None, jar_cache_get, target["key"])
+    if cached is not None:
+        jar_path, entry = cached
+        prediction.update(jar_size=entry["size"], source="cache")
+        base_path = base_archive_path(jar_path, target["jar_name"])
+        if os.path.exists(base_path):
+            prediction.update(size=os.path.getsize(base_path), source="base")
+            return prediction
+    elif learned.get("target") == target["key"] and learned.get("jar_size"):
+        prediction.update(jar_size=learned["jar_size"], source="learned")
+    else:
+        jar_size = await probe_jar_size(session, target["urls"])
+        if not jar_size:
+            return None
+        prediction_stats["probed"] += 1
+        size_predictions.setdefault(key, {}).update(target=target["key"], jar_size=jar_size)
+        await _persist_size_predictions()
+        prediction.update(jar_size=jar_size, source="head")
+    prediction["size"] = int(prediction["jar_size"] * (prediction["ratio"] or SIZE_MIN_RATIO))
+    return prediction
+
+async def record_archive_size(loader, version, prediction, jar_size, archive_size, policy):
+    entry = size_predictions.setdefault(f"{loader.lower()}|{version}", {})
+    entry["archive_size"] = archive_size
+    if prediction:
+        entry.update(target=prediction["target"], jar_size=jar_size)
+    if policy == "full":
+        ratio = archive_size / jar_size
+        entry["ratio"] = entry["ratio"] + SIZE_RATIO_ALPHA * (ratio - entry["ratio"]) if "ratio" in entry else ratio
+    await _persist_size_predictions()
+
+def archive_alternatives(loader, version):
+    current = f"{loader.lower()}|{version}"
+    fits = []
+    for key, entry in size_predictions.items():
+        if key == current or not entry.get("archive_size") or entry["archive_size"] > ARCHIVE_LIMIT_BYTES:
+            continue
+        alt_loader, alt_version = key.split("|", 1)
+        same_version = alt_version == version
+        distance = abs(parse_version(alt_version)[1] - parse_version(version)[1])
+        fits.append((not same_version, alt_loader != loader.lower(), distance, alt_version, alt_loader, entry["archive_size"]))
+    return [(alt_version, alt_loader.capitalize(), size) for *_, alt_version, alt_loader, size in sorted(fits)[:3]]
+
+def archive_limit_message(loader, version, size, predicted=False):
+    if predicted:
+        text = (
+            f"Архив получится ~{size / (1024*1024):.1f}MB и превысит лимит 50MB\n\n"
+            "⏹️ Сборка остановлена до загрузки ядра\n\n"
+        )
+    else:
+        text = f"Архив {size / (1024*1024):.1f}MB превышает лимит 50MB\n\n"
+    alternatives = archive_alternatives(loader, version)
+    if alternatives:
+        return text + "💡 Уже собирались в лимите:\n" + "\n".join(
+            f"• {alt_version} {alt_loader} ({alt_size / (1024*1024):.1f}MB)" for alt_version, alt_loader, alt_size in alternatives
+        )
+    return (
+        text +
+        "💡 Попробуйте:\n"
+        "• Более старую версию (1.12.2, 1.8.8, 1.7.10)\n"
+        "• Fabric вместо Forge для новых версий"
+    )
 
 def generate_server_properties(settings):
     return f"""eula=true
@@ -334,99 +2092,719 @@ Linux: ./start.sh
 RAM: {settings.get('ram')}MB
 """
 
-def create_zip_sync(temp_path, jar_data, jar_name, settings):
+def _write_config_entries(zf, jar_name, settings):
+    zf.writestr(_zip_info('server.properties'), generate_server_properties(settings))
+    zf.writestr(_zip_info('eula.txt'), 'eula=true')
+    start_sh, start_bat = generate_start_script(jar_name, settings.get('ram', '2048'))
+    zf.writestr(_zip_info('start.sh', 0o755), start_sh)
+    zf.writestr(_zip_info('start.bat'), start_bat)
+    zf.writestr(_zip_info('README.txt'), create_readme(settings, jar_name))
+    zf.writestr(_zip_info('ops.json'), '[]')
+    zf.writestr(_zip_info('whitelist.json'), '[]')
+
+def choose_compression(sample, total_size):
+    if not sample or total_size < 64 * 1024:
+        return zipfile.ZIP_DEFLATED, 6, "full", 0.0
+    started = time.thread_time()
+    fast_ratio = len(zlib.compress(sample, 1)) / len(sample)
+    fast_cost = time.thread_time() - started
+    started = time.thread_time()
+    zlib.compress(sample, 6)
+    baseline_cpu = (time.thread_time() - started) * total_size / len(sample)
+    if 1 - fast_ratio < COMPRESSION_MIN_GAIN:
+        if total_size <= ARCHIVE_LIMIT_BYTES:
+            return zipfile.ZIP_STORED, None, "stored", baseline_cpu
+        return zipfile.ZIP_DEFLATED, 9, "full", baseline_cpu
+    if total_size * fast_ratio <= ARCHIVE_LIMIT_BYTES:
+        return zipfile.ZIP_DEFLATED, 1, "fast", max(baseline_cpu, fast_cost)
+    return zipfile.ZIP_DEFLATED, 9, "full", baseline_cpu
+
+def _zip_info(name, mode=0o644):
+    info = zipfile.ZipInfo(name, date_time=ZIP_EPOCH)
+    info.external_attr = mode << 16
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+def _file_chunks(path):
+    with open(path, 'rb') as f:
+        yield from iter(lambda: f.read(1024 * 1024), b'')
+
+def _stream_chunks(item, stream):
+    while item[0] == "data":
+        yield item[2]
+        item = stream.get()
+
+def _write_jar_entry(zf, jar_name, sample, total_size, chunks):
+    compress_type, level, policy, baseline_cpu = choose_compression(sample, total_size)
+    info = _zip_info(jar_name)
+    info.compress_type = compress_type
+    info._compresslevel = level
+    spent = 0.0
+    with zf.open(info, 'w', force_zip64=True) as dst:
+        for chunk in chunks:
+            started = time.thread_time()
+            dst.write(chunk)
+            spent += time.thread_time() - started
+    return {"policy": policy, "cpu_spent": spent, "cpu_saved": max(0.0, baseline_cpu - spent)}
+
+def _write_jar_from_file(zf, jar_path, jar_name):
+    with open(jar_path, 'rb') as f:
+        sample = f.read(COMPRESSION_SAMPLE_SIZE)
+    return _write_jar_entry(zf, jar_name, sample, os.path.getsize(jar_path), _file_chunks(jar_path))
+
+def _write_jar_from_stream(zf, item, stream):
+    _, jar_name, _, total_size = item
+    chunks = _stream_chunks(item, stream)
+    head = []
+    buffered = 0
+    for chunk in chunks:
+        head.append(chunk)
+        buffered += len(chunk)
+        if buffered >= COMPRESSION_SAMPLE_SIZE:
+            break
+    sample = b''.join(head)[:COMPRESSION_SAMPLE_SIZE]
+    return _write_jar_entry(zf, jar_name, sample, total_size, chain(head, chunks))
+
+def record_compression_report(report):
+    compression_stats[report["policy"]] += 1
+    compression_stats["cpu_spent"] += report["cpu_spent"]
+    compression_stats["cpu_saved"] += report["cpu_saved"]
+
+def create_zip_sync(temp_path, jar_path, jar_name, settings):
     with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
-        zf.writestr(jar_name, jar_data, compress_type=zipfile.ZIP_DEFLATED, compresslevel=6)
-        zf.writestr('server.properties', generate_server_properties(settings))
-        zf.writestr('eula.txt', 'eula=true')
-        start_sh, start_bat = generate_start_script(jar_name, settings.get('ram', '2048'))
-        zf.writestr('start.sh', start_sh)
-        zf.writestr('start.bat', start_bat)
-        zf.writestr('README.txt', create_readme(settings, jar_name))
-        zf.writestr('ops.json', '[]')
-        zf.writestr('whitelist.json', '[]')
-
-async def create_server_package(user_id, progress_message):
-    settings = user_settings.get(user_id, {})
+        report = _write_jar_from_file(zf, jar_path, jar_name)
+        _write_config_entries(zf, jar_name, settings)
+    return report
+
+class JarZipStream:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=8)
+        self.started = False
+        self.aborted = False
+        self.writer = None
+        self.loop = None
+
+    def start(self, target, *args):
+        loop = self.loop = asyncio.get_event_loop()
+        self.writer = loop.create_future()
+
+        def done(result, error):
+            if self.writer.done():
+                return
+            if error:
+                self.writer.set_exception(error)
+                self._drain()
+            else:
+                self.writer.set_result(result)
+
+        def run():
+            try:
+                result, error = target(*args), None
+            except Exception as e:
+                result, error = None, e
+            loop.call_soon_threadsafe(done, result, error)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    async def feed(self, jar_name, chunk, total_size):
+        self.started = True
+        await self._put(("data", jar_name, chunk, total_size))
+
+    async def finish(self, jar_path, jar_name):
+        if self.started:
+            await self._put(("end",))
+        else:
+            await self._put(("file", jar_name, jar_path))
+
+    async def skip(self):
+        await self._put(("skip",))
+
+    def abort(self):
+        self.aborted = True
+        self._drain()
+        self.queue.put_nowait(("abort",))
+
+    def _drain(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    async def _put(self, item):
+        if self.writer and self.writer.done() and self.writer.exception():
+            raise self.writer.exception()
+        if self.aborted or (self.writer and self.writer.done()):
+            raise Exception("Сборка архива прервана")
+        await self.queue.put(item)
+
+    def get(self):
+        item = asyncio.run_coroutine_threadsafe(self.queue.get(), self.loop).result()
+        if item[0] == "abort":
+            raise Exception("Сборка архива прервана")
+        return item
+
+def create_base_stream_sync(base_tmp_path, stream):
+    item = stream.get()
+    if item[0] == "skip":
+        return None
+    with zipfile.ZipFile(base_tmp_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        if item[0] == "file":
+            report = _write_jar_from_file(zf, item[2], item[1])
+        else:
+            report = _write_jar_from_stream(zf, item, stream)
+    return report
+
+def append_config_sync(base_path, temp_path, jar_name, settings):
+    shutil.copyfile(base_path, temp_path)
+    with zipfile.ZipFile(temp_path, 'a', zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        _write_config_entries(zf, jar_name, settings)
+
+def _file_id_cache_path():
+    return os.path.join(JAR_CACHE_DIR, "file_ids.json")
+
+def load_file_id_cache():
+    file_id_cache.clear()
     try:
-        async def update_progress(text):
+        with open(_file_id_cache_path(), 'r', encoding='utf-8') as f:
+            file_id_cache.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+def save_file_id_cache(entries):
+    os.makedirs(JAR_CACHE_DIR, exist_ok=True)
+    tmp_path = _file_id_cache_path() + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, _file_id_cache_path())
+
+async def remember_file_id(archive_hash, file_id):
+    file_id_cache[archive_hash] = file_id
+    file_id_cache.move_to_end(archive_hash)
+    while len(file_id_cache) > FILE_ID_CACHE_MAX:
+        file_id_cache.popitem(last=False)
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, save_file_id_cache, list(file_id_cache.items()))
+
+def hash_file_sync(path, algorithm="sha256"):
+    digest = hashlib.new(algorithm)
+    for block in _file_chunks(path):
+        digest.update(block)
+    return digest.hexdigest()
+
+def retry_after_seconds(error):
+    delay = error.retry_after
+    if hasattr(delay, "total_seconds"):
+        delay = delay.total_seconds()
+    return float(delay)
+
+class ProgressReporter:
+    def __init__(self, message, min_interval=PROGRESS_MIN_INTERVAL):
+        self.message = message
+        self.min_interval = min_interval
+        self.pending = None
+        self.sent_text = None
+        self.next_at = 0.0
+        self.task = None
+
+    async def __call__(self, text):
+        progress_stats["requested"] += 1
+        self.pending = text
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while self.pending is not None:
+            delay = self.next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text, self.pending = self.pending, None
+            if text == self.sent_text:
+                progress_stats["skipped"] += 1
+                continue
+            await self._send(text)
+
+    async def _send(self, text):
+        try:
+            await self.message.get_bot().edit_message_text(
+                chat_id=self.message.chat_id,
+                message_id=self.message.message_id,
+                text=text,
+                rate_limit_args=PRIORITY_PROGRESS
+            )
+        except RetryAfter as e:
+            progress_stats["retry_after"] += 1
+            self.next_at = time.monotonic() + retry_after_seconds(e)
+            if self.pending is None:
+                self.pending = text
+            return False
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                return True
+        except Exception:
+            return True
+        progress_stats["sent"] += 1
+        self.sent_text = text
+        self.next_at = time.monotonic() + self.min_interval
+        return True
+
+    async def close(self):
+        self.pending = None
+        if self.task and not self.task.done():
+            self.task.cancel()
             try:
-                await progress_message.edit_text(text)
-            except:
+                await self.task
+            except asyncio.CancelledError:
                 pass
+
+    async def finish(self, text):
+        await self.close()
+        for _ in range(3):
+            delay = self.next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if await self._send(text):
+                return
+        self.pending = None
+
+async def create_server_package(settings, update_progress):
+    try:
         loader = settings.get('loader') or 'Fabric'
         version = settings.get('version') or '1.20.1'
-        jar_data, jar_name = await get_server_jar(loader, version, update_progress)
-        if not jar_data:
-            raise Exception("Не удалось загрузить серверное ядро")
-        original_size = len(jar_data)
-        await update_progress(f"🗜️ Сжатие {original_size // (1024*1024)}MB...")
+        record_jar_popularity(loader, version)
+        prediction = await predict_archive_size(loader, version)
+        if prediction and prediction["size"] > ARCHIVE_LIMIT_BYTES:
+            prediction_stats["rejected"] += 1
+            raise Exception(archive_limit_message(loader, version, prediction["size"], predicted=True))
+        policy = None
+        os.makedirs(_base_archive_dir(), exist_ok=True)
+        fd, base_tmp_path = tempfile.mkstemp(dir=_base_archive_dir(), suffix=".part")
+        os.close(fd)
+        stream = JarZipStream()
+        stream.start(create_base_stream_sync, base_tmp_path, stream)
+        try:
+            jar_path, jar_name = await get_server_jar(loader, version, update_progress, stream.feed)
+            if not jar_path:
+                raise Exception("Не удалось загрузить серверное ядро")
+            original_size = os.path.getsize(jar_path)
+            base_path = base_archive_path(jar_path, jar_name)
+            if not stream.started and os.path.exists(base_path):
+                await stream.skip()
+                await stream.writer
+                base_archive_stats["hits"] += 1
+            else:
+                await stream.finish(jar_path, jar_name)
+                if not stream.writer.done():
+                    await update_progress(f"🗜️ Сжатие {original_size // (1024*1024)}MB...")
+                report = await stream.writer
+                record_compression_report(report)
+                policy = report["policy"]
+                os.replace(base_tmp_path, base_path)
+                base_archive_stats["built"] += 1
+        except BaseException:
+            stream.abort()
+            try:
+                await stream.writer
+            except Exception:
+                pass
+            raise
+        finally:
+            if os.path.exists(base_tmp_path):
+                os.unlink(base_tmp_path)
         temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
         temp_path = temp_file.name
         temp_file.close()
         loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, create_zip_sync, temp_path, jar_data, jar_name, settings)
+        started = time.monotonic()
+        try:
+            await loop.run_in_executor(None, append_config_sync, base_path, temp_path, jar_name, settings)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        base_archive_stats["assemble_seconds"] += time.monotonic() - started
         archive_size = os.path.getsize(temp_path)
         compression_ratio = 100 - (archive_size / original_size * 100)
-        if archive_size > 49.5 * 1024 * 1024:
+        await record_archive_size(loader, version, prediction, original_size, archive_size, policy)
+        if archive_size > ARCHIVE_LIMIT_BYTES:
             os.unlink(temp_path)
-            raise Exception(
-                f"Архив {archive_size / (1024*1024):.1f}MB превышает лимит 50MB\n\n"
-                f"💡 Попробуйте:\n"
-                f"• Более старую версию (1.12.2, 1.8.8, 1.7.10)\n"
-                f"• Fabric вместо Forge для новых версий"
-            )
+            if prediction:
+                prediction_stats["missed"] += 1
+            raise Exception(archive_limit_message(loader, version, archive_size))
         await update_progress(f"✅ Архив готов: {archive_size / (1024*1024):.1f}MB")
         return temp_path, archive_size, original_size, compression_ratio
     except Exception as e:
         traceback.print_exc()
         raise Exception(str(e))
 
+DEFAULT_SETTINGS = MappingProxyType({
+    "version": "1.20.1", "loader": "Fabric", "max_players": "20",
+    "difficulty": "normal", "gamemode": "survival", "pvp": "true",
+    "online_mode": "true", "port": "25565", "view_distance": "10",
+    "simulation_distance": "10", "spawn_protection": "16",
+    "allow_nether": "true", "allow_flight": "false", "command_blocks": "false",
+    "spawn_monsters": "true", "spawn_animals": "true", "spawn_npcs": "true",
+    "generate_structures": "true", "level_type": "minecraft:normal", "seed": "",
+    "motd": "A Minecraft Server", "ram": "2048", "max_tick_time": "60000",
+    "op_permission_level": "4", "entity_broadcast_range": "100",
+    "player_idle_timeout": "0", "hardcore": "false", "whitelist": "false",
+    "max_world_size": "29999984"
+})
+
+SETTINGS_FIELDS = tuple(DEFAULT_SETTINGS)
+SETTINGS_INDEX = {key: i for i, key in enumerate(SETTINGS_FIELDS)}
+SETTINGS_BASES = {"default": DEFAULT_SETTINGS}
+SETTINGS_BASES.update({preset_id: MappingProxyType(preset["settings"]) for preset_id, preset in PRESETS.items()})
+SETTINGS_CHOICES = {
+    key: ("true", "false") for key in (
+        "pvp", "online_mode", "allow_nether", "allow_flight", "command_blocks", "spawn_monsters",
+        "spawn_animals", "spawn_npcs", "generate_structures", "hardcore", "whitelist"
+    )
+}
+SETTINGS_CHOICES.update({
+    "loader": ("Fabric", "Forge"),
+    "difficulty": ("peaceful", "easy", "normal", "hard"),
+    "gamemode": ("survival", "creative", "adventure", "spectator"),
+    "level_type": ("minecraft:normal", "minecraft:flat", "minecraft:large_biomes", "minecraft:amplified"),
+    "op_permission_level": ("1", "2", "3", "4"),
+})
+SETTINGS_EXTRA = 255
+
+class Settings:
+    __slots__ = ("base_id", "_codes", "_extra")
+
+    def __init__(self, base_id="default"):
+        self.base_id = base_id
+        self._codes = None
+        self._extra = None
+
+    def __getitem__(self, key):
+        if self._codes is not None:
+            code = self._codes[SETTINGS_INDEX[key]] if key in SETTINGS_INDEX else 0
+            if code == SETTINGS_EXTRA:
+                return self._extra[key]
+            if code:
+                return SETTINGS_CHOICES[key][code - 1]
+        return SETTINGS_BASES[self.base_id][key]
+
+    def __setitem__(self, key, value):
+        i = SETTINGS_INDEX[key]
+        base_value = SETTINGS_BASES[self.base_id][key]
+        if self._codes is None:
+            if value == base_value:
+                return
+            self._codes = bytearray(len(SETTINGS_FIELDS))
+        if self._extra and key in self._extra:
+            del self._extra[key]
+        choices = SETTINGS_CHOICES.get(key, ())
+        if value == base_value:
+            self._codes[i] = 0
+        elif value in choices:
+            self._codes[i] = choices.index(value) + 1
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+            self._codes[i] = SETTINGS_EXTRA
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in SETTINGS_INDEX
+
+    def __iter__(self):
+        return iter(SETTINGS_FIELDS)
+
+    def __len__(self):
+        return len(SETTINGS_FIELDS)
+
+    def keys(self):
+        return SETTINGS_FIELDS
+
+    def items(self):
+        return [(key, self[key]) for key in SETTINGS_FIELDS]
+
+    def overlay(self):
+        if self._codes is None:
+            return {}
+        return {key: self[key] for key, code in zip(SETTINGS_FIELDS, self._codes) if code}
+
+    def to_state(self):
+        return {"base": self.base_id, "set": self.overlay()}
+
+def settings_from_state(state):
+    if "base" in state and "set" in state:
+        settings = Settings(state["base"] if state["base"] in SETTINGS_BASES else "default")
+        values = state["set"]
+    else:
+        settings = Settings()
+        values = state
+    for key, value in values.items():
+        if key in SETTINGS_INDEX:
+            settings[key] = value
+    return settings
+
 def get_default_settings():
-    return {
-        "version": "1.20.1", "loader": "Fabric", "max_players": "20",
-        "difficulty": "normal", "gamemode": "survival", "pvp": "true",
-        "online_mode": "true", "port": "25565", "view_distance": "10",
-        "simulation_distance": "10", "spawn_protection": "16",
-        "allow_nether": "true", "allow_flight": "false", "command_blocks": "false",
-        "spawn_monsters": "true", "spawn_animals": "true", "spawn_npcs": "true",
-        "generate_structures": "true", "level_type": "minecraft:normal", "seed": "",
-        "motd": "A Minecraft Server", "ram": "2048", "max_tick_time": "60000",
-        "op_permission_level": "4", "entity_broadcast_range": "100",
-        "player_idle_timeout": "0", "hardcore": "false", "whitelist": "false",
-        "max_world_size": "29999984"
-    }
+    return Settings()
+
+DIFFICULTY_NAMES = {"peaceful": "Мирная", "easy": "Лёгкая", "normal": "Обычная", "hard": "Тяжёлая"}
+GAMEMODE_NAMES = {"survival": "Выживание", "creative": "Творческий", "adventure": "Приключение", "spectator": "Наблюдатель"}
+LEVEL_TYPE_NAMES = {
+    "minecraft:normal": "Стандартный", "minecraft:flat": "Плоский",
+    "minecraft:large_biomes": "Большие биомы", "minecraft:amplified": "Усиленный"
+}
 
 def format_config_summary(settings):
-    difficulty_names = {"peaceful": "Мирная", "easy": "Лёгкая", "normal": "Обычная", "hard": "Тяжёлая"}
-    gamemode_names = {"survival": "Выживание", "creative": "Творческий", "adventure": "Приключение", "spectator": "Наблюдатель"}
-    level_type_names = {
-        "minecraft:normal": "Стандартный", "minecraft:flat": "Плоский",
-        "minecraft:large_biomes": "Большие биомы", "minecraft:amplified": "Усиленный"
-    }
     return (
         f"🎯 Версия: {settings.get('version', '1.20.1')}\n"
         f"⚡ Загрузчик: {settings.get('loader', 'Fabric')}\n"
         f"💾 Память: {settings.get('ram', '2048')} MB\n"
         f"👥 Игроков: {settings.get('max_players', '20')}\n"
-        f"⚔️ Сложность: {difficulty_names.get(settings.get('difficulty', 'normal'), settings.get('difficulty', 'normal'))}\n"
-        f"🎮 Режим: {gamemode_names.get(settings.get('gamemode', 'survival'), settings.get('gamemode', 'survival'))}\n"
+        f"⚔️ Сложность: {DIFFICULTY_NAMES.get(settings.get('difficulty', 'normal'), settings.get('difficulty', 'normal'))}\n"
+        f"🎮 Режим: {GAMEMODE_NAMES.get(settings.get('gamemode', 'survival'), settings.get('gamemode', 'survival'))}\n"
         f"🌐 Порт: {settings.get('port', '25565')}\n"
         f"👁️ Прорисовка: {settings.get('view_distance', '10')} чанков\n"
         f"🔮 Симуляция: {settings.get('simulation_distance', '10')} чанков\n"
-        f"🗺️ Тип мира: {level_type_names.get(settings.get('level_type', 'minecraft:normal'), settings.get('level_type', 'minecraft:normal'))}"
+        f"🗺️ Тип мира: {LEVEL_TYPE_NAMES.get(settings.get('level_type', 'minecraft:normal'), settings.get('level_type', 'minecraft:normal'))}"
+    )
+
+MAIN_MENU_TEXT = (
+    "🎮 Minecraft Server Builder\n\n"
+    "✨ Поддерживаются загрузчики: Fabric, Forge\n\n"
+    "Бот создаёт готовые архивы сервера Minecraft.\n"
+    "Настройте конфигурацию или выберите шаблон -\n"
+    "и сервер будет собран автоматически."
+)
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("📋 Меню", callback_data="action_menu")]])
+ACTION_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📦 Быстрые шаблоны", callback_data="presets_menu")],
+    [InlineKeyboardButton("🛠️ Конфигурация", callback_data="config_menu")],
+    [InlineKeyboardButton("☕ Java - инструкция", callback_data="java_info")],
+    [InlineKeyboardButton("📖 Помощь", callback_data="help_menu")],
+    [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+])
+BACK_TO_ACTIONS_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="action_menu")]])
+BACK_TO_HELP_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="help_menu")]])
+JAVA_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("☕ Java 21", url="https://adoptium.net/temurin/releases/?version=21")],
+    [InlineKeyboardButton("☕ Java 17", url="https://adoptium.net/temurin/releases/?version=17")],
+    [InlineKeyboardButton("☕ Java 8",  url="https://adoptium.net/temurin/releases/?version=8")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="action_menu")]
+])
+HELP_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ Частые ошибки", callback_data="help_errors")],
+    [InlineKeyboardButton("💡 Советы", callback_data="help_tips")],
+    [InlineKeyboardButton("🌐 Как подключиться к серверу", callback_data="help_connect")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="action_menu")]
+])
+PRESETS_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(preset["name"], callback_data=preset_id)] for preset_id, preset in PRESETS.items()]
+    + [[InlineKeyboardButton("🔙 Назад", callback_data="action_menu")]]
+)
+CONFIG_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎯 Версия и загрузчик", callback_data="cfg_version_loader")],
+    [InlineKeyboardButton("👥 Игроки и режим", callback_data="cfg_players_mode")],
+    [InlineKeyboardButton("🌍 Мир и генерация", callback_data="cfg_world")],
+    [InlineKeyboardButton("⚙️ Производительность", callback_data="cfg_performance")],
+    [InlineKeyboardButton("🔒 Безопасность", callback_data="cfg_security")],
+    [InlineKeyboardButton("🚀 Создать сервер", callback_data="create_server")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="action_menu")]
+])
+VERSION_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("1.21.4", callback_data="version_1.21.4"), InlineKeyboardButton("1.21.3", callback_data="version_1.21.3")],
+    [InlineKeyboardButton("1.21.1", callback_data="version_1.21.1"), InlineKeyboardButton("1.21", callback_data="version_1.21")],
+    [InlineKeyboardButton("1.20.6", callback_data="version_1.20.6"), InlineKeyboardButton("1.20.4", callback_data="version_1.20.4")],
+    [InlineKeyboardButton("1.20.1 ✅", callback_data="version_1.20.1"), InlineKeyboardButton("1.19.4", callback_data="version_1.19.4")],
+    [InlineKeyboardButton("1.18.2", callback_data="version_1.18.2"), InlineKeyboardButton("1.16.5 💾", callback_data="version_1.16.5")],
+    [InlineKeyboardButton("1.12.2 💾", callback_data="version_1.12.2"), InlineKeyboardButton("1.8.8 💾", callback_data="version_1.8.8")],
+    [InlineKeyboardButton("1.7.10 💾", callback_data="version_1.7.10"), InlineKeyboardButton("✏️ Своя версия", callback_data="input_version")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="cfg_version_loader")]
+])
+LOADER_KEYBOARDS = {
+    fabric_ok: InlineKeyboardMarkup([
+        [InlineKeyboardButton("Fabric 💾 (рекомендуется для новых версий)", callback_data="loader_fabric")]
+        if fabric_ok else
+        [InlineKeyboardButton("⚠️ Fabric недоступен для этой версии", callback_data="loader_fabric_blocked")],
+        [InlineKeyboardButton("Forge (поддерживает все версии)", callback_data="loader_forge")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="cfg_version_loader")]
+    ])
+    for fabric_ok in (True, False)
+}
+RAM_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("512 MB", callback_data="ram_512"), InlineKeyboardButton("1 GB", callback_data="ram_1024")],
+    [InlineKeyboardButton("2 GB ✅", callback_data="ram_2048"), InlineKeyboardButton("4 GB", callback_data="ram_4096")],
+    [InlineKeyboardButton("8 GB", callback_data="ram_8192"), InlineKeyboardButton("16 GB", callback_data="ram_16384")],
+    [InlineKeyboardButton("✏️ Ввести вручную (MB)", callback_data="input_ram")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="cfg_version_loader")]
+])
+MAX_PLAYERS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("5", callback_data="maxplayers_5"), InlineKeyboardButton("10", callback_data="maxplayers_10")],
+    [InlineKeyboardButton("20 ✅", callback_data="maxplayers_20"), InlineKeyboardButton("50", callback_data="maxplayers_50")],
+    [InlineKeyboardButton("100", callback_data="maxplayers_100"), InlineKeyboardButton("200", callback_data="maxplayers_200")],
+    [InlineKeyboardButton("✏️ Ввести вручную", callback_data="input_maxplayers")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="cfg_players_mode")]
+])
+DIFFICULTY_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("☮️ Мирная", callback_data="difficulty_peaceful")],
+    [InlineKeyboardButton("😊 Лёгкая", callback_data="difficulty_easy")],
+    [InlineKeyboardButton("😐 Обычная ✅", callback_data="difficulty_normal")],
+    [InlineKeyboardButton("😈 Тяжёлая", callback_data="difficulty_hard")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="cfg_players_mode")]
+])
+GAMEMODE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⛏️ Выживание ✅", callback_data="gamemode_survival")],
+    [InlineKeyboardButton("🎨 Творческий", callback_data="gamemode_creative")],
+    [InlineKeyboardButton("🗺️ Приключение", callback_data="gamemode_adventure")],
+    [InlineKeyboardButton("👻 Наблюдатель", callback_data="gamemode_spectator")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="cfg_players_mode")]
+])
+LEVEL_TYPE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🌄 Стандартный ✅", callback_data="leveltype_minecraft:normal")],
+    [InlineKeyboardButton("🟫 Плоский", callback_data="leveltype_minecraft:flat")],
+    [InlineKeyboardButton("🌿 Большие биомы", callback_data="leveltype_minecraft:large_biomes")],
+    [InlineKeyboardButton("⛰️ Усиленный рельеф", callback_data="leveltype_minecraft:amplified")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="cfg_world")]
+])
+OP_LEVEL_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("1 - Обход защиты спавна", callback_data="oplevel_1")],
+    [InlineKeyboardButton("2 - Команды и блоки", callback_data="oplevel_2")],
+    [InlineKeyboardButton("3 - Управление игроками", callback_data="oplevel_3")],
+    [InlineKeyboardButton("4 - Полные права ✅", callback_data="oplevel_4")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="cfg_security")]
+])
+
+def _preset_card(preset_id, preset):
+    s = preset["settings"]
+    info = (
+        f"{preset['name']}\n"
+        f"{preset['desc']}\n\n"
+        f"🎯 Версия: {s['version']}\n"
+        f"⚡ Загрузчик: {s['loader']}\n"
+        f"💾 Память: {s['ram']} MB\n"
+        f"👥 Игроков: {s['max_players']}\n"
+        f"⚔️ Сложность: {DIFFICULTY_NAMES.get(s['difficulty'], s['difficulty'])}\n"
+        f"🎮 Режим: {GAMEMODE_NAMES.get(s['gamemode'], s['gamemode'])}\n"
+        f"💀 Хардкор: {'Да' if s['hardcore'] == 'true' else 'Нет'}\n"
+        f"📋 Вайтлист: {'Да' if s['whitelist'] == 'true' else 'Нет'}"
     )
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Применить и создать сервер", callback_data=f"apply_create_{preset_id}")],
+        [InlineKeyboardButton("🛠️ Применить и настроить", callback_data=f"apply_edit_{preset_id}")],
+        [InlineKeyboardButton("🔙 Назад к шаблонам", callback_data="presets_menu")]
+    ])
+    return info, keyboard
+
+PRESET_CARDS = {preset_id: _preset_card(preset_id, preset) for preset_id, preset in PRESETS.items()}
+
+def _render_config_menu(curr):
+    return f"🛠️ Конфигурация сервера\n\n{format_config_summary(curr)}", CONFIG_KEYBOARD
+
+def _render_version_loader(curr):
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"🎯 Версия: {curr.get('version', '1.20.1')}", callback_data="set_version")],
+        [InlineKeyboardButton(f"⚡ Загрузчик: {curr.get('loader', 'Fabric')}", callback_data="set_loader")],
+        [InlineKeyboardButton(f"💾 Память: {curr.get('ram', '2048')} MB", callback_data="set_ram")],
+        [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
+    ])
+    return "🎯 Версия и загрузчик\n\n⚠️ Fabric доступен только с версии 1.14 и выше.", keyboard
+
+def _render_players_mode(curr):
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"👥 Макс. игроков: {curr.get('max_players', '20')}", callback_data="set_max_players")],
+        [InlineKeyboardButton(f"⚔️ Сложность: {DIFFICULTY_NAMES.get(curr.get('difficulty','normal'), curr.get('difficulty','normal'))}", callback_data="set_difficulty")],
+        [InlineKeyboardButton(f"🎮 Режим игры: {GAMEMODE_NAMES.get(curr.get('gamemode','survival'), curr.get('gamemode','survival'))}", callback_data="set_gamemode")],
+        [InlineKeyboardButton(f"⚔️ PvP: {'Включено' if curr.get('pvp','true')=='true' else 'Выключено'}", callback_data="set_pvp")],
+        [InlineKeyboardButton(f"🔐 Проверка лицензии: {'Включена' if curr.get('online_mode','true')=='true' else 'Выключена'}", callback_data="set_online_mode")],
+        [InlineKeyboardButton(f"🌐 Порт: {curr.get('port', '25565')}", callback_data="set_port")],
+        [InlineKeyboardButton("📝 Описание сервера (MOTD)", callback_data="input_motd")],
+        [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
+    ])
+    return "👥 Игроки и режим игры:", keyboard
+
+def _render_world(curr):
+    def yn(v, t='true'): return "Да" if v == t else "Нет"
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"👁️ Прорисовка: {curr.get('view_distance','10')} чанков", callback_data="set_view_distance")],
+        [InlineKeyboardButton(f"🔮 Симуляция: {curr.get('simulation_distance','10')} чанков", callback_data="set_simulation_distance")],
+        [InlineKeyboardButton(f"🏰 Защита спавна: {curr.get('spawn_protection','16')} блоков", callback_data="set_spawn_protection")],
+        [InlineKeyboardButton(f"🔥 Незер: {yn(curr.get('allow_nether','true'))}", callback_data="set_nether")],
+        [InlineKeyboardButton(f"👹 Монстры: {yn(curr.get('spawn_monsters','true'))}", callback_data="set_monsters")],
+        [InlineKeyboardButton(f"🐷 Животные: {yn(curr.get('spawn_animals','true'))}", callback_data="set_animals")],
+        [InlineKeyboardButton(f"👨‍🌾 Жители (NPC): {yn(curr.get('spawn_npcs','true'))}", callback_data="set_npcs")],
+        [InlineKeyboardButton(f"🏛️ Структуры: {yn(curr.get('generate_structures','true'))}", callback_data="set_structures")],
+        [InlineKeyboardButton(f"🗺️ Тип мира: {LEVEL_TYPE_NAMES.get(curr.get('level_type','minecraft:normal'), curr.get('level_type','minecraft:normal'))}", callback_data="set_level_type")],
+        [InlineKeyboardButton(f"🌱 Сид: {curr.get('seed','') or 'Случайный'}", callback_data="input_seed")],
+        [InlineKeyboardButton(f"📐 Макс. размер мира: {curr.get('max_world_size','29999984')}", callback_data="set_max_world_size")],
+        [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
+    ])
+    return "🌍 Мир и генерация:", keyboard
+
+def _render_performance(curr):
+    tick = curr.get('max_tick_time', '60000')
+    tick_label = "Безлимит" if tick == '-1' else f"{tick} мс"
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"✈️ Полёт: {'Разрешён' if curr.get('allow_flight','false')=='true' else 'Запрещён'}", callback_data="set_flight")],
+        [InlineKeyboardButton(f"🎛️ Командные блоки: {'Включены' if curr.get('command_blocks','false')=='true' else 'Выключены'}", callback_data="set_cmd_blocks")],
+        [InlineKeyboardButton(f"⏱️ Макс. время тика: {tick_label}", callback_data="set_max_tick_time")],
+        [InlineKeyboardButton(f"📡 Дальность сущностей: {curr.get('entity_broadcast_range','100')}%", callback_data="set_entity_range")],
+        [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
+    ])
+    return "⚙️ Производительность:", keyboard
+
+def _render_security(curr):
+    idle = curr.get('player_idle_timeout', '0')
+    idle_label = f"{idle} мин" if idle != '0' else "Выключен"
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"💀 Хардкор: {'Включён' if curr.get('hardcore','false')=='true' else 'Выключен'}", callback_data="set_hardcore")],
+        [InlineKeyboardButton(f"📋 Белый список: {'Включён' if curr.get('whitelist','false')=='true' else 'Выключен'}", callback_data="set_whitelist")],
+        [InlineKeyboardButton(f"👑 Уровень прав оператора: {curr.get('op_permission_level','4')}", callback_data="set_op_level")],
+        [InlineKeyboardButton(f"💤 Тайм-аут AFK: {idle_label}", callback_data="set_idle_timeout")],
+        [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
+    ])
+    return "🔒 Безопасность:", keyboard
+
+MENU_RENDERERS = {
+    "config_menu": (("version", "loader", "ram", "max_players", "difficulty", "gamemode", "port",
+                     "view_distance", "simulation_distance", "level_type"), _render_config_menu),
+    "cfg_version_loader": (("version", "loader", "ram"), _render_version_loader),
+    "cfg_players_mode": (("max_players", "difficulty", "gamemode", "pvp", "online_mode", "port"), _render_players_mode),
+    "cfg_world": (("view_distance", "simulation_distance", "spawn_protection", "allow_nether", "spawn_monsters",
+                   "spawn_animals", "spawn_npcs", "generate_structures", "level_type", "seed", "max_world_size"), _render_world),
+    "cfg_performance": (("allow_flight", "command_blocks", "max_tick_time", "entity_broadcast_range"), _render_performance),
+    "cfg_security": (("hardcore", "whitelist", "op_permission_level", "player_idle_timeout"), _render_security),
+}
 
-def build_config_keyboard():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🎯 Версия и загрузчик", callback_data="cfg_version_loader")],
-        [InlineKeyboardButton("👥 Игроки и режим", callback_data="cfg_players_mode")],
-        [InlineKeyboardButton("🌍 Мир и генерация", callback_data="cfg_world")],
-        [InlineKeyboardButton("⚙️ Производительность", callback_data="cfg_performance")],
-        [InlineKeyboardButton("🔒 Безопасность", callback_data="cfg_security")],
-        [InlineKeyboardButton("🚀 Создать сервер", callback_data="create_server")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="action_menu")]
+def render_menu(menu_key, settings):
+    fields, renderer = MENU_RENDERERS[menu_key]
+    values = tuple(settings.get(field) for field in fields)
+    key = (menu_key, values)
+    cached = menu_cache.get(key)
+    if cached is not None:
+        menu_cache.move_to_end(key)
+        menu_cache_stats["hits"] += 1
+        return cached
+    menu_cache_stats["misses"] += 1
+    cached = menu_cache[key] = renderer({field: value for field, value in zip(fields, values) if value is not None})
+    if len(menu_cache) > MENU_CACHE_MAX:
+        menu_cache.popitem(last=False)
+    return cached
+
+def render_toggle_menu(setting_name, display_name, back_menu, curr_val):
+    key = ("toggle", setting_name, back_menu, curr_val)
+    cached = menu_cache.get(key)
+    if cached is not None:
+        menu_cache_stats["hits"] += 1
+        return cached
+    menu_cache_stats["misses"] += 1
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"✅ Включить{'  ◀' if curr_val == 'true' else ''}", callback_data=f"toggle_{setting_name}_true")],
+        [InlineKeyboardButton(f"❌ Выключить{'  ◀' if curr_val == 'false' else ''}", callback_data=f"toggle_{setting_name}_false")],
+        [InlineKeyboardButton("🔙 Назад", callback_data=back_menu)]
     ])
+    cached = menu_cache[key] = (f"{display_name}:", keyboard)
+    if len(menu_cache) > MENU_CACHE_MAX:
+        menu_cache.popitem(last=False)
+    return cached
 
 async def edit_menu(bot, chat_id, message_id, text, keyboard):
     try:
@@ -444,39 +2822,163 @@ async def start(update, context: ContextTypes.DEFAULT_TYPE):
     if user_id not in user_settings:
         user_settings[user_id] = get_default_settings()
     user_states[user_id] = None
-    user_creating_server[user_id] = False
-    keyboard = [[InlineKeyboardButton("📋 Меню", callback_data="action_menu")]]
-    await update.message.reply_text(
-        "🎮 Minecraft Server Builder\n\n"
-        "✨ Поддерживаются загрузчики: Fabric, Forge\n\n"
-        "Бот создаёт готовые архивы сервера Minecraft.\n"
-        "Настройте конфигурацию или выберите шаблон -\n"
-        "и сервер будет собран автоматически.",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+    await release_build_lock(user_id)
+    await update.message.reply_text(MAIN_MENU_TEXT, reply_markup=MAIN_MENU_KEYBOARD)
+
+def format_stats():
+    lookups = jar_cache_stats["hits"] + jar_cache_stats["misses"]
+    hit_rate = jar_cache_stats["hits"] / lookups * 100 if lookups else 0
+    return (
+        f"📊 Статистика\n\n"
+        f"📦 Кэш ядер: {jar_cache_stats['hits']} попаданий / {jar_cache_stats['misses']} промахов ({hit_rate:.0f}%)\n"
+        f"🗂️ Записей: {len(jar_cache_index)}, вытеснено: {jar_cache_stats['evictions']}, "
+        f"из общего индекса: {jar_cache_stats['shared']}\n"
+        f"💾 Сэкономлено трафика: {jar_cache_stats['bytes_saved'] // (1024*1024)} MB\n"
+        f"⏱️ Сэкономлено времени загрузки: {jar_cache_stats['seconds_saved']:.0f} с\n"
+        f"🌐 Скачано с upstream: {jar_cache_stats['bytes_downloaded'] // (1024*1024)} MB "
+        f"(по сети {download_stats['bytes_transferred'] // (1024*1024)} MB, докачек {download_stats['resumed']}, "
+        f"повторно использовано {download_stats['bytes_reused'] // (1024*1024)} MB, "
+        f"перезапусков {download_stats['restarts']}, по сегментам {download_stats['segmented']}, "
+        f"ошибок сегментов {download_stats['segment_errors']})\n"
+        f"🪞 Зеркала: {download_stats['hedged']} хедж-запросов, проверено контрольных сумм "
+        f"{download_stats['verified']}, несовпадений {download_stats['checksum_failures']}, "
+        f"отклонено без суммы {download_stats['unverified']}"
+        f"{format_mirror_stats()}\n"
+        f"🛡️ Устойчивость: {resilience_stats['retries']} повторов, {resilience_stats['retry_after']} по Retry-After, "
+        f"{resilience_stats['fail_fast']} быстрых отказов, {resilience_stats['served_from_cache']} из кэша при сбое"
+        f"{format_breakers()}\n"
+        f"📏 Прогноз размера: {prediction_stats['rejected']} отклонено до загрузки, "
+        f"{prediction_stats['probed']} HEAD-проб, {prediction_stats['missed']} промахов, "
+        f"известно {len(size_predictions)} сборок\n"
+        f"🗜️ Сжатие ядер: {compression_stats['stored']} без сжатия, {compression_stats['fast']} быстрое, "
+        f"{compression_stats['full']} полное; CPU {compression_stats['cpu_spent']:.1f} с, "
+        f"сэкономлено ~{compression_stats['cpu_saved']:.1f} с\n"
+        f"🧱 Базовые архивы: {base_archive_stats['hits']} из кэша, {base_archive_stats['built']} собрано, "
+        f"сборка {base_archive_stats['assemble_seconds'] / max(1, base_archive_stats['hits'] + base_archive_stats['built']) * 1000:.0f} мс в среднем\n"
+        f"📨 Отправка: {file_id_stats['hits']} по file_id, {file_id_stats['uploads']} загрузок, "
+        f"сэкономлено {file_id_stats['bytes_saved'] // (1024*1024)} MB\n"
+        f"🏗️ Сборки: {build_stats['active']} активных, {build_queue_size()} в очереди, "
+        f"{build_stats['completed']} готово, {build_stats['rejected']} отклонено, "
+        f"в среднем {build_stats['avg_seconds']:.0f} с\n"
+        f"✏️ Прогресс: {progress_stats['sent']} правок из {progress_stats['requested']} обновлений, "
+        f"{progress_stats['skipped']} без изменений, {progress_stats['retry_after']} RetryAfter\n"
+        f"📬 Исходящие: {outbound_stats['sent']} запросов, очередь {outbound_stats['queue_depth']} "
+        f"(макс. {outbound_stats['max_queue_depth']}), ожидание в среднем "
+        f"{outbound_stats['total_wait'] / max(1, outbound_stats['sent']) * 1000:.0f} мс, "
+        f"макс. {outbound_stats['max_wait']:.1f} с, 429: {outbound_stats['retry_after']}\n"
+        f"🔗 Загрузок ядер: {jar_flight_stats['started']}, объединено запросов: {jar_flight_stats['coalesced']}\n"
+        f"🪝 Webhook: {webhook_stats['received']} обновлений, {webhook_stats['rejected']} отклонено, "
+        f"{webhook_stats['malformed']} битых\n"
+        f"🔥 Прогрев: {warm_stats['cycles']} циклов, {warm_stats['prefetched']} скачано, "
+        f"{warm_stats['already_warm']} уже в кэше, {warm_stats['failed']} ошибок, "
+        f"{warm_stats['bytes'] // (1024*1024)} MB, пауза {warm_stats['throttled_seconds']:.0f} с\n"
+        f"🧾 Метаданные: {meta_cache_stats['fresh']} свежих, {meta_cache_stats['stale']} устаревших, "
+        f"{meta_cache_stats['revalidated']} 304, {meta_cache_stats['fetched']} загрузок, "
+        f"{meta_cache_stats['shared']} от других реплик\n"
+        f"🧭 Кнопки: {sum(e['count'] for e in callback_latency.values())} нажатий, "
+        f"{callback_stats['unrouted']} без маршрута, меню из кэша {menu_cache_stats['hits']}, "
+        f"отрисовано {menu_cache_stats['misses']}"
+        f"{format_callback_latency()}"
     )
 
+def format_mirror_stats():
+    lines = ""
+    for base, entry in sorted(mirror_stats.items(), key=lambda item: item[1]["ewma"]):
+        lines += (
+            f"\n  • {urlparse(base).netloc}{urlparse(base).path}: ~{entry['ewma'] * 1000:.0f} мс, "
+            f"первым {entry['wins']}, обогнан {entry['lost']}, ошибок {entry['errors']}"
+        )
+    return lines
+
+def format_breakers():
+    names = {"closed": "норма", "open": "разомкнут", "half_open": "пробный запрос"}
+    lines = ""
+    for host, breaker in sorted(host_breakers.items()):
+        if breaker["state"] == "closed" and not breaker["opened"]:
+            continue
+        lines += (
+            f"\n  • {host}: {names[breaker['state']]}, ошибок подряд {breaker['failures']}, "
+            f"размыкался {breaker['opened']}×, отклонено {breaker['rejected']}"
+        )
+        if breaker["state"] == "open":
+            lines += f", ещё {max(0, breaker['until'] - time.monotonic()):.0f} с"
+    return lines
+
+def format_callback_latency():
+    slowest = sorted(callback_latency.items(), key=lambda item: item[1]["total"] / item[1]["count"], reverse=True)[:5]
+    lines = ""
+    for route, entry in slowest:
+        lines += (
+            f"\n  • {route}: {entry['count']}×, в среднем {entry['total'] / entry['count'] * 1000:.0f} мс, "
+            f"p95 ≤ {callback_latency_quantile(entry, 0.95) * 1000:.0f} мс"
+        )
+    return lines
+
+async def stats_command(update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    await update.message.reply_text(format_stats())
+
 async def show_action_menu(query):
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("📦 Быстрые шаблоны", callback_data="presets_menu")],
-        [InlineKeyboardButton("🛠️ Конфигурация", callback_data="config_menu")],
-        [InlineKeyboardButton("☕ Java - инструкция", callback_data="java_info")],
-        [InlineKeyboardButton("📖 Помощь", callback_data="help_menu")],
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-    ])
-    await query.edit_message_text("📋 Выберите действие:", reply_markup=keyboard)
+    await query.edit_message_text("📋 Выберите действие:", reply_markup=ACTION_MENU_KEYBOARD)
 
 async def show_config_menu(query, user_id):
-    curr = user_settings.get(user_id, get_default_settings())
-    summary = format_config_summary(curr)
-    await query.edit_message_text(
-        f"🛠️ Конфигурация сервера\n\n{summary}",
-        reply_markup=build_config_keyboard()
-    )
+    text, keyboard = render_menu("config_menu", user_settings.get(user_id, get_default_settings()))
+    await query.edit_message_text(text, reply_markup=keyboard)
     user_menu_message[user_id] = {
         "chat_id": query.message.chat_id,
         "message_id": query.message.message_id
     }
 
+def callback_route(*names, prefix=None):
+    def register(handler):
+        for name in names:
+            callback_routes[name] = handler
+        if prefix is not None:
+            node = callback_prefix_trie
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node[None] = (prefix + "*", handler)
+        return handler
+    return register
+
+def resolve_callback(data):
+    handler = callback_routes.get(data)
+    if handler is not None:
+        return data, handler
+    match = (None, None)
+    node = callback_prefix_trie
+    for ch in data:
+        node = node.get(ch)
+        if node is None:
+            break
+        if None in node:
+            match = node[None]
+    return match
+
+def record_callback_latency(route, seconds):
+    entry = callback_latency.get(route)
+    if entry is None:
+        entry = callback_latency[route] = {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * (len(CALLBACK_LATENCY_BUCKETS) + 1)}
+    entry["count"] += 1
+    entry["total"] += seconds
+    entry["max"] = max(entry["max"], seconds)
+    for i, bound in enumerate(CALLBACK_LATENCY_BUCKETS):
+        if seconds <= bound:
+            entry["buckets"][i] += 1
+            break
+    else:
+        entry["buckets"][-1] += 1
+
+def callback_latency_quantile(entry, q):
+    target = entry["count"] * q
+    seen = 0
+    for i, count in enumerate(entry["buckets"]):
+        seen += count
+        if seen >= target and count:
+            return CALLBACK_LATENCY_BUCKETS[i] if i < len(CALLBACK_LATENCY_BUCKETS) else entry["max"]
+    return entry["max"]
+
 async def button_handler(update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -486,500 +2988,291 @@ async def button_handler(update, context: ContextTypes.DEFAULT_TYPE):
     if user_id not in user_settings:
         user_settings[user_id] = get_default_settings()
 
-    if data == "main_menu":
-        user_states[user_id] = None
-        user_menu_message.pop(user_id, None)
-        await query.edit_message_text(
-            "🎮 Minecraft Server Builder\n\n"
-            "✨ Поддерживаются загрузчики: Fabric, Forge\n\n"
-            "Бот создаёт готовые архивы сервера Minecraft.\n"
-            "Настройте конфигурацию или выберите шаблон -\n"
-            "и сервер будет собран автоматически.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📋 Меню", callback_data="action_menu")]])
-        )
+    route, handler = resolve_callback(data)
+    if handler is None:
+        callback_stats["unrouted"] += 1
+        return
+    started = time.monotonic()
+    try:
+        await handler(query, context, user_id, data)
+    finally:
+        record_callback_latency(route, time.monotonic() - started)
 
-    elif data == "action_menu":
-        user_states[user_id] = None
-        user_menu_message.pop(user_id, None)
+@callback_route("main_menu")
+async def _cb_main_menu(query, context, user_id, data):
+    user_states[user_id] = None
+    user_menu_message.pop(user_id, None)
+    await query.edit_message_text(MAIN_MENU_TEXT, reply_markup=MAIN_MENU_KEYBOARD)
+
+@callback_route("action_menu")
+async def _cb_action_menu(query, context, user_id, data):
+    user_states[user_id] = None
+    user_menu_message.pop(user_id, None)
+    await show_action_menu(query)
+
+# ───────────────── JAVA ─────────────────
+@callback_route("java_info")
+async def _cb_java_info(query, context, user_id, data):
+    user_menu_message.pop(user_id, None)
+    text = (
+        "☕ Java для Minecraft\n\n"
+        "Minecraft 1.21+      →  Java 21\n"
+        "Minecraft 1.18–1.20  →  Java 17\n"
+        "Minecraft 1.17       →  Java 16\n"
+        "Minecraft 1.7–1.16   →  Java 8\n\n"
+        "Скачать Java (Eclipse Temurin - бесплатно, без рекламы):"
+    )
+    await query.edit_message_text(text, reply_markup=JAVA_KEYBOARD)
+
+# ───────────────── ПОМОЩЬ ─────────────────
+@callback_route("help_menu")
+async def _cb_help_menu(query, context, user_id, data):
+    user_menu_message.pop(user_id, None)
+    await query.edit_message_text("📖 Помощь - выберите раздел:", reply_markup=HELP_KEYBOARD)
+
+@callback_route("help_errors")
+async def _cb_help_errors(query, context, user_id, data):
+    text = (
+        "❌ Частые ошибки\n\n"
+        "«java» не является командой\n"
+        "→ Java не установлена или не добавлена в PATH. Установите Java и перезапустите терминал.\n\n"
+        "Error: Could not find or load main class\n"
+        "→ Скорее всего не та версия Java. Проверьте - какая нужна для вашей версии Minecraft.\n\n"
+        "Forge не поддерживает эту версию\n"
+        "→ Forge есть не для каждой версии. Попробуйте соседнюю (например 1.20.1 вместо 1.20.3).\n\n"
+    )
+    await query.edit_message_text(text, reply_markup=BACK_TO_HELP_KEYBOARD)
+
+@callback_route("help_tips")
+async def _cb_help_tips(query, context, user_id, data):
+    text = (
+        "💡 Советы\n\n"
+        "RAM\n"
+        "→ Для обычного сервера хватает 4GB. Если играете с модами - берите от 6GB.\n\n"
+        "Fabric vs Forge\n"
+        "→ Fabric быстрее и легче, хорош для новых версий. Forge нужен для больших модпаков и старых версий.\n\n"
+        "Online Mode (проверка лицензии)\n"
+        "→ Если играете с пиратками - выключите. Если все с лицензией - лучше оставить включённым, иначе любой зайдёт под чужим ником.\n\n"
+        "Прорисовка\n"
+        "→ Чем меньше - тем легче серверу. На слабых машинах ставьте 6–8 чанков.\n\n"
+        "Сид\n"
+        "→ Можно оставить пустым - мир сгенерируется случайно. Или ввести любое число/слово для конкретного мира."
+    )
+    await query.edit_message_text(text, reply_markup=BACK_TO_HELP_KEYBOARD)
+
+@callback_route("help_connect")
+async def _cb_help_connect(query, context, user_id, data):
+    text = (
+        "🌐 Как подключиться к серверу\n\n"
+        "Локальная сеть (один роутер)\n"
+        "→ Узнайте локальный IP компьютера (ipconfig в консоли (cmd) на Windows, ip на Linux). В Minecraft вводите этот IP и порт, например: 192.168.1.5:25565. Или попробуйте 127.0.1\n\n"
+        "Через интернет\n"
+        "→ Нужен внешний IP (можно узнать на 2ip.ru). Также нужно пробросить порт 25565 в настройках роутера (раздел Port Forwarding)."
+    )
+    await query.edit_message_text(text, reply_markup=BACK_TO_HELP_KEYBOARD)
+
+# ───────────────── ПРЕСЕТЫ ─────────────────
+@callback_route("presets_menu")
+async def _cb_presets_menu(query, context, user_id, data):
+    user_menu_message.pop(user_id, None)
+    await query.edit_message_text(
+        "📦 Быстрые шаблоны\n\n"
+        "Выберите готовый пресет - настройки применятся автоматически.",
+        reply_markup=PRESETS_KEYBOARD
+    )
+
+@callback_route(prefix="preset_")
+async def _cb_preset(query, context, user_id, data):
+    card = PRESET_CARDS.get(data)
+    if not card:
         await show_action_menu(query)
+        return
+    info, keyboard = card
+    await query.edit_message_text(info, reply_markup=keyboard)
+
+@callback_route(prefix="apply_create_preset_")
+async def _cb_apply_create_preset(query, context, user_id, data):
+    preset_id = data.replace("apply_create_", "")
+    preset = PRESETS.get(preset_id)
+    if preset:
+        user_settings[user_id] = Settings(preset_id)
+    await _start_build(user_id, query, context)
+
+@callback_route(prefix="apply_edit_preset_")
+async def _cb_apply_edit_preset(query, context, user_id, data):
+    preset_id = data.replace("apply_edit_", "")
+    preset = PRESETS.get(preset_id)
+    if preset:
+        user_settings[user_id] = Settings(preset_id)
+    await show_config_menu(query, user_id)
+
+@callback_route("config_menu")
+async def _cb_config_menu(query, context, user_id, data):
+    user_states[user_id] = None
+    await show_config_menu(query, user_id)
 
-    # ───────────────── JAVA ─────────────────
-    elif data == "java_info":
-        user_menu_message.pop(user_id, None)
-        text = (
-            "☕ Java для Minecraft\n\n"
-            "Minecraft 1.21+      →  Java 21\n"
-            "Minecraft 1.18–1.20  →  Java 17\n"
-            "Minecraft 1.17       →  Java 16\n"
-            "Minecraft 1.7–1.16   →  Java 8\n\n"
-            "Скачать Java (Eclipse Temurin - бесплатно, без рекламы):"
-        )
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("☕ Java 21", url="https://adoptium.net/temurin/releases/?version=21")],
-            [InlineKeyboardButton("☕ Java 17", url="https://adoptium.net/temurin/releases/?version=17")],
-            [InlineKeyboardButton("☕ Java 8",  url="https://adoptium.net/temurin/releases/?version=8")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="action_menu")]
-        ])
-        await query.edit_message_text(text, reply_markup=keyboard)
-
-    # ───────────────── ПОМОЩЬ ─────────────────
-    elif data == "help_menu":
-        user_menu_message.pop(user_id, None)
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("❌ Частые ошибки", callback_data="help_errors")],
-            [InlineKeyboardButton("💡 Советы", callback_data="help_tips")],
-            [InlineKeyboardButton("🌐 Как подключиться к серверу", callback_data="help_connect")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="action_menu")]
-        ])
-        await query.edit_message_text("📖 Помощь - выберите раздел:", reply_markup=keyboard)
-
-    elif data == "help_errors":
-        text = (
-            "❌ Частые ошибки\n\n"
-            "«java» не является командой\n"
-            "→ Java не установлена или не добавлена в PATH. Установите Java и перезапустите терминал.\n\n"
-            "Error: Could not find or load main class\n"
-            "→ Скорее всего не та версия Java. Проверьте - какая нужна для вашей версии Minecraft.\n\n"
-            "Forge не поддерживает эту версию\n"
-            "→ Forge есть не для каждой версии. Попробуйте соседнюю (например 1.20.1 вместо 1.20.3).\n\n"
-        )
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="help_menu")]])
-        await query.edit_message_text(text, reply_markup=keyboard)
+@callback_route("cfg_version_loader", "cfg_players_mode", "cfg_world", "cfg_performance", "cfg_security")
+async def _cb_cfg_submenu(query, context, user_id, data):
+    user_states[user_id] = None
+    text, keyboard = render_menu(data, user_settings.get(user_id, get_default_settings()))
+    await query.edit_message_text(text, reply_markup=keyboard)
+    user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
 
-    elif data == "help_tips":
-        text = (
-            "💡 Советы\n\n"
-            "RAM\n"
-            "→ Для обычного сервера хватает 4GB. Если играете с модами - берите от 6GB.\n\n"
-            "Fabric vs Forge\n"
-            "→ Fabric быстрее и легче, хорош для новых версий. Forge нужен для больших модпаков и старых версий.\n\n"
-            "Online Mode (проверка лицензии)\n"
-            "→ Если играете с пиратками - выключите. Если все с лицензией - лучше оставить включённым, иначе любой зайдёт под чужим ником.\n\n"
-            "Прорисовка\n"
-            "→ Чем меньше - тем легче серверу. На слабых машинах ставьте 6–8 чанков.\n\n"
-            "Сид\n"
-            "→ Можно оставить пустым - мир сгенерируется случайно. Или ввести любое число/слово для конкретного мира."
-        )
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="help_menu")]])
-        await query.edit_message_text(text, reply_markup=keyboard)
+@callback_route("set_version")
+async def _cb_set_version(query, context, user_id, data):
+    await query.edit_message_text("🎯 Выберите версию Minecraft:\n\n💾 = Меньше размер архива\n✅ = Рекомендуется\n⚠️ Fabric доступен только с 1.14+", reply_markup=VERSION_KEYBOARD)
+    user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
 
-    elif data == "help_connect":
-        text = (
-            "🌐 Как подключиться к серверу\n\n"
-            "Локальная сеть (один роутер)\n"
-            "→ Узнайте локальный IP компьютера (ipconfig в консоли (cmd) на Windows, ip на Linux). В Minecraft вводите этот IP и порт, например: 192.168.1.5:25565. Или попробуйте 127.0.1\n\n"
-            "Через интернет\n"
-            "→ Нужен внешний IP (можно узнать на 2ip.ru). Также нужно пробросить порт 25565 в настройках роутера (раздел Port Forwarding)."
-        )
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="help_menu")]])
-        await query.edit_message_text(text, reply_markup=keyboard)
+@callback_route("set_loader")
+async def _cb_set_loader(query, context, user_id, data):
+    version = user_settings[user_id].get('version', '1.20.1')
+    fabric_ok = is_fabric_supported(version)
+    await query.edit_message_text(
+        f"⚡ Выберите загрузчик:\n\nТекущая версия: {version}\n"
+        f"{'✅ Fabric поддерживается' if fabric_ok else '❌ Fabric не поддерживает версии ниже 1.14'}",
+        reply_markup=LOADER_KEYBOARDS[fabric_ok]
+    )
+    user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
 
-    # ───────────────── ПРЕСЕТЫ ─────────────────
-    elif data == "presets_menu":
-        user_menu_message.pop(user_id, None)
-        keyboard = []
-        for preset_id, preset in PRESETS.items():
-            keyboard.append([InlineKeyboardButton(preset["name"], callback_data=preset_id)])
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="action_menu")])
-        await query.edit_message_text(
-            "📦 Быстрые шаблоны\n\n"
-            "Выберите готовый пресет - настройки применятся автоматически.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+@callback_route("set_ram")
+async def _cb_set_ram(query, context, user_id, data):
+    await query.edit_message_text("💾 Выберите объём оперативной памяти:\n\n✅ = Рекомендуется для большинства серверов", reply_markup=RAM_KEYBOARD)
+    user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
 
-    elif data.startswith("preset_") and not data.startswith("apply_"):
-        preset = PRESETS.get(data)
-        if not preset:
-            await show_action_menu(query)
-            return
-        s = preset["settings"]
-        difficulty_names = {"peaceful": "Мирная", "easy": "Лёгкая", "normal": "Обычная", "hard": "Тяжёлая"}
-        gamemode_names = {"survival": "Выживание", "creative": "Творческий", "adventure": "Приключение", "spectator": "Наблюдатель"}
-        info = (
-            f"{preset['name']}\n"
-            f"{preset['desc']}\n\n"
-            f"🎯 Версия: {s['version']}\n"
-            f"⚡ Загрузчик: {s['loader']}\n"
-            f"💾 Память: {s['ram']} MB\n"
-            f"👥 Игроков: {s['max_players']}\n"
-            f"⚔️ Сложность: {difficulty_names.get(s['difficulty'], s['difficulty'])}\n"
-            f"🎮 Режим: {gamemode_names.get(s['gamemode'], s['gamemode'])}\n"
-            f"💀 Хардкор: {'Да' if s['hardcore'] == 'true' else 'Нет'}\n"
-            f"📋 Вайтлист: {'Да' if s['whitelist'] == 'true' else 'Нет'}"
-        )
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ Применить и создать сервер", callback_data=f"apply_create_{data}")],
-            [InlineKeyboardButton("🛠️ Применить и настроить", callback_data=f"apply_edit_{data}")],
-            [InlineKeyboardButton("🔙 Назад к шаблонам", callback_data="presets_menu")]
-        ])
-        await query.edit_message_text(info, reply_markup=keyboard)
-
-    elif data.startswith("apply_create_preset_"):
-        preset_id = data.replace("apply_create_", "")
-        preset = PRESETS.get(preset_id)
-        if preset:
-            user_settings[user_id] = dict(preset["settings"])
-        if user_creating_server.get(user_id, False):
-            await query.answer("⚠️ Сервер уже создаётся!", show_alert=True)
-            return
-        user_creating_server[user_id] = True
-        msg = await query.edit_message_text("⏳ Запуск...")
-        await _do_create_server(user_id, msg, query, context)
-
-    elif data.startswith("apply_edit_preset_"):
-        preset_id = data.replace("apply_edit_", "")
-        preset = PRESETS.get(preset_id)
-        if preset:
-            user_settings[user_id] = dict(preset["settings"])
-        await show_config_menu(query, user_id)
-
-    elif data == "config_menu":
-        user_states[user_id] = None
-        await show_config_menu(query, user_id)
-
-    elif data == "cfg_version_loader":
-        user_states[user_id] = None
-        curr = user_settings.get(user_id, get_default_settings())
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"🎯 Версия: {curr.get('version', '1.20.1')}", callback_data="set_version")],
-            [InlineKeyboardButton(f"⚡ Загрузчик: {curr.get('loader', 'Fabric')}", callback_data="set_loader")],
-            [InlineKeyboardButton(f"💾 Память: {curr.get('ram', '2048')} MB", callback_data="set_ram")],
-            [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
-        ])
-        await query.edit_message_text(
-            "🎯 Версия и загрузчик\n\n⚠️ Fabric доступен только с версии 1.14 и выше.",
-            reply_markup=keyboard
-        )
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "cfg_players_mode":
-        user_states[user_id] = None
-        curr = user_settings.get(user_id, get_default_settings())
-        difficulty_names = {"peaceful": "Мирная", "easy": "Лёгкая", "normal": "Обычная", "hard": "Тяжёлая"}
-        gamemode_names = {"survival": "Выживание", "creative": "Творческий", "adventure": "Приключение", "spectator": "Наблюдатель"}
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"👥 Макс. игроков: {curr.get('max_players', '20')}", callback_data="set_max_players")],
-            [InlineKeyboardButton(f"⚔️ Сложность: {difficulty_names.get(curr.get('difficulty','normal'), curr.get('difficulty','normal'))}", callback_data="set_difficulty")],
-            [InlineKeyboardButton(f"🎮 Режим игры: {gamemode_names.get(curr.get('gamemode','survival'), curr.get('gamemode','survival'))}", callback_data="set_gamemode")],
-            [InlineKeyboardButton(f"⚔️ PvP: {'Включено' if curr.get('pvp','true')=='true' else 'Выключено'}", callback_data="set_pvp")],
-            [InlineKeyboardButton(f"🔐 Проверка лицензии: {'Включена' if curr.get('online_mode','true')=='true' else 'Выключена'}", callback_data="set_online_mode")],
-            [InlineKeyboardButton(f"🌐 Порт: {curr.get('port', '25565')}", callback_data="set_port")],
-            [InlineKeyboardButton("📝 Описание сервера (MOTD)", callback_data="input_motd")],
-            [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
-        ])
-        await query.edit_message_text("👥 Игроки и режим игры:", reply_markup=keyboard)
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "cfg_world":
-        user_states[user_id] = None
-        curr = user_settings.get(user_id, get_default_settings())
-        level_type_names = {
-            "minecraft:normal": "Стандартный", "minecraft:flat": "Плоский",
-            "minecraft:large_biomes": "Большие биомы", "minecraft:amplified": "Усиленный"
-        }
-        def yn(v, t='true'): return "Да" if v == t else "Нет"
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"👁️ Прорисовка: {curr.get('view_distance','10')} чанков", callback_data="set_view_distance")],
-            [InlineKeyboardButton(f"🔮 Симуляция: {curr.get('simulation_distance','10')} чанков", callback_data="set_simulation_distance")],
-            [InlineKeyboardButton(f"🏰 Защита спавна: {curr.get('spawn_protection','16')} блоков", callback_data="set_spawn_protection")],
-            [InlineKeyboardButton(f"🔥 Незер: {yn(curr.get('allow_nether','true'))}", callback_data="set_nether")],
-            [InlineKeyboardButton(f"👹 Монстры: {yn(curr.get('spawn_monsters','true'))}", callback_data="set_monsters")],
-            [InlineKeyboardButton(f"🐷 Животные: {yn(curr.get('spawn_animals','true'))}", callback_data="set_animals")],
-            [InlineKeyboardButton(f"👨‍🌾 Жители (NPC): {yn(curr.get('spawn_npcs','true'))}", callback_data="set_npcs")],
-            [InlineKeyboardButton(f"🏛️ Структуры: {yn(curr.get('generate_structures','true'))}", callback_data="set_structures")],
-            [InlineKeyboardButton(f"🗺️ Тип мира: {level_type_names.get(curr.get('level_type','minecraft:normal'), curr.get('level_type','minecraft:normal'))}", callback_data="set_level_type")],
-            [InlineKeyboardButton(f"🌱 Сид: {curr.get('seed','') or 'Случайный'}", callback_data="input_seed")],
-            [InlineKeyboardButton(f"📐 Макс. размер мира: {curr.get('max_world_size','29999984')}", callback_data="set_max_world_size")],
-            [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
-        ])
-        await query.edit_message_text("🌍 Мир и генерация:", reply_markup=keyboard)
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "cfg_performance":
-        user_states[user_id] = None
-        curr = user_settings.get(user_id, get_default_settings())
-        tick = curr.get('max_tick_time', '60000')
-        tick_label = "Безлимит" if tick == '-1' else f"{tick} мс"
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"✈️ Полёт: {'Разрешён' if curr.get('allow_flight','false')=='true' else 'Запрещён'}", callback_data="set_flight")],
-            [InlineKeyboardButton(f"🎛️ Командные блоки: {'Включены' if curr.get('command_blocks','false')=='true' else 'Выключены'}", callback_data="set_cmd_blocks")],
-            [InlineKeyboardButton(f"⏱️ Макс. время тика: {tick_label}", callback_data="set_max_tick_time")],
-            [InlineKeyboardButton(f"📡 Дальность сущностей: {curr.get('entity_broadcast_range','100')}%", callback_data="set_entity_range")],
-            [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
-        ])
-        await query.edit_message_text("⚙️ Производительность:", reply_markup=keyboard)
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "cfg_security":
-        user_states[user_id] = None
-        curr = user_settings.get(user_id, get_default_settings())
-        idle = curr.get('player_idle_timeout', '0')
-        idle_label = f"{idle} мин" if idle != '0' else "Выключен"
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"💀 Хардкор: {'Включён' if curr.get('hardcore','false')=='true' else 'Выключен'}", callback_data="set_hardcore")],
-            [InlineKeyboardButton(f"📋 Белый список: {'Включён' if curr.get('whitelist','false')=='true' else 'Выключен'}", callback_data="set_whitelist")],
-            [InlineKeyboardButton(f"👑 Уровень прав оператора: {curr.get('op_permission_level','4')}", callback_data="set_op_level")],
-            [InlineKeyboardButton(f"💤 Тайм-аут AFK: {idle_label}", callback_data="set_idle_timeout")],
-            [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
-        ])
-        await query.edit_message_text("🔒 Безопасность:", reply_markup=keyboard)
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "set_version":
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("1.21.4", callback_data="version_1.21.4"), InlineKeyboardButton("1.21.3", callback_data="version_1.21.3")],
-            [InlineKeyboardButton("1.21.1", callback_data="version_1.21.1"), InlineKeyboardButton("1.21", callback_data="version_1.21")],
-            [InlineKeyboardButton("1.20.6", callback_data="version_1.20.6"), InlineKeyboardButton("1.20.4", callback_data="version_1.20.4")],
-            [InlineKeyboardButton("1.20.1 ✅", callback_data="version_1.20.1"), InlineKeyboardButton("1.19.4", callback_data="version_1.19.4")],
-            [InlineKeyboardButton("1.18.2", callback_data="version_1.18.2"), InlineKeyboardButton("1.16.5 💾", callback_data="version_1.16.5")],
-            [InlineKeyboardButton("1.12.2 💾", callback_data="version_1.12.2"), InlineKeyboardButton("1.8.8 💾", callback_data="version_1.8.8")],
-            [InlineKeyboardButton("1.7.10 💾", callback_data="version_1.7.10"), InlineKeyboardButton("✏️ Своя версия", callback_data="input_version")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="cfg_version_loader")]
-        ])
-        await query.edit_message_text(
-            "🎯 Выберите версию Minecraft:\n\n💾 = Меньше размер архива\n✅ = Рекомендуется\n⚠️ Fabric доступен только с 1.14+",
-            reply_markup=keyboard
-        )
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "set_loader":
-        version = user_settings[user_id].get('version', '1.20.1')
-        fabric_ok = is_fabric_supported(version)
-        rows = []
-        if fabric_ok:
-            rows.append([InlineKeyboardButton("Fabric 💾 (рекомендуется для новых версий)", callback_data="loader_fabric")])
-        else:
-            rows.append([InlineKeyboardButton("⚠️ Fabric недоступен для этой версии", callback_data="loader_fabric_blocked")])
-        rows.append([InlineKeyboardButton("Forge (поддерживает все версии)", callback_data="loader_forge")])
-        rows.append([InlineKeyboardButton("🔙 Назад", callback_data="cfg_version_loader")])
-        await query.edit_message_text(
-            f"⚡ Выберите загрузчик:\n\nТекущая версия: {version}\n"
-            f"{'✅ Fabric поддерживается' if fabric_ok else '❌ Fabric не поддерживает версии ниже 1.14'}",
-            reply_markup=InlineKeyboardMarkup(rows)
-        )
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "set_ram":
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("512 MB", callback_data="ram_512"), InlineKeyboardButton("1 GB", callback_data="ram_1024")],
-            [InlineKeyboardButton("2 GB ✅", callback_data="ram_2048"), InlineKeyboardButton("4 GB", callback_data="ram_4096")],
-            [InlineKeyboardButton("8 GB", callback_data="ram_8192"), InlineKeyboardButton("16 GB", callback_data="ram_16384")],
-            [InlineKeyboardButton("✏️ Ввести вручную (MB)", callback_data="input_ram")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="cfg_version_loader")]
-        ])
-        await query.edit_message_text("💾 Выберите объём оперативной памяти:\n\n✅ = Рекомендуется для большинства серверов", reply_markup=keyboard)
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "set_max_players":
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("5", callback_data="maxplayers_5"), InlineKeyboardButton("10", callback_data="maxplayers_10")],
-            [InlineKeyboardButton("20 ✅", callback_data="maxplayers_20"), InlineKeyboardButton("50", callback_data="maxplayers_50")],
-            [InlineKeyboardButton("100", callback_data="maxplayers_100"), InlineKeyboardButton("200", callback_data="maxplayers_200")],
-            [InlineKeyboardButton("✏️ Ввести вручную", callback_data="input_maxplayers")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="cfg_players_mode")]
-        ])
-        await query.edit_message_text("👥 Максимальное количество игроков:", reply_markup=keyboard)
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "set_difficulty":
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("☮️ Мирная", callback_data="difficulty_peaceful")],
-            [InlineKeyboardButton("😊 Лёгкая", callback_data="difficulty_easy")],
-            [InlineKeyboardButton("😐 Обычная ✅", callback_data="difficulty_normal")],
-            [InlineKeyboardButton("😈 Тяжёлая", callback_data="difficulty_hard")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="cfg_players_mode")]
-        ])
-        await query.edit_message_text("⚔️ Сложность:", reply_markup=keyboard)
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "set_gamemode":
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("⛏️ Выживание ✅", callback_data="gamemode_survival")],
-            [InlineKeyboardButton("🎨 Творческий", callback_data="gamemode_creative")],
-            [InlineKeyboardButton("🗺️ Приключение", callback_data="gamemode_adventure")],
-            [InlineKeyboardButton("👻 Наблюдатель", callback_data="gamemode_spectator")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="cfg_players_mode")]
-        ])
-        await query.edit_message_text("🎮 Режим игры по умолчанию:", reply_markup=keyboard)
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "set_pvp":
-        await _toggle_menu(query, user_id, "pvp", "⚔️ PvP (бои между игроками)", "cfg_players_mode")
-    elif data == "set_online_mode":
-        await _toggle_menu(query, user_id, "online_mode", "🔐 Проверка лицензии (Online Mode)", "cfg_players_mode")
-    elif data == "set_nether":
-        await _toggle_menu(query, user_id, "allow_nether", "🔥 Незер", "cfg_world")
-    elif data == "set_monsters":
-        await _toggle_menu(query, user_id, "spawn_monsters", "👹 Спавн монстров", "cfg_world")
-    elif data == "set_animals":
-        await _toggle_menu(query, user_id, "spawn_animals", "🐷 Спавн животных", "cfg_world")
-    elif data == "set_npcs":
-        await _toggle_menu(query, user_id, "spawn_npcs", "👨‍🌾 Спавн жителей (NPC)", "cfg_world")
-    elif data == "set_structures":
-        await _toggle_menu(query, user_id, "generate_structures", "🏛️ Генерация структур", "cfg_world")
-    elif data == "set_flight":
-        await _toggle_menu(query, user_id, "allow_flight", "✈️ Полёт", "cfg_performance")
-    elif data == "set_cmd_blocks":
-        await _toggle_menu(query, user_id, "command_blocks", "🎛️ Командные блоки", "cfg_performance")
-    elif data == "set_hardcore":
-        await _toggle_menu(query, user_id, "hardcore", "💀 Хардкор режим", "cfg_security")
-    elif data == "set_whitelist":
-        await _toggle_menu(query, user_id, "whitelist", "📋 Белый список", "cfg_security")
-
-    elif data == "set_level_type":
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🌄 Стандартный ✅", callback_data="leveltype_minecraft:normal")],
-            [InlineKeyboardButton("🟫 Плоский", callback_data="leveltype_minecraft:flat")],
-            [InlineKeyboardButton("🌿 Большие биомы", callback_data="leveltype_minecraft:large_biomes")],
-            [InlineKeyboardButton("⛰️ Усиленный рельеф", callback_data="leveltype_minecraft:amplified")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="cfg_world")]
-        ])
-        await query.edit_message_text("🗺️ Тип генерации мира:", reply_markup=keyboard)
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "set_op_level":
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("1 - Обход защиты спавна", callback_data="oplevel_1")],
-            [InlineKeyboardButton("2 - Команды и блоки", callback_data="oplevel_2")],
-            [InlineKeyboardButton("3 - Управление игроками", callback_data="oplevel_3")],
-            [InlineKeyboardButton("4 - Полные права ✅", callback_data="oplevel_4")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="cfg_security")]
-        ])
-        await query.edit_message_text("👑 Уровень прав оператора:", reply_markup=keyboard)
-        user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
-
-    elif data == "set_port":
-        user_states[user_id] = ("input_port", "cfg_players_mode")
-        await _ask_input(query, context, user_id, "Введите порт сервера (1–65535):")
-    elif data == "set_view_distance":
-        user_states[user_id] = ("input_viewdist", "cfg_world")
-        await _ask_input(query, context, user_id, "Введите дальность прорисовки в чанках (2–32):")
-    elif data == "set_simulation_distance":
-        user_states[user_id] = ("input_simdist", "cfg_world")
-        await _ask_input(query, context, user_id, "Введите дальность симуляции в чанках (2–32):")
-    elif data == "set_spawn_protection":
-        user_states[user_id] = ("input_spawnprot", "cfg_world")
-        await _ask_input(query, context, user_id, "Введите радиус защиты спавна в блоках (0 = выключено):")
-    elif data == "set_max_world_size":
-        user_states[user_id] = ("input_max_world_size", "cfg_world")
-        await _ask_input(query, context, user_id, "Введите максимальный размер мира в блоках (мин. 1000):")
-    elif data == "set_max_tick_time":
-        user_states[user_id] = ("input_max_tick", "cfg_performance")
-        await _ask_input(query, context, user_id, "Введите макс. время тика в мс (60000 = стандарт, -1 = безлимит):")
-    elif data == "set_entity_range":
-        user_states[user_id] = ("input_entity_range", "cfg_performance")
-        await _ask_input(query, context, user_id, "Введите дальность трансляции сущностей в % (10–1000):")
-    elif data == "set_idle_timeout":
-        user_states[user_id] = ("input_idle_timeout", "cfg_security")
-        await _ask_input(query, context, user_id, "Введите тайм-аут AFK в минутах (0 = выключено):")
-    elif data == "input_version":
-        user_states[user_id] = ("input_version", "cfg_version_loader")
-        await _ask_input(query, context, user_id, "Введите версию Minecraft (например: 1.20.1):")
-    elif data == "input_ram":
-        user_states[user_id] = ("input_ram", "cfg_version_loader")
-        await _ask_input(query, context, user_id, "Введите объём RAM в MB (например: 2048):")
-    elif data == "input_maxplayers":
-        user_states[user_id] = ("input_maxplayers", "cfg_players_mode")
-        await _ask_input(query, context, user_id, "Введите максимальное количество игроков:")
-    elif data == "input_motd":
-        user_states[user_id] = ("input_motd", "cfg_players_mode")
-        await _ask_input(query, context, user_id, "Введите описание сервера (MOTD):")
-    elif data == "input_seed":
-        user_states[user_id] = ("input_seed", "cfg_world")
-        await _ask_input(query, context, user_id, "Введите сид мира (или отправьте - для случайного):")
-
-    elif data == "loader_fabric_blocked":
-        await query.answer("❌ Fabric недоступен для версий ниже 1.14. Выберите Forge или смените версию.", show_alert=True)
-
-    elif data.startswith("version_"):
-        user_settings[user_id]["version"] = data[len("version_"):]
-        info = user_menu_message.get(user_id)
-        if info:
-            curr = user_settings.get(user_id, get_default_settings())
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"🎯 Версия: {curr.get('version', '1.20.1')}", callback_data="set_version")],
-                [InlineKeyboardButton(f"⚡ Загрузчик: {curr.get('loader', 'Fabric')}", callback_data="set_loader")],
-                [InlineKeyboardButton(f"💾 Память: {curr.get('ram', '2048')} MB", callback_data="set_ram")],
-                [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
-            ])
-            await edit_menu(context.bot, info["chat_id"], info["message_id"],
-                            "🎯 Версия и загрузчик\n\n⚠️ Fabric доступен только с версии 1.14 и выше.", keyboard)
-
-    elif data.startswith("loader_") and data != "loader_fabric_blocked":
-        loader_val = data[len("loader_"):].capitalize()
-        if loader_val.lower() == "fabric" and not is_fabric_supported(user_settings[user_id].get("version", "1.20.1")):
-            await query.answer("❌ Fabric не поддерживает версии ниже 1.14!", show_alert=True)
-            return
-        user_settings[user_id]["loader"] = loader_val
-        info = user_menu_message.get(user_id)
-        if info:
-            curr = user_settings.get(user_id, get_default_settings())
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"🎯 Версия: {curr.get('version', '1.20.1')}", callback_data="set_version")],
-                [InlineKeyboardButton(f"⚡ Загрузчик: {curr.get('loader', 'Fabric')}", callback_data="set_loader")],
-                [InlineKeyboardButton(f"💾 Память: {curr.get('ram', '2048')} MB", callback_data="set_ram")],
-                [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
-            ])
-            await edit_menu(context.bot, info["chat_id"], info["message_id"],
-                            "🎯 Версия и загрузчик\n\n⚠️ Fabric доступен только с версии 1.14 и выше.", keyboard)
-
-    elif data.startswith("ram_"):
-        user_settings[user_id]["ram"] = data[len("ram_"):]
-        info = user_menu_message.get(user_id)
-        if info:
-            curr = user_settings.get(user_id, get_default_settings())
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"🎯 Версия: {curr.get('version', '1.20.1')}", callback_data="set_version")],
-                [InlineKeyboardButton(f"⚡ Загрузчик: {curr.get('loader', 'Fabric')}", callback_data="set_loader")],
-                [InlineKeyboardButton(f"💾 Память: {curr.get('ram', '2048')} MB", callback_data="set_ram")],
-                [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
-            ])
-            await edit_menu(context.bot, info["chat_id"], info["message_id"],
-                            "🎯 Версия и загрузчик\n\n⚠️ Fabric доступен только с версии 1.14 и выше.", keyboard)
-
-    elif data.startswith("maxplayers_"):
-        user_settings[user_id]["max_players"] = data[len("maxplayers_"):]
-        await _refresh_submenu(context.bot, user_id, "cfg_players_mode")
-
-    elif data.startswith("difficulty_"):
-        user_settings[user_id]["difficulty"] = data[len("difficulty_"):]
-        await _refresh_submenu(context.bot, user_id, "cfg_players_mode")
-
-    elif data.startswith("gamemode_"):
-        user_settings[user_id]["gamemode"] = data[len("gamemode_"):]
-        await _refresh_submenu(context.bot, user_id, "cfg_players_mode")
-
-    elif data.startswith("toggle_"):
-        parts = data[len("toggle_"):].rsplit("_", 1)
-        setting_name = parts[0]
-        value = parts[1]
-        user_settings[user_id][setting_name] = value
-        back_map = {
-            "allow_nether": "cfg_world", "spawn_monsters": "cfg_world",
-            "spawn_animals": "cfg_world", "spawn_npcs": "cfg_world",
-            "generate_structures": "cfg_world",
-            "allow_flight": "cfg_performance", "command_blocks": "cfg_performance",
-            "hardcore": "cfg_security", "whitelist": "cfg_security",
-            "pvp": "cfg_players_mode", "online_mode": "cfg_players_mode"
-        }
-        await _refresh_submenu(context.bot, user_id, back_map.get(setting_name, "config_menu"))
+@callback_route("set_max_players")
+async def _cb_set_max_players(query, context, user_id, data):
+    await query.edit_message_text("👥 Максимальное количество игроков:", reply_markup=MAX_PLAYERS_KEYBOARD)
+    user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
 
-    elif data.startswith("leveltype_"):
-        user_settings[user_id]["level_type"] = data[len("leveltype_"):]
-        await _refresh_submenu(context.bot, user_id, "cfg_world")
+@callback_route("set_difficulty")
+async def _cb_set_difficulty(query, context, user_id, data):
+    await query.edit_message_text("⚔️ Сложность:", reply_markup=DIFFICULTY_KEYBOARD)
+    user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
 
-    elif data.startswith("oplevel_"):
-        user_settings[user_id]["op_permission_level"] = data[len("oplevel_"):]
-        await _refresh_submenu(context.bot, user_id, "cfg_security")
+@callback_route("set_gamemode")
+async def _cb_set_gamemode(query, context, user_id, data):
+    await query.edit_message_text("🎮 Режим игры по умолчанию:", reply_markup=GAMEMODE_KEYBOARD)
+    user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
 
-    elif data == "create_server":
-        if user_creating_server.get(user_id, False):
-            await query.answer("⚠️ Сервер уже создаётся!", show_alert=True)
-            return
+@callback_route("set_level_type")
+async def _cb_set_level_type(query, context, user_id, data):
+    await query.edit_message_text("🗺️ Тип генерации мира:", reply_markup=LEVEL_TYPE_KEYBOARD)
+    user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
+
+@callback_route("set_op_level")
+async def _cb_set_op_level(query, context, user_id, data):
+    await query.edit_message_text("👑 Уровень прав оператора:", reply_markup=OP_LEVEL_KEYBOARD)
+    user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
+
+@callback_route("loader_fabric_blocked")
+async def _cb_loader_fabric_blocked(query, context, user_id, data):
+    await query.answer("❌ Fabric недоступен для версий ниже 1.14. Выберите Forge или смените версию.", show_alert=True)
+
+@callback_route(prefix="version_")
+async def _cb_version(query, context, user_id, data):
+    user_settings[user_id]["version"] = data[len("version_"):]
+    await _refresh_submenu(context.bot, user_id, "cfg_version_loader")
+
+@callback_route(prefix="loader_")
+async def _cb_loader(query, context, user_id, data):
+    loader_val = data[len("loader_"):].capitalize()
+    if loader_val.lower() == "fabric" and not is_fabric_supported(user_settings[user_id].get("version", "1.20.1")):
+        await query.answer("❌ Fabric не поддерживает версии ниже 1.14!", show_alert=True)
+        return
+    user_settings[user_id]["loader"] = loader_val
+    await _refresh_submenu(context.bot, user_id, "cfg_version_loader")
+
+@callback_route(prefix="ram_")
+async def _cb_ram(query, context, user_id, data):
+    user_settings[user_id]["ram"] = data[len("ram_"):]
+    await _refresh_submenu(context.bot, user_id, "cfg_version_loader")
+
+@callback_route(prefix="maxplayers_")
+async def _cb_maxplayers(query, context, user_id, data):
+    user_settings[user_id]["max_players"] = data[len("maxplayers_"):]
+    await _refresh_submenu(context.bot, user_id, "cfg_players_mode")
+
+@callback_route(prefix="difficulty_")
+async def _cb_difficulty(query, context, user_id, data):
+    user_settings[user_id]["difficulty"] = data[len("difficulty_"):]
+    await _refresh_submenu(context.bot, user_id, "cfg_players_mode")
+
+@callback_route(prefix="gamemode_")
+async def _cb_gamemode(query, context, user_id, data):
+    user_settings[user_id]["gamemode"] = data[len("gamemode_"):]
+    await _refresh_submenu(context.bot, user_id, "cfg_players_mode")
+
+@callback_route(prefix="toggle_")
+async def _cb_toggle(query, context, user_id, data):
+    parts = data[len("toggle_"):].rsplit("_", 1)
+    setting_name = parts[0]
+    value = parts[1]
+    user_settings[user_id][setting_name] = value
+    back_map = {
+        "allow_nether": "cfg_world", "spawn_monsters": "cfg_world",
+        "spawn_animals": "cfg_world", "spawn_npcs": "cfg_world",
+        "generate_structures": "cfg_world",
+        "allow_flight": "cfg_performance", "command_blocks": "cfg_performance",
+        "hardcore": "cfg_security", "whitelist": "cfg_security",
+        "pvp": "cfg_players_mode", "online_mode": "cfg_players_mode"
+    }
+    await _refresh_submenu(context.bot, user_id, back_map.get(setting_name, "config_menu"))
+
+@callback_route(prefix="leveltype_")
+async def _cb_leveltype(query, context, user_id, data):
+    user_settings[user_id]["level_type"] = data[len("leveltype_"):]
+    await _refresh_submenu(context.bot, user_id, "cfg_world")
+
+@callback_route(prefix="oplevel_")
+async def _cb_oplevel(query, context, user_id, data):
+    user_settings[user_id]["op_permission_level"] = data[len("oplevel_"):]
+    await _refresh_submenu(context.bot, user_id, "cfg_security")
+
+@callback_route("create_server")
+async def _cb_create_server(query, context, user_id, data):
+    if await _start_build(user_id, query, context):
         user_menu_message.pop(user_id, None)
-        user_creating_server[user_id] = True
-        msg = await query.edit_message_text("⏳ Запуск...")
-        await _do_create_server(user_id, msg, query, context)
+
+TOGGLE_ROUTES = {
+    "set_pvp": ("pvp", "⚔️ PvP (бои между игроками)", "cfg_players_mode"),
+    "set_online_mode": ("online_mode", "🔐 Проверка лицензии (Online Mode)", "cfg_players_mode"),
+    "set_nether": ("allow_nether", "🔥 Незер", "cfg_world"),
+    "set_monsters": ("spawn_monsters", "👹 Спавн монстров", "cfg_world"),
+    "set_animals": ("spawn_animals", "🐷 Спавн животных", "cfg_world"),
+    "set_npcs": ("spawn_npcs", "👨‍🌾 Спавн жителей (NPC)", "cfg_world"),
+    "set_structures": ("generate_structures", "🏛️ Генерация структур", "cfg_world"),
+    "set_flight": ("allow_flight", "✈️ Полёт", "cfg_performance"),
+    "set_cmd_blocks": ("command_blocks", "🎛️ Командные блоки", "cfg_performance"),
+    "set_hardcore": ("hardcore", "💀 Хардкор режим", "cfg_security"),
+    "set_whitelist": ("whitelist", "📋 Белый список", "cfg_security"),
+}
+
+INPUT_ROUTES = {
+    "set_port": ("input_port", "cfg_players_mode", "Введите порт сервера (1–65535):"),
+    "set_view_distance": ("input_viewdist", "cfg_world", "Введите дальность прорисовки в чанках (2–32):"),
+    "set_simulation_distance": ("input_simdist", "cfg_world", "Введите дальность симуляции в чанках (2–32):"),
+    "set_spawn_protection": ("input_spawnprot", "cfg_world", "Введите радиус защиты спавна в блоках (0 = выключено):"),
+    "set_max_world_size": ("input_max_world_size", "cfg_world", "Введите максимальный размер мира в блоках (мин. 1000):"),
+    "set_max_tick_time": ("input_max_tick", "cfg_performance", "Введите макс. время тика в мс (60000 = стандарт, -1 = безлимит):"),
+    "set_entity_range": ("input_entity_range", "cfg_performance", "Введите дальность трансляции сущностей в % (10–1000):"),
+    "set_idle_timeout": ("input_idle_timeout", "cfg_security", "Введите тайм-аут AFK в минутах (0 = выключено):"),
+    "input_version": ("input_version", "cfg_version_loader", "Введите версию Minecraft (например: 1.20.1):"),
+    "input_ram": ("input_ram", "cfg_version_loader", "Введите объём RAM в MB (например: 2048):"),
+    "input_maxplayers": ("input_maxplayers", "cfg_players_mode", "Введите максимальное количество игроков:"),
+    "input_motd": ("input_motd", "cfg_players_mode", "Введите описание сервера (MOTD):"),
+    "input_seed": ("input_seed", "cfg_world", "Введите сид мира (или отправьте - для случайного):"),
+}
+
+@callback_route(*TOGGLE_ROUTES)
+async def _cb_toggle_menu(query, context, user_id, data):
+    setting_name, display_name, back_menu = TOGGLE_ROUTES[data]
+    await _toggle_menu(query, user_id, setting_name, display_name, back_menu)
+
+@callback_route(*INPUT_ROUTES)
+async def _cb_input(query, context, user_id, data):
+    state, back_menu, prompt_text = INPUT_ROUTES[data]
+    user_states[user_id] = (state, back_menu)
+    await _ask_input(query, context, user_id, prompt_text)
 
 async def _ask_input(query, context, user_id, prompt_text):
     sent = await query.message.reply_text(
@@ -991,85 +3284,16 @@ async def _ask_input(query, context, user_id, prompt_text):
 
 async def _toggle_menu(query, user_id, setting_name, display_name, back_menu):
     curr_val = user_settings.get(user_id, {}).get(setting_name, 'false')
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton(f"✅ Включить{'  ◀' if curr_val == 'true' else ''}", callback_data=f"toggle_{setting_name}_true")],
-        [InlineKeyboardButton(f"❌ Выключить{'  ◀' if curr_val == 'false' else ''}", callback_data=f"toggle_{setting_name}_false")],
-        [InlineKeyboardButton("🔙 Назад", callback_data=back_menu)]
-    ])
-    await query.edit_message_text(f"{display_name}:", reply_markup=keyboard)
+    text, keyboard = render_toggle_menu(setting_name, display_name, back_menu, curr_val)
+    await query.edit_message_text(text, reply_markup=keyboard)
     user_menu_message[user_id] = {"chat_id": query.message.chat_id, "message_id": query.message.message_id}
 
 async def _refresh_submenu(bot, user_id, menu_key):
     info = user_menu_message.get(user_id)
-    if not info:
+    if not info or menu_key not in MENU_RENDERERS:
         return
-    curr = user_settings.get(user_id, get_default_settings())
-
-    if menu_key == "cfg_players_mode":
-        difficulty_names = {"peaceful": "Мирная", "easy": "Лёгкая", "normal": "Обычная", "hard": "Тяжёлая"}
-        gamemode_names = {"survival": "Выживание", "creative": "Творческий", "adventure": "Приключение", "spectator": "Наблюдатель"}
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"👥 Макс. игроков: {curr.get('max_players','20')}", callback_data="set_max_players")],
-            [InlineKeyboardButton(f"⚔️ Сложность: {difficulty_names.get(curr.get('difficulty','normal'), curr.get('difficulty','normal'))}", callback_data="set_difficulty")],
-            [InlineKeyboardButton(f"🎮 Режим игры: {gamemode_names.get(curr.get('gamemode','survival'), curr.get('gamemode','survival'))}", callback_data="set_gamemode")],
-            [InlineKeyboardButton(f"⚔️ PvP: {'Включено' if curr.get('pvp','true')=='true' else 'Выключено'}", callback_data="set_pvp")],
-            [InlineKeyboardButton(f"🔐 Проверка лицензии: {'Включена' if curr.get('online_mode','true')=='true' else 'Выключена'}", callback_data="set_online_mode")],
-            [InlineKeyboardButton(f"🌐 Порт: {curr.get('port','25565')}", callback_data="set_port")],
-            [InlineKeyboardButton("📝 Описание сервера (MOTD)", callback_data="input_motd")],
-            [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
-        ])
-        await edit_menu(bot, info["chat_id"], info["message_id"], "👥 Игроки и режим игры:", keyboard)
-
-    elif menu_key == "cfg_world":
-        level_type_names = {
-            "minecraft:normal": "Стандартный", "minecraft:flat": "Плоский",
-            "minecraft:large_biomes": "Большие биомы", "minecraft:amplified": "Усиленный"
-        }
-        def yn(v, t='true'): return "Да" if v == t else "Нет"
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"👁️ Прорисовка: {curr.get('view_distance','10')} чанков", callback_data="set_view_distance")],
-            [InlineKeyboardButton(f"🔮 Симуляция: {curr.get('simulation_distance','10')} чанков", callback_data="set_simulation_distance")],
-            [InlineKeyboardButton(f"🏰 Защита спавна: {curr.get('spawn_protection','16')} блоков", callback_data="set_spawn_protection")],
-            [InlineKeyboardButton(f"🔥 Незер: {yn(curr.get('allow_nether','true'))}", callback_data="set_nether")],
-            [InlineKeyboardButton(f"👹 Монстры: {yn(curr.get('spawn_monsters','true'))}", callback_data="set_monsters")],
-            [InlineKeyboardButton(f"🐷 Животные: {yn(curr.get('spawn_animals','true'))}", callback_data="set_animals")],
-            [InlineKeyboardButton(f"👨‍🌾 Жители (NPC): {yn(curr.get('spawn_npcs','true'))}", callback_data="set_npcs")],
-            [InlineKeyboardButton(f"🏛️ Структуры: {yn(curr.get('generate_structures','true'))}", callback_data="set_structures")],
-            [InlineKeyboardButton(f"🗺️ Тип мира: {level_type_names.get(curr.get('level_type','minecraft:normal'), curr.get('level_type','minecraft:normal'))}", callback_data="set_level_type")],
-            [InlineKeyboardButton(f"🌱 Сид: {curr.get('seed','') or 'Случайный'}", callback_data="input_seed")],
-            [InlineKeyboardButton(f"📐 Макс. размер мира: {curr.get('max_world_size','29999984')}", callback_data="set_max_world_size")],
-            [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
-        ])
-        await edit_menu(bot, info["chat_id"], info["message_id"], "🌍 Мир и генерация:", keyboard)
-
-    elif menu_key == "cfg_performance":
-        tick = curr.get('max_tick_time', '60000')
-        tick_label = "Безлимит" if tick == '-1' else f"{tick} мс"
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"✈️ Полёт: {'Разрешён' if curr.get('allow_flight','false')=='true' else 'Запрещён'}", callback_data="set_flight")],
-            [InlineKeyboardButton(f"🎛️ Командные блоки: {'Включены' if curr.get('command_blocks','false')=='true' else 'Выключены'}", callback_data="set_cmd_blocks")],
-            [InlineKeyboardButton(f"⏱️ Макс. время тика: {tick_label}", callback_data="set_max_tick_time")],
-            [InlineKeyboardButton(f"📡 Дальность сущностей: {curr.get('entity_broadcast_range','100')}%", callback_data="set_entity_range")],
-            [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
-        ])
-        await edit_menu(bot, info["chat_id"], info["message_id"], "⚙️ Производительность:", keyboard)
-
-    elif menu_key == "cfg_security":
-        idle = curr.get('player_idle_timeout', '0')
-        idle_label = f"{idle} мин" if idle != '0' else "Выключен"
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"💀 Хардкор: {'Включён' if curr.get('hardcore','false')=='true' else 'Выключен'}", callback_data="set_hardcore")],
-            [InlineKeyboardButton(f"📋 Белый список: {'Включён' if curr.get('whitelist','false')=='true' else 'Выключен'}", callback_data="set_whitelist")],
-            [InlineKeyboardButton(f"👑 Уровень прав оператора: {curr.get('op_permission_level','4')}", callback_data="set_op_level")],
-            [InlineKeyboardButton(f"💤 Тайм-аут AFK: {idle_label}", callback_data="set_idle_timeout")],
-            [InlineKeyboardButton("🔙 Назад к конфигурации", callback_data="config_menu")]
-        ])
-        await edit_menu(bot, info["chat_id"], info["message_id"], "🔒 Безопасность:", keyboard)
-
-    elif menu_key == "config_menu":
-        summary = format_config_summary(curr)
-        await edit_menu(bot, info["chat_id"], info["message_id"],
-                        f"🛠️ Конфигурация сервера\n\n{summary}", build_config_keyboard())
+    text, keyboard = render_menu(menu_key, user_settings.get(user_id, get_default_settings()))
+    await edit_menu(bot, info["chat_id"], info["message_id"], text, keyboard)
 
 async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -1160,12 +3384,16 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if error_text:
         note = await context.bot.send_message(chat_id=chat_id, text=error_text)
-        await asyncio.sleep(3)
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=note.message_id)
-            await context.bot.delete_message(chat_id=chat_id, message_id=user_msg_id)
-        except:
-            pass
+
+        async def cleanup_error():
+            await asyncio.sleep(3)
+            try:
+                await context.bot.delete_message(chat_id=chat_id, message_id=note.message_id, rate_limit_args=PRIORITY_CLEANUP)
+                await context.bot.delete_message(chat_id=chat_id, message_id=user_msg_id, rate_limit_args=PRIORITY_CLEANUP)
+            except:
+                pass
+
+        context.application.create_task(cleanup_error())
         return
 
     user_states[user_id] = None
@@ -1173,29 +3401,202 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     async def cleanup():
         await asyncio.sleep(3)
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=user_msg_id)
+            await context.bot.delete_message(chat_id=chat_id, message_id=user_msg_id, rate_limit_args=PRIORITY_CLEANUP)
         except:
             pass
         prompt_msg_id = context.user_data.get("prompt_msg_id") if context.user_data else None
         prompt_chat_id = context.user_data.get("prompt_chat_id", chat_id) if context.user_data else chat_id
         if prompt_msg_id:
             try:
-                await context.bot.delete_message(chat_id=prompt_chat_id, message_id=prompt_msg_id)
+                await context.bot.delete_message(chat_id=prompt_chat_id, message_id=prompt_msg_id, rate_limit_args=PRIORITY_CLEANUP)
             except:
                 pass
 
     if applied:
-        asyncio.create_task(cleanup())
+        context.application.create_task(cleanup())
         await _refresh_submenu(context.bot, user_id, back_menu)
 
-async def _do_create_server(user_id, msg, query, context):
+def build_queue_size():
+    return sum(len(jobs) for jobs in build_queue.values())
+
+def _build_queue_order():
+    order = []
+    rounds = [list(jobs) for jobs in build_queue.values()]
+    depth = 0
+    while any(depth < len(jobs) for jobs in rounds):
+        for jobs in rounds:
+            if depth < len(jobs):
+                order.append(jobs[depth])
+        depth += 1
+    return order
+
+def _format_eta(seconds):
+    if seconds < 60:
+        return f"~{int(seconds)} с"
+    return f"~{math.ceil(seconds / 60)} мин"
+
+async def _announce_queue_positions():
+    order = _build_queue_order()
+    free = max(0, BUILD_WORKERS - build_stats["active"])
+    for position, job in enumerate(order, 1):
+        if position <= free or job["position"] == position:
+            continue
+        job["position"] = position
+        eta = math.ceil((position - free) / BUILD_WORKERS) * build_stats["avg_seconds"]
+        await job["progress"](
+            f"🕐 В очереди на сборку: {position} из {len(order)}\n"
+            f"⏱️ Ожидание: {_format_eta(eta)}"
+        )
+
+def _next_build_job():
+    for user_id in build_queue:
+        jobs = build_queue.pop(user_id)
+        job = jobs.popleft()
+        if jobs:
+            build_queue[user_id] = jobs
+        return job
+    return None
+
+async def submit_build(user_id, progress, run):
+    job = {
+        "user_id": user_id, "progress": progress, "run": run, "position": None,
+        "future": asyncio.get_event_loop().create_future()
+    }
+    job["future"].add_done_callback(lambda f: f.cancelled() or f.exception())
+    build_queue.setdefault(user_id, deque()).append(job)
+    build_wakeup.set()
+    await _announce_queue_positions()
+    return job["future"]
+
+async def build_worker():
+    while True:
+        job = _next_build_job()
+        if job is None:
+            build_wakeup.clear()
+            await build_wakeup.wait()
+            continue
+        build_stats["active"] += 1
+        await _announce_queue_positions()
+        started = time.monotonic()
+        try:
+            job["future"].set_result(await job["run"]())
+        except asyncio.CancelledError:
+            job["future"].cancel()
+            await asyncio.gather(job["progress"].finish(BUILD_DROPPED_TEXT), return_exceptions=True)
+            raise
+        except Exception as e:
+            job["future"].set_exception(e)
+        finally:
+            build_stats["active"] -= 1
+            build_stats["completed"] += 1
+            build_stats["avg_seconds"] = build_stats["avg_seconds"] * 0.8 + (time.monotonic() - started) * 0.2
+
+def start_build_workers():
+    global build_wakeup
+    build_wakeup = asyncio.Event()
+    for _ in range(BUILD_WORKERS):
+        build_workers.append(asyncio.create_task(build_worker()))
+
+async def stop_build_workers():
+    for task in build_workers:
+        task.cancel()
+    await asyncio.gather(*build_workers, return_exceptions=True)
+    build_workers.clear()
+
+async def drop_build_jobs():
+    jobs = [job for queued in build_queue.values() for job in queued]
+    build_queue.clear()
+    for job in jobs:
+        job["future"].cancel()
+    await asyncio.gather(*(job["progress"].finish(BUILD_DROPPED_TEXT) for job in jobs), return_exceptions=True)
+    await stop_build_workers()
+    await asyncio.gather(*(release_build_lock(user_id) for user_id in list(build_locks)), return_exceptions=True)
+
+async def _keep_lock(name, token, ttl):
+    while True:
+        await asyncio.sleep(ttl / 3)
+        try:
+            if not await backend_call(state_backend.refresh_lock, name, token, ttl):
+                print(f"[ERROR] Блокировка {name} потеряна")
+                return
+        except Exception as e:
+            print(f"[ERROR] Продление блокировки {name}: {e}")
+
+async def acquire_build_lock(user_id):
+    token = f"{INSTANCE_ID}:{os.urandom(8).hex()}"
+    if not await backend_call(state_backend.acquire_lock, f"build:{user_id}", token, BUILD_LOCK_TTL):
+        return False
+    build_locks[user_id] = (token, asyncio.create_task(_keep_lock(f"build:{user_id}", token, BUILD_LOCK_TTL)))
+    return True
+
+async def release_build_lock(user_id, token=None):
+    held = build_locks.get(user_id)
+    if held is None or (token and held[0] != token):
+        return
+    del build_locks[user_id]
+    token, keeper = held
+    keeper.cancel()
+    try:
+        await backend_call(state_backend.release_lock, f"build:{user_id}", token)
+    except Exception as e:
+        print(f"[ERROR] Снятие блокировки {user_id}: {e}")
+
+async def _start_build(user_id, query, context):
+    try:
+        locked = await acquire_build_lock(user_id)
+    except Exception as e:
+        print(f"[ERROR] Блокировка сборки {user_id}: {e}")
+        await query.answer("⚠️ Сборка временно недоступна, попробуйте позже", show_alert=True)
+        return False
+    if not locked:
+        await query.answer("⚠️ Сервер уже создаётся!", show_alert=True)
+        return False
+    try:
+        if build_queue_size() >= BUILD_QUEUE_LIMIT:
+            build_stats["rejected"] += 1
+            await release_build_lock(user_id)
+            await query.edit_message_text(
+                "⚠️ Очередь сборки переполнена\n\nПопробуйте ещё раз через пару минут.",
+                reply_markup=BACK_TO_ACTIONS_KEYBOARD
+            )
+            return False
+        msg = await query.edit_message_text("⏳ Запуск...")
+        progress = ProgressReporter(msg)
+        progress.sent_text = "⏳ Запуск..."
+        token = build_locks[user_id][0]
+        settings = dict(user_settings.get(user_id, {}).items())
+        await submit_build(user_id, progress, lambda: _do_create_server(user_id, progress, query, context, token, settings))
+    except BaseException:
+        await release_build_lock(user_id)
+        raise
+    return True
+
+async def _do_create_server(user_id, progress, query, context, token, settings):
     temp_path = None
+    menu_delay = 3
+
+    async def follow_up(temp_path):
+        try:
+            await asyncio.sleep(menu_delay)
+            await context.bot.send_message(
+                chat_id=query.message.chat_id,
+                text="📋 Выберите действие:",
+                reply_markup=ACTION_MENU_KEYBOARD
+            )
+        except Exception as e:
+            print(f"[ERROR] Меню после сборки: {e}")
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                try:
+                    os.unlink(temp_path)
+                except Exception as e:
+                    print(f"[ERROR] Удаление файла: {e}")
+
     try:
-        temp_path, archive_size, original_size, compression = await create_server_package(user_id, msg)
-        s = user_settings.get(user_id, {})
-        loader = s.get('loader') or 'Fabric'
-        version = s.get('version') or '1.20.1'
-        ram = s.get('ram') or '2048'
+        temp_path, archive_size, original_size, compression = await create_server_package(settings, progress)
+        loader = settings.get('loader') or 'Fabric'
+        version = settings.get('version') or '1.20.1'
+        ram = settings.get('ram') or '2048'
         _, java_label = get_java_for_version(version)
         fname = f"minecraft-server-{version}-{loader.lower()}.zip"
         caption = (
@@ -1206,59 +3607,286 @@ async def _do_create_server(user_id, msg, query, context):
             f"☕ Требуется: {java_label}\n\n"
             f"🚀 Распакуйте и запустите start.bat (Windows) или start.sh (Linux)"
         )
-        await msg.edit_text(f"📤 Отправка {archive_size / (1024*1024):.1f} MB...")
-        with open(temp_path, 'rb') as file:
-            await context.bot.send_document(
-                chat_id=query.message.chat_id,
-                document=file,
-                filename=fname,
-                caption=caption,
-                read_timeout=600,
-                write_timeout=600,
-                connect_timeout=120,
-                pool_timeout=120
-            )
-        await msg.delete()
-        await asyncio.sleep(3)
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📦 Быстрые шаблоны", callback_data="presets_menu")],
-            [InlineKeyboardButton("🛠️ Конфигурация", callback_data="config_menu")],
-            [InlineKeyboardButton("☕ Java - инструкция", callback_data="java_info")],
-            [InlineKeyboardButton("📖 Помощь", callback_data="help_menu")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-        ])
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="📋 Выберите действие:",
-            reply_markup=keyboard
+        loop = asyncio.get_event_loop()
+        archive_hash = await loop.run_in_executor(None, hash_file_sync, temp_path)
+        file_id = file_id_cache.get(archive_hash)
+        sent = None
+        if file_id:
+            try:
+                sent = await context.bot.send_document(
+                    chat_id=query.message.chat_id,
+                    document=file_id,
+                    caption=caption
+                )
+                file_id_stats["hits"] += 1
+                file_id_stats["bytes_saved"] += archive_size
+            except Exception:
+                file_id_cache.pop(archive_hash, None)
+        if sent is None:
+            await progress(f"📤 Отправка {archive_size / (1024*1024):.1f} MB...")
+            with open(temp_path, 'rb') as file:
+                sent = await context.bot.send_document(
+                    chat_id=query.message.chat_id,
+                    document=file,
+                    filename=fname,
+                    caption=caption,
+                    read_timeout=600,
+                    write_timeout=600,
+                    connect_timeout=120,
+                    pool_timeout=120
+                )
+            file_id_stats["uploads"] += 1
+            if sent.document:
+                await remember_file_id(archive_hash, sent.document.file_id)
+        await progress.close()
+        await context.bot.delete_message(
+            chat_id=progress.message.chat_id,
+            message_id=progress.message.message_id,
+            rate_limit_args=PRIORITY_CLEANUP
         )
     except Exception as e:
         traceback.print_exc()
-        await msg.edit_text(f"❌ Ошибка:\n\n{str(e)}")
-        await asyncio.sleep(5)
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📦 Быстрые шаблоны", callback_data="presets_menu")],
-            [InlineKeyboardButton("🛠️ Конфигурация", callback_data="config_menu")],
-            [InlineKeyboardButton("☕ Java - инструкция", callback_data="java_info")],
-            [InlineKeyboardButton("📖 Помощь", callback_data="help_menu")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-        ])
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="📋 Выберите действие:",
-            reply_markup=keyboard
-        )
+        await progress.finish(f"❌ Ошибка:\n\n{str(e)}")
+        menu_delay = 5
     finally:
-        user_creating_server[user_id] = False
-        if temp_path and os.path.exists(temp_path):
+        await release_build_lock(user_id, token)
+        context.application.create_task(follow_up(temp_path))
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class OutboundScheduler(BaseRateLimiter):
+    def __init__(self):
+        self._global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._chats = {}
+        self._waiters = []
+        self._seq = 0
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._pump_task = None
+
+    async def initialize(self):
+        self._wakeup = asyncio.Event()
+        self._pump_task = asyncio.create_task(self._pump())
+
+    async def shutdown(self):
+        if self._pump_task:
+            self._pump_task.cancel()
             try:
-                await asyncio.sleep(1)
-                os.unlink(temp_path)
-            except Exception as e:
-                print(f"[ERROR] Удаление файла: {e}")
+                await self._pump_task
+            except asyncio.CancelledError:
+                pass
+            self._pump_task = None
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                now = time.monotonic()
+                self._chats = {k: b for k, b in self._chats.items() if b.wait_time(now) or b.tokens < b.capacity}
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(TG_GROUP_CHAT_RATE, 3)
+            else:
+                bucket = TokenBucket(TG_PRIVATE_CHAT_RATE, 3)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id, priority):
+        future = asyncio.get_event_loop().create_future()
+        self._seq += 1
+        enqueued = time.monotonic()
+        heapq.heappush(self._waiters, (priority, self._seq, chat_id, future))
+        outbound_stats["queue_depth"] = len(self._waiters)
+        outbound_stats["max_queue_depth"] = max(outbound_stats["max_queue_depth"], len(self._waiters))
+        self._wakeup.set()
+        await future
+        waited = time.monotonic() - enqueued
+        outbound_stats["total_wait"] += waited
+        outbound_stats["max_wait"] = max(outbound_stats["max_wait"], waited)
+
+    async def _pump(self):
+        while True:
+            self._waiters = [w for w in self._waiters if not w[3].done()]
+            heapq.heapify(self._waiters)
+            outbound_stats["queue_depth"] = len(self._waiters)
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            delay = max(self._paused_until - now, self._global.wait_time(now))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            chosen = None
+            delay = None
+            for waiter in sorted(self._waiters):
+                chat_delay = self._chat_bucket(waiter[2]).wait_time(now)
+                if chat_delay == 0:
+                    chosen = waiter
+                    break
+                delay = chat_delay if delay is None else min(delay, chat_delay)
+            if chosen is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._waiters.remove(chosen)
+            self._global.take()
+            self._chat_bucket(chosen[2]).take()
+            chosen[3].set_result(None)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        priority = PRIORITY_MENU if rate_limit_args is None else rate_limit_args
+        for attempt in range(TG_MAX_RETRIES + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                result = await callback(*args, **kwargs)
+                outbound_stats["sent"] += 1
+                return result
+            except RetryAfter as e:
+                outbound_stats["retry_after"] += 1
+                if attempt == TG_MAX_RETRIES:
+                    raise
+                self._paused_until = time.monotonic() + retry_after_seconds(e) + 0.1
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates, max_pending_updates):
+        super().__init__(max_pending_updates)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._user_locks = {}
+        self._user_pending = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+        lock = self._user_locks.setdefault(user.id, asyncio.Lock())
+        self._user_pending[user.id] = self._user_pending.get(user.id, 0) + 1
+        try:
+            async with lock, self._slots:
+                await state_store.sync_user(user.id)
+                try:
+                    await coroutine
+                finally:
+                    await state_store.flush_user(user.id)
+        finally:
+            self._user_pending[user.id] -= 1
+            if not self._user_pending[user.id]:
+                del self._user_pending[user.id]
+                del self._user_locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+async def webhook_handler(request):
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token.encode(), request.app["secret"].encode()):
+        webhook_stats["rejected"] += 1
+        return web.Response(status=403)
+    app = request.app["bot_app"]
+    try:
+        update = Update.de_json(await request.json(), app.bot)
+    except Exception:
+        webhook_stats["malformed"] += 1
+        return web.Response(status=400)
+    webhook_stats["received"] += 1
+    app.update_queue.put_nowait(update)
+    return web.Response()
+
+async def healthz_handler(request):
+    return web.Response(text="ok")
+
+async def run_webhook(app):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    web_app = web.Application(client_max_size=1024 * 1024)
+    web_app["bot_app"] = app
+    web_app["secret"] = WEBHOOK_SECRET
+    if not WEBHOOK_SECRET:
+        web_app["secret"] = secrets.token_urlsafe(32)
+        print("[WARN] WEBHOOK_SECRET не задан, сгенерирован случайный; для нескольких реплик задайте общий")
+    web_app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    web_app.router.add_get("/healthz", healthz_handler)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=web_app["secret"],
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES
+        )
+        await app.start()
+        print(f"[INFO] Webhook слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        if app.running:
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        await app.shutdown()
+
+async def on_startup(app):
+    if STATE_MULTI_REPLICA and not state_backend.shared:
+        print("[WARN] STATE_MULTI_REPLICA включён, но хранилище состояния не общее")
+    get_http_session()
+    state_store.start()
+    start_build_workers()
+    start_jar_warmer()
+
+async def on_stop(app):
+    await drop_build_jobs()
+
+async def on_shutdown(app):
+    await stop_jar_warmer()
+    await drop_build_jobs()
+    await close_http_session()
+    await state_store.close()
 
 def main():
+    if not TOKEN:
+        print("[ERROR] Не задан токен бота: укажите переменную окружения BOT_TOKEN")
+        return
     print("[INFO] Запуск бота...")
+    load_jar_cache_index()
+    load_file_id_cache()
+    load_jar_popularity()
+    load_size_predictions()
     request = HTTPXRequest(
         connection_pool_size=16,
         read_timeout=600,
@@ -1266,12 +3894,26 @@ def main():
         connect_timeout=120,
         pool_timeout=120
     )
-    app = Application.builder().token(TOKEN).request(request).build()
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .request(request)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES))
+        .rate_limiter(OutboundScheduler())
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("stats", stats_command))
     app.add_handler(CallbackQueryHandler(button_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_input))
     print("[INFO] Бот запущен! Ожидание команд...")
-    app.run_polling()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()